@@ -0,0 +1,303 @@
+import argparse
+import csv
+import json
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+
+import fake_github_api
+import metrics
+import repo_collector
+import repo_scanner
+import synthetic_repos
+from scan_engine import PatternMatcher
+from tarball_fetch import TarballFetcher
+from url_index import UrlIndex
+from workspace import Workspace
+
+# brief functionality explanation:
+# runs the collector and the scanner against local stand-ins (fake_github_api.py
+# and a corpus from synthetic_repos.py) and reports throughput as JSON, so runs
+# of different versions can be compared.
+# every scenario runs in a fresh process, so peak memory is measured per scenario.
+# the output of the tools under test is hidden unless --verbose is given.
+
+# "search" scenarios run search_github_repositories against the fake API,
+# "scan" scenarios run handle_report over a synthetic corpus,
+# "match" scenarios run the pattern matcher over random data (cost per pattern)
+SCENARIOS = {
+    "search_1_token": {"kind": "search", "keywords": 2, "results": 250, "latency": 0.02, "tokens": 1},
+    "search_4_tokens": {"kind": "search", "keywords": 2, "results": 250, "latency": 0.02, "tokens": 4},
+    "scan_1_worker": {"kind": "scan", "repos": 20, "files": 50, "file_size": 4096, "workers": 1},
+    "scan_4_workers": {"kind": "scan", "repos": 20, "files": 50, "file_size": 4096, "workers": 4},
+    "scan_git_daemon": {"kind": "scan", "repos": 20, "files": 50, "file_size": 4096, "workers": 4,
+                        "transport": "daemon"},
+    "scan_blob_limit": {"kind": "scan", "repos": 10, "files": 50, "file_size": 4096, "workers": 4,
+                        "large_files": 2, "blob_limit": "1m"},
+    "scan_tarball_stream": {"kind": "scan", "repos": 20, "files": 50, "file_size": 4096, "workers": 4,
+                            "transport": "tarball"},
+    "match_2_patterns": {"kind": "match", "literals": 2},
+    "match_50_patterns": {"kind": "match", "literals": 45, "regexes": 5},
+}
+
+SEARCH_DEFAULTS = {"keywords": 2, "results": 250, "latency": 0.0, "limit": 30, "window": 60,
+                   "retry_after": None, "tokens": 1, "min_interval": 1.0}
+SCAN_DEFAULTS = {"repos": 20, "files": 50, "file_size": 4096, "python_ratio": 0.6, "binary_ratio": 0.1,
+                 "large_files": 0, "hit_ratio": 0.2, "seed": 0, "workers": 1, "transport": "file",
+                 "blob_limit": None, "sparse": None, "max_size_mb": 100}
+
+MATCH_DEFAULTS = {"literals": 2, "regexes": 0, "data_mb": 2, "repeat": 5, "seed": 0}
+
+
+def run_search(config):
+    """
+    Pages through the search results of a few keywords on a fake API.
+
+    Args:
+        config (dict): The scenario, see SEARCH_DEFAULTS.
+
+    Returns:
+        dict: The metrics.
+    """
+    config = dict(SEARCH_DEFAULTS, **config)
+    server = fake_github_api.start_server(results=config["results"], limit=config["limit"],
+                                          window=config["window"], retry_after=config["retry_after"],
+                                          latency=config["latency"])
+    repo_collector.configure_session(server.url, pool_size=4)
+    tokens = repo_collector.TokenPool([f"bench-token-{number}" for number in range(config["tokens"])],
+                                      min_interval=config["min_interval"])
+
+    start = time.perf_counter()
+    repositories = 0
+    for number in range(config["keywords"]):
+        repositories += len(repo_collector.search_github_repositories(tokens, f"bench{number}", "python", 10, 14))
+    elapsed = time.perf_counter() - start
+    server.shutdown()
+
+    pages = server.stats["requests"]
+    return {
+        "elapsed_s": round(elapsed, 3),
+        "pages": pages,
+        "pages_per_s": round(pages / elapsed, 2),
+        "repos": repositories,
+        "repos_per_hour": round(repositories / elapsed * 3600),
+        "rate_limited": server.stats["rate_limited"],
+        "stage_seconds": {stage: values["sum_s"] for stage, values in metrics.registry.snapshot()["stages"].items()},
+    }
+
+
+def run_scan(config, workdir):
+    """
+    Clones and scans a synthetic corpus with handle_report.
+
+    Args:
+        config (dict): The scenario, see SCAN_DEFAULTS.
+        workdir (str): The directory for the corpus and the scan.
+
+    Returns:
+        dict: The metrics.
+    """
+    config = dict(SCAN_DEFAULTS, **config)
+    corpus = synthetic_repos.make_corpus(os.path.join(workdir, "corpus"), repos=config["repos"],
+                                         hit_ratio=config["hit_ratio"], seed=config["seed"],
+                                         files=config["files"], file_size=config["file_size"],
+                                         python_ratio=config["python_ratio"],
+                                         binary_ratio=config["binary_ratio"], large_files=config["large_files"])
+    daemon = None
+    if config["transport"] == "daemon":
+        daemon = synthetic_repos.GitDaemon(synthetic_repos.corpus_root(corpus))
+        urls = daemon.urls(corpus)
+    elif config["transport"] == "tarball":
+        # streamed and scanned in memory instead of cloned
+        daemon = synthetic_repos.TarballServer(synthetic_repos.corpus_root(corpus))
+        urls = daemon.urls(corpus)
+        repo_scanner.tarballs = TarballFetcher(pool_size=config["workers"])
+    else:
+        urls = synthetic_repos.file_urls(corpus)
+
+    # the scanner works in the current directory (hits.txt)
+    run_dir = tempfile.mkdtemp(prefix="scan-", dir=workdir)
+    os.chdir(run_dir)
+    with open("repositories_1.csv", "w", newline="") as file:
+        writer = csv.writer(file)
+        for repo, url in zip(corpus, urls):
+            writer.writerow([repo["name"], "10", url, str(repo["size"] // 1024)])
+
+    repo_scanner.CLONE_DELAY = 0
+    repo_scanner.workspace = Workspace(os.path.join(run_dir, "tmp"))
+    blacklist = UrlIndex(os.path.join(run_dir, "blacklist.db"), "scanned")
+    clone_options = {"blob_limit": config["blob_limit"], "sparse_patterns": config["sparse"]}
+
+    try:
+        start = time.perf_counter()
+        repo_scanner.handle_report(run_dir, 1, blacklist, workers=config["workers"], max_hits=len(corpus) + 1,
+                                   max_size_mb=config["max_size_mb"], clone_options=clone_options)
+        elapsed = time.perf_counter() - start
+    finally:
+        blacklist.close()
+        # deletions run in the background, wait for them before removing the run directory
+        repo_scanner.workspace.close()
+        if daemon is not None:
+            daemon.close()
+
+    os.chdir(workdir)
+    shutil.rmtree(run_dir, ignore_errors=True)
+
+    snapshot = metrics.registry.snapshot()
+    counters = snapshot["counters"]
+    return {
+        "elapsed_s": round(elapsed, 3),
+        "repos": len(corpus),
+        # repositories that failed permanently (deleted, private, too big) take no real work
+        "repos_per_hour": round((len(corpus) - counters.get("repos_failed_permanently", 0)) / elapsed * 3600),
+        "bytes_cloned": counters.get("bytes_cloned", 0),
+        "bytes_checked_out": sum(repo["size"] for repo in corpus),
+        "files_scanned": counters.get("files_scanned", 0),
+        "hits": counters.get("hits", 0),
+        "expected_hits": sum(repo["hit"] for repo in corpus),
+        # where the time went (summed over all workers)
+        "stage_seconds": {stage: values["sum_s"] for stage, values in snapshot["stages"].items()},
+    }
+
+
+def run_match(config):
+    """
+    Matches literals and regexes (none of which occur) against random data,
+    the worst case where every pattern has to look at every byte.
+
+    Args:
+        config (dict): The scenario, see MATCH_DEFAULTS.
+
+    Returns:
+        dict: The metrics.
+    """
+    config = dict(MATCH_DEFAULTS, **config)
+    rng = random.Random(config["seed"])
+    data = rng.randbytes(int(config["data_mb"] * 1024 * 1024))
+    matcher = PatternMatcher(literals=[f"needle_{number}_literal" for number in range(config["literals"])],
+                             regexes=[rf"needle_{number}\s*\(\w+" for number in range(config["regexes"])])
+
+    start = time.perf_counter()
+    for _ in range(config["repeat"]):
+        matcher.find(data)
+    elapsed = time.perf_counter() - start
+    return {
+        "elapsed_s": round(elapsed, 3),
+        "patterns": len(matcher.names),
+        "mb_per_s": round(config["data_mb"] * config["repeat"] / elapsed, 1),
+    }
+
+
+def peak_rss_mb(who):
+    # kilobytes on linux, bytes on macos
+    maxrss = resource.getrusage(who).ru_maxrss
+    return round(maxrss / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+def run_scenario(config, workdir, verbose, results):
+    """
+    Runs one scenario (in its own process) and puts its metrics into `results`.
+    """
+    if not verbose:
+        # on the file descriptors, so git (which inherits them) is silenced too
+        devnull = os.open(os.devnull, os.O_WRONLY)
+        os.dup2(devnull, 1)
+        os.dup2(devnull, 2)
+    if config["kind"] == "search":
+        metrics = run_search(config)
+    elif config["kind"] == "scan":
+        metrics = run_scan(config, workdir)
+    elif config["kind"] == "match":
+        metrics = run_match(config)
+    else:
+        raise ValueError(f"unknown scenario kind {config['kind']!r}")
+    metrics["peak_rss_mb"] = peak_rss_mb(resource.RUSAGE_SELF)
+    metrics["peak_rss_children_mb"] = peak_rss_mb(resource.RUSAGE_CHILDREN)
+    results.put(metrics)
+
+
+def version():
+    """
+    Returns:
+        str: The git version of this tree, e.g. "a4e2fb3" or "a4e2fb3-dirty".
+    """
+    try:
+        return subprocess.run(["git", "describe", "--always", "--dirty"], cwd=os.path.dirname(os.path.abspath(__file__)),
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks for repo_collector and repo_scanner')
+    parser.add_argument('--scenarios', type=str, default=None, help='JSON file with scenarios ({"name": {"kind": ..., ...}}), replaces the built-in ones (optional)')
+    parser.add_argument('--only', type=str, nargs='+', default=None, help='Only run these scenarios (optional)')
+    parser.add_argument('--workdir', type=str, default='./bench', help='Directory for the synthetic corpus (reused between runs)')
+    parser.add_argument('--out', type=str, default=None, help='Write the results to this JSON file (optional, default: print them)')
+    parser.add_argument('--verbose', action='store_true', help='Show the output of the tools under test (optional)')
+
+    parser.epilog = """
+    Every scenario runs in its own process against local stand-ins, nothing
+    is sent to GitHub. Keep the JSON files of different versions to compare
+    them.
+
+    Example usage:
+    python benchmark.py --out bench-$(git describe --always).json
+    python benchmark.py --only scan_1_worker scan_4_workers
+    """
+    args = parser.parse_args()
+
+    scenarios = SCENARIOS
+    if args.scenarios is not None:
+        with open(args.scenarios) as file:
+            scenarios = json.load(file)
+    if args.only:
+        unknown = [name for name in args.only if name not in scenarios]
+        if unknown:
+            parser.error(f"unknown scenarios: {', '.join(unknown)}")
+        scenarios = {name: scenarios[name] for name in args.only}
+
+    workdir = os.path.abspath(args.workdir)
+    os.makedirs(workdir, exist_ok=True)
+
+    report = {
+        "version": version(),
+        "timestamp": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "scenarios": {},
+    }
+    context = multiprocessing.get_context("spawn")
+    for name, config in scenarios.items():
+        print(f"Running {name}...", file=sys.stderr)
+        results = context.Queue()
+        process = context.Process(target=run_scenario, args=(config, workdir, args.verbose, results))
+        process.start()
+        process.join()
+        if process.exitcode != 0:
+            print(f"{name} failed (exit code {process.exitcode})", file=sys.stderr)
+            report["scenarios"][name] = {"config": config, "error": process.exitcode}
+            continue
+        metrics = results.get()
+        print(f"{name}: {metrics}", file=sys.stderr)
+        report["scenarios"][name] = {"config": config, "metrics": metrics}
+
+    output = json.dumps(report, indent=2)
+    if args.out is not None:
+        with open(args.out, "w") as file:
+            file.write(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,373 @@
+import json
+import os
+import threading
+from datetime import date
+
+from repo_store import RepoInfo
+
+# brief functionality explanation:
+# small state files that let repo_collector and repo_scanner continue after a
+# crash or ctrl+c exactly where they stopped, without --file_batch_index or
+# --starting_point.
+# every change is written to a temp file, fsynced and renamed over the old
+# checkpoint, so a crash leaves either the old or the new state, never half of one.
+#
+# collector: the batch number, the finished keywords and the slices of the
+# keywords in progress. the pages fetched so far are appended to a journal
+# next to the checkpoint, so they are not requested again. it also records
+# slices whose results were cut off, so their watermark is not advanced after a restart.
+# scanner: the CSV file, the row offset (everything before it is done), the
+# repos that are being cloned/scanned and results that are not consumed yet.
+# rows picked from the store by push date are picked with the cutoff of the
+# first run, otherwise the offset would point into a different list of rows.
+
+
+def write_json_atomic(file_path, data):
+    """
+    Replaces a JSON file, so that readers (and crashes) see the old or the new content.
+
+    Args:
+        file_path (str): The path of the file.
+        data: The JSON-serializable content.
+    """
+    temp_path = file_path + '.tmp'
+    with open(temp_path, 'w') as file:
+        json.dump(data, file)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(temp_path, file_path)
+
+
+def read_json(file_path, default):
+    if not os.path.exists(file_path):
+        return default
+    with open(file_path) as file:
+        return json.load(file)
+
+
+def slice_key(search_slice):
+    """
+    Returns:
+        str: A stable key for a (min_stars, max_stars, created) search slice.
+    """
+    min_stars, max_stars, created = search_slice
+    created = None if created is None else [created[0].isoformat(), created[1].isoformat()]
+    return json.dumps([min_stars, max_stars, created])
+
+
+def parse_slice(key):
+    min_stars, max_stars, created = json.loads(key)
+    if created is not None:
+        created = (date.fromisoformat(created[0]), date.fromisoformat(created[1]))
+    return min_stars, max_stars, created
+
+
+class CollectorCheckpoint:
+    """
+    Progress of repo_collector. Thread safe (slices are collected in parallel).
+    """
+
+    def __init__(self, file_path):
+        """
+        Args:
+            file_path (str): The path of the checkpoint, the page journal is `<file_path>.pages`.
+        """
+        self.file_path = file_path
+        self.journal_path = file_path + '.pages'
+        self.lock = threading.Lock()
+        self.state = read_json(file_path, {"file_batch_index": None, "done": [], "slices": {}, "writing": None})
+        self.exists = os.path.exists(file_path)
+
+        # term -> slice key -> {"next_page", "done", "repos"}, rebuilt from the journal
+        self.pages = {}
+        if os.path.exists(self.journal_path):
+            with open(self.journal_path) as file:
+                for line in file:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # the last line may be cut off by a crash
+                        break
+                    self._apply(entry)
+        self.journal = open(self.journal_path, 'a')
+
+    def _apply(self, entry):
+        state = self.pages.setdefault(entry["term"], {}).setdefault(
+            entry["slice"], {"next_page": 1, "done": False, "complete": True, "repos": []})
+        if entry.get("done"):
+            state["done"] = True
+            state["complete"] = entry.get("complete", True)
+        else:
+            state["repos"].extend(RepoInfo(*repo_info) for repo_info in entry["repos"])
+            state["next_page"] = entry["page"] + 1
+
+    def _append(self, entry):
+        # caller holds the lock
+        self._apply(entry)
+        self.journal.write(json.dumps(entry) + '\n')
+        self.journal.flush()
+        os.fsync(self.journal.fileno())
+
+    def _save(self):
+        # caller holds the lock
+        write_json_atomic(self.file_path, self.state)
+        self.exists = True
+
+    @property
+    def file_batch_index(self):
+        return self.state["file_batch_index"]
+
+    def done_keywords(self):
+        return set(self.state["done"])
+
+    def start(self, file_batch_index):
+        """
+        Records the batch number a new run starts at (unless resuming).
+        """
+        with self.lock:
+            if self.state["file_batch_index"] is None:
+                self.state["file_batch_index"] = file_batch_index
+                self._save()
+
+    def next_pass(self):
+        """
+        Starts searching all keywords again (incremental mode), after the last batch of the previous pass.
+        """
+        with self.lock:
+            self.state.update({"done": [], "slices": {}, "writing": None})
+            self._save()
+
+    def slices(self, term):
+        """
+        Returns:
+            list: The slices a keyword was partitioned into before, or None.
+        """
+        with self.lock:
+            keys = self.state["slices"].get(term)
+        return None if keys is None else [parse_slice(key) for key in keys]
+
+    def set_slices(self, term, slices):
+        with self.lock:
+            self.state["slices"][term] = [slice_key(search_slice) for search_slice in slices]
+            self._save()
+
+    def slice_state(self, term, search_slice):
+        """
+        Returns:
+            tuple: (next page to fetch, True if the slice is finished)
+        """
+        with self.lock:
+            state = self.pages.get(term, {}).get(slice_key(search_slice))
+        return (1, False) if state is None else (state["next_page"], state["done"])
+
+    def page_done(self, term, search_slice, page, repositories):
+        with self.lock:
+            self._append({"term": term, "slice": slice_key(search_slice), "page": page,
+                          "repos": [list(repo_info) for repo_info in repositories]})
+
+    def page_recorder(self, term, search_slice, start_page, on_page=None):
+        """
+        Returns:
+            callable: An on_page callback for search_github_repositories that journals every page.
+        """
+        page = start_page
+
+        def record(repositories):
+            nonlocal page
+            self.page_done(term, search_slice, page, repositories)
+            page += 1
+            if on_page is not None:
+                on_page(repositories)
+        return record
+
+    def slice_done(self, term, search_slice, complete=True):
+        """
+        Args:
+            term (str): The keyword.
+            search_slice (tuple): The (min_stars, max_stars, created) slice.
+            complete (bool, optional): False if results of the slice were left out (e.g. over the result cap). Defaults to True.
+        """
+        with self.lock:
+            self._append({"term": term, "slice": slice_key(search_slice), "done": True, "complete": complete})
+
+    def complete(self, term):
+        """
+        Returns:
+            bool: False if results of any journaled slice of a keyword were left out.
+        """
+        with self.lock:
+            return all(state["complete"] for state in self.pages.get(term, {}).values())
+
+    def collected(self, term):
+        """
+        Returns:
+            list: All repositories journaled for a keyword, in slice and page order.
+        """
+        with self.lock:
+            slices = self.state["slices"].get(term) or list(self.pages.get(term, {}))
+            states = self.pages.get(term, {})
+            return [repo_info for key in slices if key in states for repo_info in states[key]["repos"]]
+
+    def writing(self, term, file_batch_index):
+        """
+        Records that a keyword is about to be written as batch `file_batch_index`.
+        """
+        with self.lock:
+            self.state["writing"] = {"term": term, "file_batch_index": file_batch_index}
+            self._save()
+
+    def interrupted_write(self):
+        """
+        Returns:
+            dict: {"term", "file_batch_index"} of a batch that was being written when the collector stopped, or None.
+        """
+        return self.state["writing"]
+
+    def keyword_done(self, term, file_batch_index, query=None):
+        """
+        Marks a keyword as written, and drops its pages from the journal.
+
+        Args:
+            term (str): The keyword.
+            file_batch_index (int): The batch it was written as.
+            query (str, optional): The query its slices and pages were recorded under, if not the keyword itself. Defaults to None.
+        """
+        query = query or term
+        with self.lock:
+            self.state["done"].append(term)
+            self.state["slices"].pop(query, None)
+            self.state["file_batch_index"] = file_batch_index
+            self.state["writing"] = None
+            self._save()
+
+            # rewrite the journal without the finished keyword
+            self.pages.pop(query, None)
+            self.journal.close()
+            temp_path = self.journal_path + '.tmp'
+            with open(temp_path, 'w') as file:
+                for other, slices in self.pages.items():
+                    for key, state in slices.items():
+                        if state["repos"]:
+                            file.write(json.dumps({"term": other, "slice": key, "page": state["next_page"] - 1,
+                                                   "repos": [list(repo_info) for repo_info in state["repos"]]}) + '\n')
+                        if state["done"]:
+                            file.write(json.dumps({"term": other, "slice": key, "done": True,
+                                                   "complete": state["complete"]}) + '\n')
+                file.flush()
+                os.fsync(file.fileno())
+            os.replace(temp_path, self.journal_path)
+            self.journal = open(self.journal_path, 'a')
+
+    def close(self):
+        with self.lock:
+            self.journal.close()
+
+
+class ScannerCheckpoint:
+    """
+    Progress of repo_scanner within the current CSV file. Thread safe
+    (results are recorded from the worker threads).
+    """
+
+    def __init__(self, file_path):
+        """
+        Args:
+            file_path (str): The path of the checkpoint.
+        """
+        self.file_path = file_path
+        self.lock = threading.Lock()
+        self.exists = os.path.exists(file_path)
+        self.state = read_json(file_path, {"report": None, "offset": 0, "hits": 0, "in_flight": {}, "finished": {}})
+
+    def _save(self):
+        # caller holds the lock
+        write_json_atomic(self.file_path, self.state)
+        self.exists = True
+
+    @property
+    def report(self):
+        return self.state["report"]
+
+    def resume(self, report_number):
+        """
+        Returns the progress within a CSV file, if the checkpoint is about it.
+
+        Returns:
+            tuple: (row offset, hits so far, {row: hit files} of finished rows, {row: (name, url)} of interrupted rows)
+        """
+        with self.lock:
+            if self.state["report"] != report_number:
+                self.state = {"report": report_number, "offset": 0, "hits": 0, "in_flight": {}, "finished": {}}
+                self._save()
+                return 0, 0, {}, {}
+            finished = {int(index): hit_files for index, hit_files in self.state["finished"].items()}
+            interrupted = {int(index): tuple(repo) for index, repo in self.state["in_flight"].items()
+                           if index not in self.state["finished"]}
+            return self.state["offset"], self.state["hits"], finished, interrupted
+
+    def pushed_since(self, cutoff):
+        """
+        Records the pushed_within_days cutoff the rows of the CSV file were selected with,
+        so that resuming selects the same rows and the offset still fits.
+
+        Args:
+            cutoff (str): The cutoff of this run (see repo_store.pushed_cutoff).
+
+        Returns:
+            str: The cutoff recorded for the CSV file, `cutoff` if there was none yet.
+        """
+        with self.lock:
+            if self.state.get("pushed_since") is None:
+                self.state["pushed_since"] = cutoff
+                self._save()
+            return self.state["pushed_since"]
+
+    def started(self, index, row):
+        with self.lock:
+            self.state["in_flight"][str(index)] = [row[0], row[2]]
+            self._save()
+
+    def finished(self, index, hit_files):
+        with self.lock:
+            self.state["finished"][str(index)] = hit_files
+            self._save()
+
+    def consumed(self, index, hits):
+        """
+        Records that a row and all rows before it are done.
+        """
+        with self.lock:
+            self.state["offset"] = index + 1
+            self.state["hits"] = hits
+            self.state["in_flight"].pop(str(index), None)
+            self.state["finished"].pop(str(index), None)
+            self._save()
+
+    def report_done(self, report_number):
+        with self.lock:
+            self.state = {"report": report_number + 1, "offset": 0, "hits": 0, "in_flight": {}, "finished": {}}
+            self._save()
+
+
+def release_interrupted(interrupted, blacklist, workspace):
+    """
+    Undoes the claim and removes the half-finished clone of repositories that
+    were being processed when the scanner stopped, so they are processed again.
+
+    Args:
+        interrupted (dict): {row: (name, url)} as returned by ScannerCheckpoint.resume().
+        blacklist (UrlIndex): The blacklist the repositories were claimed in.
+        workspace (Workspace): Where the clones are.
+    """
+    for name, url in interrupted.values():
+        blacklist.discard(url)
+        workspace.discard(workspace.path(name, url))
+
+
+def remove_checkpoint(file_path):
+    """
+    Deletes a collector checkpoint and its page journal (to start over).
+    """
+    for path in (file_path, file_path + '.pages', file_path + '.tmp'):
+        if os.path.exists(path):
+            os.remove(path)
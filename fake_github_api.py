@@ -0,0 +1,287 @@
+import argparse
+import hashlib
+import json
+import threading
+import time
+from datetime import date, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+# brief functionality explanation:
+# a local stand-in for the parts of the GitHub API the collector uses
+# (/user and /search/repositories), so the collector can be run and
+# measured without touching GitHub or spending rate limit.
+# search results are made up, but stable, and honour the stars/created/pushed qualifiers.
+# it sends the same rate limit headers as GitHub and answers with a 403
+# (optionally with Retry-After) once a token has used up its window.
+
+FIRST_CREATED = date(2010, 1, 1)
+
+# the repository field each search qualifier compares with
+QUALIFIERS = {"stars": "stargazers_count", "created": "created_at", "pushed": "pushed_at"}
+
+
+def matches(value, condition):
+    """
+    Checks a repository field against a qualifier value: `a..b`, `>=a`, `>a`, `<=a`, `<a` or `a`.
+    Dates compare with the date part of timestamps.
+
+    Returns:
+        bool: True if the value matches.
+    """
+    def compare(bound):
+        if isinstance(value, int):
+            return value, int(bound)
+        return value[:len(bound)], bound
+
+    if '..' in condition:
+        low, high = condition.split('..', 1)
+        return compare(low)[0] >= compare(low)[1] and compare(high)[0] <= compare(high)[1]
+    for operator, check in (('>=', lambda a, b: a >= b), ('<=', lambda a, b: a <= b),
+                            ('>', lambda a, b: a > b), ('<', lambda a, b: a < b)):
+        if condition.startswith(operator):
+            return check(*compare(condition[len(operator):]))
+    actual, bound = compare(condition)
+    return actual == bound
+
+
+class FakeGitHubServer(ThreadingHTTPServer):
+    """
+    HTTP server that imitates the GitHub search API.
+    """
+    daemon_threads = True
+
+    def __init__(self, address, results=120, limit=30, window=60, retry_after=None, latency=0.0,
+                 repo_url_template=None, corpus_size=None, touched=0):
+        """
+        Args:
+            address (tuple): (host, port) to listen on, port 0 picks a free one.
+            results (int, optional): Number of search results per query. Defaults to 120.
+            limit (int, optional): Requests per token and window. Defaults to 30 (GitHub's search limit).
+            window (int, optional): Length of a rate limit window in seconds. Defaults to 60.
+            retry_after (int, optional): Send this Retry-After on 403s, like GitHub's secondary limit. Defaults to None.
+            latency (float, optional): Seconds to wait before answering. Defaults to 0.0.
+            repo_url_template (str, optional): html_url of the results, e.g. "file:///tmp/corpus/repo{index}",
+                so they can actually be cloned. Defaults to None (made up github.com URLs).
+            corpus_size (int, optional): {index} runs from 0 to corpus_size - 1. Defaults to None (no wrap around).
+            touched (int, optional): The first this many repositories of every keyword were pushed to when
+                the server started, e.g. to try out incremental collection. Defaults to 0.
+        """
+        super().__init__(address, FakeGitHubHandler)
+        self.results = results
+        self.limit = limit
+        self.window = window
+        self.retry_after = retry_after
+        self.latency = latency
+        self.repo_url_template = repo_url_template
+        self.corpus_size = corpus_size
+        self.touched = touched
+        self.started = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())
+        # token -> [window reset timestamp, requests used]
+        self.windows = {}
+        self.lock = threading.Lock()
+        self.stats = {"requests": 0, "rate_limited": 0, "not_modified": 0}
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def count(self, name):
+        with self.lock:
+            self.stats[name] += 1
+
+    def take(self, token, count=True):
+        """
+        Counts a request against the token's rate limit window.
+
+        Args:
+            token (str): The Authorization header of the request.
+            count (bool, optional): False to only look at the window (for 304s). Defaults to True.
+
+        Returns:
+            tuple: (allowed, remaining, reset timestamp)
+        """
+        with self.lock:
+            self.stats["requests"] += 1
+            now = time.time()
+            reset, used = self.windows.get(token, (0, 0))
+            if now >= reset:
+                reset, used = int(now) + self.window, 0
+            allowed = used < self.limit or not count
+            if not count:
+                pass
+            elif allowed:
+                used += 1
+            else:
+                self.stats["rate_limited"] += 1
+            self.windows[token] = (reset, used)
+            return allowed, self.limit - used, reset
+
+    def fake_repo(self, keyword, number):
+        """
+        Builds a deterministic repository for a keyword.
+        """
+        digest = hashlib.sha1(keyword.encode('utf-8')).hexdigest()[:8]
+        name = f"repo-{digest}-{number}"
+        html_url = f"https://github.com/fake-{digest}/{name}"
+        if self.repo_url_template is not None:
+            index = number % self.corpus_size if self.corpus_size else number
+            html_url = self.repo_url_template.format(index=index)
+            name = html_url.rstrip('/').rsplit('/', 1)[-1]
+        created = FIRST_CREATED + timedelta(days=(number * 7919) % 5000)
+        pushed = f"{(created + timedelta(days=number % 1000)).isoformat()}T00:00:00Z"
+        if number < self.touched:
+            pushed = self.started
+        return {
+            "name": name,
+            "full_name": f"fake-{digest}/{name}",
+            "html_url": html_url,
+            "stargazers_count": 10 + number % 5,
+            "size": 100 + number,
+            "created_at": f"{created.isoformat()}T00:00:00Z",
+            "pushed_at": pushed,
+            "default_branch": "main",
+            "fork": number % 4 == 0,
+            "archived": number % 10 == 0,
+            "topics": ["flask"] if number % 3 == 0 else [],
+        }
+
+    def search(self, query):
+        """
+        Finds the fake repositories matching a query. The words of the query are
+        the keyword, `stars:`, `created:` and `pushed:` qualifiers are applied.
+
+        Returns:
+            list: The matching repositories.
+        """
+        words = query.split()
+        keyword = " ".join(word for word in words if ':' not in word)
+        repos = [self.fake_repo(keyword, number) for number in range(self.results)]
+        for word in words:
+            name, _, condition = word.partition(':')
+            if name in QUALIFIERS:
+                repos = [repo for repo in repos if matches(repo[QUALIFIERS[name]], condition)]
+        return repos
+
+
+class FakeGitHubHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        server = self.server
+        if server.latency:
+            time.sleep(server.latency)
+
+        url = urlparse(self.path)
+        token = self.headers.get('Authorization', '')
+        if not token:
+            return self.send_json(401, {"message": "Requires authentication"})
+
+        status, body = self.answer(url, token)
+        etag = '"' + hashlib.sha1(json.dumps(body).encode('utf-8')).hexdigest() + '"'
+
+        # like on GitHub, a 304 does not count against the rate limit
+        not_modified = status == 200 and self.headers.get('If-None-Match') == etag
+        allowed, remaining, reset = server.take(token, count=not not_modified)
+        headers = {
+            "X-RateLimit-Limit": str(server.limit),
+            "X-RateLimit-Remaining": str(max(0, remaining)),
+            "X-RateLimit-Reset": str(reset),
+            "X-RateLimit-Used": str(server.limit - max(0, remaining)),
+            "X-RateLimit-Resource": "search",
+        }
+        if not allowed:
+            if server.retry_after is not None:
+                headers["Retry-After"] = str(server.retry_after)
+            return self.send_json(403, {"message": "API rate limit exceeded"}, headers)
+        if not_modified:
+            server.count("not_modified")
+            self.send_response(304)
+            headers["ETag"] = etag
+            for key, value in headers.items():
+                self.send_header(key, value)
+            self.end_headers()
+            return
+        if status == 200:
+            headers["ETag"] = etag
+        return self.send_json(status, body, headers)
+
+    def answer(self, url, token):
+        """
+        Builds the (status, body) for a request path.
+        """
+        server = self.server
+        if url.path == '/user':
+            # every token is its own account, with its own rate limit
+            return 200, {"login": "fake-user-" + hashlib.sha1(token.encode('utf-8')).hexdigest()[:8]}
+
+        if url.path == '/search/repositories':
+            params = parse_qs(url.query)
+            query = params.get('q', [''])[0]
+            per_page = min(100, int(params.get('per_page', ['30'])[0]))
+            page = int(params.get('page', ['1'])[0])
+            start = (page - 1) * per_page
+            if start >= 1000:
+                return 422, {"message": "Only the first 1000 search results are available"}
+            repos = server.search(query)
+            items = repos[start:min(start + per_page, 1000)]
+            return 200, {"total_count": len(repos), "incomplete_results": False, "items": items}
+
+        return 404, {"message": "Not Found"}
+
+    def send_json(self, status, body, headers=None):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        # keep the output of the tools under test readable
+        pass
+
+
+def start_server(host='127.0.0.1', port=0, **config):
+    """
+    Starts a fake GitHub API server in a background thread.
+
+    Args:
+        host (str, optional): The interface to listen on. Defaults to '127.0.0.1'.
+        port (int, optional): The port to listen on, 0 picks a free one. Defaults to 0.
+        **config: Passed on to FakeGitHubServer.
+
+    Returns:
+        FakeGitHubServer: The running server, see its `url` attribute.
+    """
+    server = FakeGitHubServer((host, port), **config)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Fake GitHub API for testing repo_collector')
+    parser.add_argument('--port', type=int, default=8000, help='Port to listen on')
+    parser.add_argument('--results', type=int, default=120, help='Search results per query')
+    parser.add_argument('--limit', type=int, default=30, help='Requests per token and window')
+    parser.add_argument('--window', type=int, default=60, help='Rate limit window in seconds')
+    parser.add_argument('--retry_after', type=int, default=None, help='Send Retry-After on 403s (optional)')
+    parser.add_argument('--latency', type=float, default=0.0, help='Seconds to wait before answering')
+    parser.add_argument('--repo_url_template', type=str, default=None, help='html_url of the results, e.g. file:///tmp/corpus/repo{index} (optional)')
+    parser.add_argument('--corpus_size', type=int, default=None, help='Number of repositories {index} wraps around at (optional)')
+    parser.add_argument('--touched', type=int, default=0, help='The first N repositories of every keyword were pushed to just now (optional)')
+
+    parser.epilog = """
+    Example usage:
+    python fake_github_api.py --port 8000
+    python repo_collector.py --token x --out ./urlstash --api_url http://127.0.0.1:8000
+    """
+    args = parser.parse_args()
+    server = FakeGitHubServer(('127.0.0.1', args.port), results=args.results, limit=args.limit,
+                              window=args.window, retry_after=args.retry_after, latency=args.latency,
+                              repo_url_template=args.repo_url_template, corpus_size=args.corpus_size,
+                              touched=args.touched)
+    print(f"Fake GitHub API listening on {server.url}")
+    server.serve_forever()
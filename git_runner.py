@@ -0,0 +1,299 @@
+import logging
+import os
+import random
+import re
+import signal
+import sqlite3
+import subprocess
+import threading
+import time
+
+import metrics
+
+# brief functionality explanation:
+# runs git for the scanner so that no repository can freeze it. git never
+# prompts (a deleted or private repository asks for credentials otherwise),
+# transfers that crawl below a minimum speed are dropped by git itself, and a
+# clone that runs past its wall-clock timeout is killed together with all of
+# its helper processes (git-remote-https, index-pack, ...), which live in a
+# process group of their own.
+# failures are sorted into kinds: not found, auth, too big, network, timeout
+# and local (e.g. a full disk). only network errors are retried (with
+# exponential backoff); not found, auth and too big are permanent and
+# recorded in the index database, so the repository is never tried again.
+
+logger = logging.getLogger(__name__)
+
+# the kinds of failures
+NOT_FOUND = "not_found"
+AUTH = "auth"
+TOO_BIG = "too_big"
+NETWORK = "network"
+TIMEOUT = "timeout"
+# a problem of the machine running the scan (e.g. a full disk), not of the repository
+LOCAL = "local"
+OTHER = "other"
+KINDS = (NOT_FOUND, AUTH, TOO_BIG, NETWORK, TIMEOUT, LOCAL, OTHER)
+# trying again will not help
+PERMANENT = frozenset({NOT_FOUND, AUTH, TOO_BIG})
+# trying again right away may help; a timeout would most likely just time out again
+RETRYABLE = frozenset({NETWORK})
+
+# seconds a clone may take at most
+CLONE_TIMEOUT = 600
+# git gives up if the transfer is slower than LOW_SPEED_LIMIT bytes/s for LOW_SPEED_TIME seconds
+LOW_SPEED_LIMIT = 1000
+LOW_SPEED_TIME = 60
+# retries of network errors, waiting BACKOFF * 2^attempt seconds (with jitter) before each
+RETRIES = 2
+BACKOFF = 5.0
+
+# git's messages, checked in this order (the first match wins). the permanent kinds only
+# match what git says about the repository itself, not e.g. "git-lfs: command not found"
+PATTERNS = [
+    (LOCAL, r"no space left on device|disk quota exceeded|file size limit exceeded|too many open files"
+            r"|cannot allocate memory"),
+    (TIMEOUT, r"operation too slow|operation timed out after"),
+    (NOT_FOUND, r"repository '[^']*' not found|repository not found|repository '[^']*' does not exist"
+                r"|does not appear to be a git repository"
+                r"|returned error: 4(04|10)|dmca|access to this repository has been disabled"),
+    (AUTH, r"authentication failed|could not read (username|password)|terminal prompts disabled"
+           r"|permission denied|returned error: 40[13]|invalid credentials"),
+    (TOO_BIG, r"exceeds maximum|returned error: 413"),
+    (NETWORK, r"could not resolve|failed to connect|connection (refused|reset|timed out)|early eof"
+              r"|rpc failed|remote end hung up|unable to access|gnutls|ssl|tls|returned error: 5\d\d"
+              r"|index-pack failed|unexpected disconnect|network is unreachable"),
+]
+
+
+class GitFailed(Exception):
+    """
+    A git command (or a download standing in for it) failed.
+
+    Attributes:
+        kind (str): One of KINDS.
+        message (str): What went wrong, e.g. git's error output.
+    """
+
+    def __init__(self, kind, message):
+        super().__init__(f"{kind}: {message}")
+        self.kind = kind
+        self.message = message
+
+    @property
+    def permanent(self):
+        return self.kind in PERMANENT
+
+
+def classify(stderr):
+    """
+    Returns:
+        str: The kind of failure git's error output describes (OTHER if it is not recognized).
+    """
+    text = stderr.lower()
+    for kind, pattern in PATTERNS:
+        if re.search(pattern, text):
+            return kind
+    return OTHER
+
+
+def non_interactive_env():
+    """
+    Returns:
+        dict: The environment for git: no prompts for credentials, no askpass helpers, ssh in batch mode.
+    """
+    env = {name: value for name, value in os.environ.items() if name not in ('GIT_ASKPASS', 'SSH_ASKPASS')}
+    env.update({"GIT_TERMINAL_PROMPT": "0", "GCM_INTERACTIVE": "never",
+                "GIT_SSH_COMMAND": "ssh -o BatchMode=yes -o ConnectTimeout=30"})
+    return env
+
+
+class CloneLimits:
+    """
+    How long git may take, and how often a failed clone is retried.
+    """
+
+    def __init__(self, timeout=CLONE_TIMEOUT, low_speed_limit=LOW_SPEED_LIMIT, low_speed_time=LOW_SPEED_TIME,
+                 retries=RETRIES, backoff=BACKOFF):
+        """
+        Args:
+            timeout (float, optional): Kill a clone after this many seconds, None for no limit. Defaults to CLONE_TIMEOUT.
+            low_speed_limit (int, optional): Drop transfers slower than this many bytes per second... Defaults to LOW_SPEED_LIMIT.
+            low_speed_time (int, optional): ...for this many seconds, 0 to never drop them. Defaults to LOW_SPEED_TIME.
+            retries (int, optional): Retries of network errors. Defaults to RETRIES.
+            backoff (float, optional): Seconds before the first retry, doubled for every further one. Defaults to BACKOFF.
+        """
+        self.timeout = timeout
+        self.low_speed_limit = low_speed_limit
+        self.low_speed_time = low_speed_time
+        self.retries = retries
+        self.backoff = backoff
+
+    def git_config(self):
+        """
+        Returns:
+            list: The `-c` options that make git drop slow transfers.
+        """
+        if not self.low_speed_time:
+            return []
+        return ['-c', f'http.lowSpeedLimit={self.low_speed_limit}', '-c', f'http.lowSpeedTime={self.low_speed_time}']
+
+
+def run_git(args, timeout=None, limits=None):
+    """
+    Runs git non-interactively, in a process group of its own that is killed
+    as a whole when the timeout expires.
+
+    Args:
+        args (list): The arguments after `git`, e.g. ['clone', ...].
+        timeout (float, optional): Seconds until git is killed. Defaults to None (no limit).
+        limits (CloneLimits, optional): Adds the low-speed limit for network commands. Defaults to None.
+
+    Returns:
+        str: What git wrote to stdout.
+
+    Raises:
+        GitFailed: git failed or timed out.
+    """
+    command = ['git'] + (limits.git_config() if limits is not None else []) + list(args)
+    process = subprocess.Popen(command, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                               text=True, env=non_interactive_env(), start_new_session=True)
+    try:
+        stdout, stderr = process.communicate(timeout=timeout)
+    except subprocess.TimeoutExpired:
+        kill_group(process)
+        metrics.inc("git_killed")
+        raise GitFailed(TIMEOUT, f"git {args[0]} killed after {timeout}s")
+    except BaseException:
+        # e.g. KeyboardInterrupt, do not leave git behind
+        kill_group(process)
+        raise
+    if process.returncode:
+        stderr = stderr.strip()
+        raise GitFailed(classify(stderr), stderr or f"git {args[0]} exited with {process.returncode}")
+    return stdout
+
+
+def time_left(deadline):
+    """
+    Returns:
+        float: Seconds until a time.monotonic() deadline (at least a little), or None without a deadline.
+    """
+    if deadline is None:
+        return None
+    return max(0.1, deadline - time.monotonic())
+
+
+def kill_group(process):
+    """
+    Kills a process started by run_git() and everything it started, and reaps it.
+    """
+    try:
+        os.killpg(process.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+    process.communicate()
+
+
+def retry(attempt, limits=None, description="git"):
+    """
+    Calls `attempt` until it succeeds, retrying retryable failures with exponential backoff.
+
+    Args:
+        attempt (callable): Called with the number of the attempt (0 for the first one).
+        limits (CloneLimits, optional): The number of retries and the backoff. Defaults to None (CloneLimits()).
+        description (str, optional): What is attempted, for the log. Defaults to "git".
+
+    Returns:
+        The result of `attempt`.
+
+    Raises:
+        GitFailed: The last failure, or the first one that is not retryable.
+    """
+    limits = limits or CloneLimits()
+    for number in range(limits.retries + 1):
+        try:
+            return attempt(number)
+        except GitFailed as e:
+            if e.kind not in RETRYABLE or number == limits.retries:
+                raise
+            delay = limits.backoff * 2 ** number * random.uniform(0.5, 1.5)
+            logger.info(f"{description} failed, retrying in {delay:.1f}s",
+                        extra={"kind": e.kind, "error": e.message, "attempt": number + 1})
+            metrics.inc("git_retries")
+            time.sleep(delay)
+
+
+class FailureLog:
+    """
+    Repositories that failed permanently (not found, auth, too big), kept in the
+    index database so they are never tried again. Thread safe.
+    """
+
+    def __init__(self, db_path, retry_kinds=()):
+        """
+        Args:
+            db_path (str): The database the failures are kept in (the scanner's blacklist).
+            retry_kinds (iterable, optional): Kinds whose records are ignored, e.g. TOO_BIG after raising --max_size_mb. Defaults to ().
+        """
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(db_path, timeout=60, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS failures ("
+                        "url TEXT PRIMARY KEY, kind TEXT NOT NULL, message TEXT, failed REAL)")
+        self.db.commit()
+        retry_kinds = set(retry_kinds)
+        self.failed = {url: kind for url, kind in self.db.execute("SELECT url, kind FROM failures")
+                       if kind not in retry_kinds}
+
+    def __contains__(self, url):
+        with self.lock:
+            return url.strip() in self.failed
+
+    def __len__(self):
+        with self.lock:
+            return len(self.failed)
+
+    def record(self, url, failure):
+        """
+        Records a failure if it is permanent.
+
+        Args:
+            url (str): The URL of the repository.
+            failure (GitFailed): What went wrong.
+
+        Returns:
+            bool: True if it was recorded.
+        """
+        if not failure.permanent:
+            return False
+        url = url.strip()
+        with self.lock:
+            self.failed[url] = failure.kind
+            with self.db:
+                self.db.execute("INSERT OR REPLACE INTO failures VALUES (?, ?, ?, ?)",
+                                (url, failure.kind, failure.message[:500], time.time()))
+        return True
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+
+def add_arguments(parser):
+    """
+    Adds the timeouts and retries of clones to a command line parser.
+    """
+    parser.add_argument('--clone_timeout', type=float, default=CLONE_TIMEOUT, help='Kill a clone (or download) after this many seconds (optional, 0 = no limit)')
+    parser.add_argument('--low_speed_time', type=int, default=LOW_SPEED_TIME, help=f'Drop transfers slower than {LOW_SPEED_LIMIT} bytes/s for this many seconds (optional, 0 = never)')
+    parser.add_argument('--clone_retries', type=int, default=RETRIES, help='Retries of clones that failed with a network error (optional)')
+    parser.add_argument('--retry_failed', type=str, nargs='+', default=(), choices=sorted(PERMANENT), help='Try repositories again that failed permanently for these reasons, e.g. too_big after raising --max_size_mb (optional)')
+
+
+def limits_from_args(args):
+    """
+    Returns:
+        CloneLimits: The limits given on the command line (see add_arguments).
+    """
+    return CloneLimits(timeout=args.clone_timeout or None, low_speed_time=args.low_speed_time,
+                       retries=max(0, args.clone_retries))
@@ -0,0 +1,186 @@
+import hashlib
+import json
+import logging
+import sqlite3
+import threading
+import time
+from urllib.parse import urlencode
+
+import requests
+from requests.structures import CaseInsensitiveDict
+
+from log_utils import RESULT
+
+logger = logging.getLogger(__name__)
+
+# these describe the state of the rate limit when the response was sent,
+# they must not be replayed from the cache
+RATE_LIMIT_HEADERS = ('X-RateLimit-Limit', 'X-RateLimit-Remaining', 'X-RateLimit-Reset',
+                      'X-RateLimit-Used', 'X-RateLimit-Resource', 'Retry-After')
+
+
+class CachedSession(requests.Session):
+    """
+    requests.Session with a persistent response cache for GET requests.
+
+    Responses are stored in SQLite, keyed by URL and query parameters.
+    Within `ttl` seconds a cached response is returned without any request.
+    After that it is revalidated with `If-None-Match`, and a 304 (which does
+    not count against GitHub's rate limit) refreshes the cached copy. Once
+    the cache grows beyond `max_bytes`, the least recently used responses
+    are evicted.
+    """
+
+    def __init__(self, db_path, ttl=86400, max_bytes=500 * 1024 * 1024, cacheable_paths=('/search/',)):
+        """
+        Args:
+            db_path (str): The path to the SQLite database file.
+            ttl (int, optional): Seconds a response is used without revalidating it. Defaults to 86400.
+            max_bytes (int, optional): Size of the cache before old responses are evicted. Defaults to 500 MB.
+            cacheable_paths (tuple, optional): Only URLs containing one of these are cached. Defaults to ('/search/',).
+        """
+        super().__init__()
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.cacheable_paths = cacheable_paths
+        self.stats = {"hits": 0, "revalidated": 0, "misses": 0}
+
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(db_path, timeout=60, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS responses ("
+                         "key TEXT PRIMARY KEY, etag TEXT, headers TEXT, body BLOB, "
+                         "stored_at REAL, accessed_at REAL, size INTEGER)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed_at)")
+        self._size = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+
+    def request(self, method, url, params=None, headers=None, **kwargs):
+        if method.upper() != 'GET' or not any(path in url for path in self.cacheable_paths):
+            return super().request(method, url, params=params, headers=headers, **kwargs)
+
+        key = cache_key(url, params)
+        entry = self._load(key)
+        if entry is not None and time.time() - entry["stored_at"] < self.ttl:
+            self._count("hits")
+            return self._response(url, entry)
+
+        headers = dict(headers or {})
+        if entry is not None and entry["etag"]:
+            headers['If-None-Match'] = entry["etag"]
+        response = super().request(method, url, params=params, headers=headers, **kwargs)
+
+        if response.status_code == 304 and entry is not None:
+            self._count("revalidated")
+            self._touch(key)
+            # fresh rate limit headers from the 304, cached body
+            return self._response(url, entry, response.headers)
+
+        self._count("misses")
+        if response.status_code == 200:
+            self._store(key, response)
+        return response
+
+    def fresh(self, url, params=None):
+        """
+        Returns the cached response if it can be used without any request,
+        so callers can skip waiting for the rate limiter.
+
+        Args:
+            url (str): The URL.
+            params (dict, optional): The query parameters. Defaults to None.
+
+        Returns:
+            requests.Response: The cached response, or None.
+        """
+        if not any(path in url for path in self.cacheable_paths):
+            return None
+        # one lookup: an entry that expires right now is still returned, never re-requested without the caller's headers
+        entry = self._load(cache_key(url, params))
+        if entry is None or time.time() - entry["stored_at"] >= self.ttl:
+            return None
+        self._count("hits")
+        return self._response(url, entry)
+
+    def report(self):
+        """
+        Logs the hit/miss counts of this run.
+        """
+        total = sum(self.stats.values())
+        served = self.stats["hits"] + self.stats["revalidated"]
+        logger.log(RESULT, f"HTTP cache: {self.stats['hits']} hits, {self.stats['revalidated']} revalidated (304), "
+                   f"{self.stats['misses']} misses, {served}/{total} served from cache, "
+                   f"{self._size / 1024 / 1024:.1f} MB stored")
+
+    def close(self):
+        super().close()
+        with self._lock:
+            self._db.close()
+
+    def _count(self, name):
+        with self._lock:
+            self.stats[name] += 1
+
+    def _load(self, key):
+        with self._lock:
+            row = self._db.execute("SELECT etag, headers, body, stored_at FROM responses WHERE key = ?",
+                                   (key,)).fetchone()
+            if row is None:
+                return None
+            self._db.execute("UPDATE responses SET accessed_at = ? WHERE key = ?", (time.time(), key))
+            self._db.commit()
+        return {"etag": row[0], "headers": json.loads(row[1]), "body": row[2], "stored_at": row[3]}
+
+    def _touch(self, key):
+        with self._lock:
+            now = time.time()
+            self._db.execute("UPDATE responses SET stored_at = ?, accessed_at = ? WHERE key = ?", (now, now, key))
+            self._db.commit()
+
+    def _store(self, key, response):
+        headers = {name: value for name, value in response.headers.items() if name not in RATE_LIMIT_HEADERS}
+        body = response.content
+        now = time.time()
+        with self._lock:
+            old = self._db.execute("SELECT size FROM responses WHERE key = ?", (key,)).fetchone()
+            self._db.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?)",
+                             (key, response.headers.get('ETag'), json.dumps(headers), body, now, now, len(body)))
+            self._size += len(body) - (old[0] if old else 0)
+            if self._size > self.max_bytes:
+                self._evict()
+            self._db.commit()
+
+    def _evict(self):
+        # caller holds self._lock, drop least recently used entries until 90% of the budget is left
+        target = self.max_bytes * 0.9
+        for key, size in self._db.execute("SELECT key, size FROM responses ORDER BY accessed_at").fetchall():
+            if self._size <= target:
+                break
+            self._db.execute("DELETE FROM responses WHERE key = ?", (key,))
+            self._size -= size
+
+    def _response(self, url, entry, headers=None):
+        response = requests.Response()
+        response.status_code = 200
+        response.url = url
+        response._content = entry["body"]
+        response.headers = CaseInsensitiveDict(entry["headers"])
+        for name in RATE_LIMIT_HEADERS:
+            if headers is not None and name in headers:
+                response.headers[name] = headers[name]
+        response.from_cache = True
+        return response
+
+
+def cache_key(url, params=None):
+    """
+    Builds the cache key of a request from its URL and query parameters.
+
+    Args:
+        url (str): The URL.
+        params (dict, optional): The query parameters. Defaults to None.
+
+    Returns:
+        str: The key.
+    """
+    query = urlencode(sorted((str(k), str(v)) for k, v in (params or {}).items()))
+    return hashlib.sha256(f"{url}?{query}".encode('utf-8')).hexdigest()
@@ -0,0 +1,155 @@
+import logging
+import math
+import sqlite3
+import threading
+import time
+
+# brief functionality explanation:
+# decides which keyword the collector searches next. the keywords overlap a
+# lot ("web", "webapp", "flask", "app", ...), so after a while many of them
+# mostly find repositories that were already collected.
+# every keyword is probed once with the first page of its results: that gives
+# its total_count and a sample of its repositories. the share of the sample
+# that is not collected yet estimates how many new repositories a keyword
+# would bring per API call; it is re-evaluated against the growing set of
+# collected URLs after every keyword, without further requests.
+# the keywords with the highest estimate go first, those below --min_yield
+# last (or not at all). the real yield of every run is kept in the index
+# database, for reporting and for keywords whose probe failed.
+
+logger = logging.getLogger(__name__)
+
+# results per page and per query of the search API (see repo_collector.py)
+PER_PAGE = 50
+RESULT_CAP = 1000
+
+
+class KeywordScheduler:
+    """
+    Orders keywords by their expected yield of new repositories per API call. Thread safe.
+    """
+
+    def __init__(self, db_path, min_yield=0.0):
+        """
+        Args:
+            db_path (str): The database the observed yields are kept in (the collector's URL index).
+            min_yield (float, optional): Keywords expected to find fewer new repositories per API call are low-yield. Defaults to 0.0.
+        """
+        self.min_yield = min_yield
+        self.lock = threading.Lock()
+        # term -> (total_count, sample of URLs), from probe()
+        self.probes = {}
+        self.db = sqlite3.connect(db_path, timeout=60, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS keyword_yield ("
+                        "term TEXT PRIMARY KEY, runs INTEGER, calls INTEGER, fetched INTEGER, new INTEGER, "
+                        "total_count INTEGER, updated REAL)")
+        self.db.commit()
+
+    def probe(self, term, total_count, sample):
+        """
+        Records the result of a probe.
+
+        Args:
+            term (str): The keyword.
+            total_count (int): The number of results of the keyword, or None if the probe failed.
+            sample (list): URLs of the first page of results.
+        """
+        with self.lock:
+            if total_count is not None:
+                self.probes[term] = (total_count, [url.strip() for url in sample])
+
+    def history(self, term):
+        """
+        Returns:
+            float: New repositories per API call the last time the keyword was searched, or None.
+        """
+        with self.lock:
+            row = self.db.execute("SELECT calls, new FROM keyword_yield WHERE term = ?", (term,)).fetchone()
+        if row is None or not row[0]:
+            return None
+        return row[1] / row[0]
+
+    def estimate(self, term, seen):
+        """
+        Estimates the new repositories a keyword finds per API call.
+
+        Args:
+            term (str): The keyword.
+            seen (UrlIndex): The URLs that were collected already.
+
+        Returns:
+            float: The estimate, or None if nothing is known about the keyword.
+        """
+        with self.lock:
+            probe = self.probes.get(term)
+        if probe is None:
+            return self.history(term)
+        total_count, sample = probe
+        if not total_count or not sample:
+            return 0.0
+        novelty = sum(url not in seen for url in sample) / len(sample)
+        # pages to fetch, plus the count requests to split queries over the result cap
+        calls = math.ceil(total_count / PER_PAGE) + 2 * math.ceil(total_count / RESULT_CAP) - 1
+        return total_count * novelty / max(1, calls)
+
+    def order(self, terms, seen):
+        """
+        Returns:
+            list: The keywords by expected yield, highest first; unknown ones keep their place after the known ones.
+        """
+        estimates = {term: self.estimate(term, seen) for term in terms}
+        known = sorted((term for term in terms if estimates[term] is not None), key=lambda term: -estimates[term])
+        return known + [term for term in terms if estimates[term] is None]
+
+    def next(self, terms, seen, reorder=True, skip_low_yield=False):
+        """
+        Picks the keyword to search next.
+
+        Args:
+            terms (list): The keywords that are left, in list order.
+            seen (UrlIndex): The URLs that were collected already.
+            reorder (bool, optional): Pick the highest expected yield instead of the first keyword. Defaults to True.
+            skip_low_yield (bool, optional): Never pick a keyword below min_yield. Defaults to False.
+
+        Returns:
+            str: The keyword, or None if there is none (worth searching).
+        """
+        for term in self.order(terms, seen) if reorder else terms:
+            if skip_low_yield and self.is_low_yield(term, seen):
+                continue
+            return term
+        return None
+
+    def is_low_yield(self, term, seen):
+        """
+        Returns:
+            bool: True if the keyword is expected to find fewer than min_yield new repositories per API call.
+        """
+        estimate = self.estimate(term, seen)
+        return estimate is not None and estimate < self.min_yield
+
+    def record(self, term, calls, fetched, new):
+        """
+        Keeps the real yield of a searched keyword.
+
+        Args:
+            term (str): The keyword.
+            calls (int): The API requests it took.
+            fetched (int): The repositories it found.
+            new (int): The repositories that were not collected before.
+        """
+        with self.lock:
+            total_count = self.probes.get(term, (None,))[0]
+            with self.db:
+                self.db.execute("INSERT INTO keyword_yield VALUES (?, 1, ?, ?, ?, ?, ?) ON CONFLICT (term) DO UPDATE SET "
+                                "runs = runs + 1, calls = excluded.calls, fetched = excluded.fetched, "
+                                "new = excluded.new, total_count = COALESCE(excluded.total_count, total_count), "
+                                "updated = excluded.updated",
+                                (term, calls, fetched, new, total_count, time.time()))
+        logger.info(f"{term}: {new} new of {fetched} repositories in {calls} API calls",
+                    extra={"term": term, "yield": round(new / calls, 2) if calls else None})
+
+    def close(self):
+        with self.lock:
+            self.db.close()
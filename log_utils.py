@@ -0,0 +1,256 @@
+import atexit
+import json
+import logging
+import queue
+import sys
+import threading
+import time
+from logging.handlers import QueueHandler, QueueListener
+
+# brief functionality explanation:
+# logging setup shared by the scripts. modules log with
+#
+#   logger = logging.getLogger(__name__)
+#   logger.info("cloned repository", extra={"repo": name, "mb": 1.5})
+#
+# the extra fields are kept as fields in JSON lines (--log_format json, --log_file)
+# and appended as key=value in the text format.
+# records go through a queue and are written by a background thread, so the
+# scanning and collecting threads never wait for the terminal or the disk.
+# hits and end-of-run summaries are logged at the RESULT level, between INFO
+# and WARNING, so --quiet can show only those.
+# Progress is a single status line (rate, ETA) that is redrawn in place.
+
+RESULT = 25
+logging.addLevelName(RESULT, "RESULT")
+
+# attributes every LogRecord has, everything else was passed with extra=
+STANDARD_ATTRIBUTES = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime'}
+
+# the progress line currently on the terminal, see ConsoleHandler
+_progress = None
+_console_lock = threading.Lock()
+_progress_enabled = False
+
+
+def extra_fields(record):
+    return {key: value for key, value in vars(record).items() if key not in STANDARD_ATTRIBUTES}
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    One JSON object per line: time, level, logger, msg and the extra fields.
+    """
+
+    def format(self, record):
+        entry = {"time": round(record.created, 3), "level": record.levelname,
+                 "logger": record.name, "msg": record.getMessage()}
+        entry.update(extra_fields(record))
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    """
+    `12:00:00 INFO    message  key=value ...`
+    """
+
+    def format(self, record):
+        line = f"{time.strftime('%H:%M:%S', time.localtime(record.created))} {record.levelname:<7} {record.getMessage()}"
+        fields = extra_fields(record)
+        if fields:
+            line += "  " + " ".join(f"{key}={format_value(value)}" for key, value in fields.items())
+        if record.exc_info:
+            line += "\n" + self.formatException(record.exc_info)
+        return line
+
+
+def format_value(value):
+    if isinstance(value, (list, tuple, set)):
+        return ",".join(str(item) for item in value)
+    if isinstance(value, float):
+        return f"{value:.3g}"
+    return str(value)
+
+
+class ConsoleHandler(logging.StreamHandler):
+    """
+    StreamHandler that moves the progress line out of the way of log messages.
+    """
+
+    def emit(self, record):
+        with _console_lock:
+            progress = _progress
+            if progress is not None:
+                progress.clear()
+            super().emit(record)
+            if progress is not None:
+                progress.draw(force=True)
+
+
+def setup_logging(level="INFO", log_format="text", log_file=None, quiet=False, progress=False):
+    """
+    Configures the root logger: a console handler, optionally a JSON-lines
+    file, both fed through a queue by a background thread.
+
+    Args:
+        level (str, optional): The lowest level that is logged. Defaults to "INFO".
+        log_format (str, optional): "text" or "json" for the console. Defaults to "text".
+        log_file (str, optional): Also write JSON lines (at `level`) to this file. Defaults to None.
+        quiet (bool, optional): Only hits, summaries, warnings and errors on the console. Defaults to False.
+        progress (bool, optional): Show a progress line (on stderr) instead of the per-repo/per-page messages. Defaults to False.
+    """
+    global _progress_enabled
+
+    level = logging.getLevelName(level.upper()) if isinstance(level, str) else level
+    console = ConsoleHandler(sys.stdout)
+    console.setFormatter(JsonFormatter() if log_format == "json" else TextFormatter())
+    # with a progress line, the details would just scroll it away
+    console.setLevel(RESULT if quiet or progress else level)
+    handlers = [console]
+    if log_file is not None:
+        file_handler = logging.FileHandler(log_file)
+        file_handler.setFormatter(JsonFormatter())
+        file_handler.setLevel(level)
+        handlers.append(file_handler)
+
+    records = queue.SimpleQueue()
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(QueueHandler(records))
+    # records below every handler's level are dropped before they are even built
+    root.setLevel(min(handler.level for handler in handlers))
+
+    listener = QueueListener(records, *handlers, respect_handler_level=True)
+    listener.start()
+    # write out what is still queued when the program ends
+    atexit.register(listener.stop)
+    _progress_enabled = progress
+
+
+def add_arguments(parser):
+    """
+    Adds the logging options to a command line parser.
+    """
+    parser.add_argument('--log_level', type=str, default='INFO', choices=['DEBUG', 'INFO', 'RESULT', 'WARNING', 'ERROR'], help='Lowest level that is logged (optional)')
+    parser.add_argument('--log_format', type=str, default='text', choices=['text', 'json'], help='Console output as text or JSON lines (optional)')
+    parser.add_argument('--log_file', type=str, default=None, help='Also write JSON lines to this file (optional)')
+    parser.add_argument('--quiet', action='store_true', help='Only show hits, summaries and problems (optional)')
+    parser.add_argument('--progress', action='store_true', help='Show a single progress line with rates and ETA (optional)')
+
+
+def setup_from_args(args):
+    setup_logging(args.log_level, args.log_format, args.log_file, args.quiet, args.progress)
+
+
+class Progress:
+    """
+    A single status line, e.g. `scan: 120/500 repos (24%) 3.1/s hits=5 ETA 2m03s`.
+
+    It is redrawn in place on a terminal (at most every `interval` seconds)
+    and written as a plain line every 30 seconds otherwise. Nothing is shown
+    unless logging was set up with progress=True.
+    """
+
+    def __init__(self, label, total=None, unit="repos", interval=0.5, stream=None):
+        """
+        Args:
+            label (str): What is being done.
+            total (int, optional): The number of items, for the percentage and ETA. Defaults to None.
+            unit (str, optional): What is counted. Defaults to "repos".
+            interval (float, optional): Seconds between two redraws. Defaults to 0.5.
+            stream (file, optional): Where to draw. Defaults to sys.stderr.
+        """
+        self.label = label
+        self.total = total
+        self.unit = unit
+        self.stream = stream or sys.stderr
+        self.tty = self.stream.isatty()
+        self.interval = interval if self.tty else 30.0
+        self.done = 0
+        self.counts = {}
+        self.started = time.time()
+        self.drawn = 0.0
+        self.width = 0
+        self.lock = threading.Lock()
+
+    def __enter__(self):
+        global _progress
+        if _progress_enabled and self.tty:
+            with _console_lock:
+                _progress = self
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def update(self, done=1, **counts):
+        """
+        Counts finished items (and e.g. hits=1) and redraws the line if it is time to.
+        """
+        with self.lock:
+            self.done += done
+            for name, value in counts.items():
+                self.counts[name] = self.counts.get(name, 0) + value
+        if _progress_enabled and time.time() - self.drawn >= self.interval:
+            with _console_lock:
+                self.draw()
+
+    def line(self):
+        elapsed = max(time.time() - self.started, 1e-6)
+        rate = self.done / elapsed
+        text = f"{self.label}: {self.done}"
+        if self.total:
+            text += f"/{self.total} {self.unit} ({self.done / self.total:.0%})"
+        else:
+            text += f" {self.unit}"
+        # items counted as failed=1 (e.g. deleted repositories) are left out of the throughput
+        text += f" {(self.done - self.counts.get('failed', 0)) / elapsed:.2f}/s"
+        text += "".join(f" {name}={value}" for name, value in self.counts.items())
+        if self.total and rate > 0 and self.done < self.total:
+            text += f" ETA {format_duration((self.total - self.done) / rate)}"
+        return text
+
+    def draw(self, force=False):
+        # caller holds _console_lock
+        if not _progress_enabled:
+            return
+        self.drawn = time.time()
+        text = self.line()
+        if self.tty:
+            self.stream.write("\r" + text.ljust(self.width))
+            self.width = len(text)
+        elif not force:
+            self.stream.write(text + "\n")
+        self.stream.flush()
+
+    def clear(self):
+        # caller holds _console_lock
+        if self.tty and self.width:
+            self.stream.write("\r" + " " * self.width + "\r")
+            self.stream.flush()
+
+    def close(self):
+        """
+        Draws the final state and leaves the line on the screen.
+        """
+        global _progress
+        with _console_lock:
+            if _progress is self:
+                _progress = None
+            if _progress_enabled:
+                self.draw()
+                if self.tty:
+                    self.stream.write("\n")
+                    self.stream.flush()
+
+
+def format_duration(seconds):
+    seconds = int(seconds)
+    if seconds < 60:
+        return f"{seconds}s"
+    if seconds < 3600:
+        return f"{seconds // 60}m{seconds % 60:02d}s"
+    return f"{seconds // 3600}h{seconds % 3600 // 60:02d}m"
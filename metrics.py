@@ -0,0 +1,326 @@
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# brief functionality explanation:
+# counters, per-stage timing histograms and queue depths of a run, e.g.
+#
+#   with metrics.timer("clone"):
+#       clone_repository(...)
+#   metrics.inc("hits")
+#   metrics.queue("pipeline_pending", queue.pending)
+#
+# they can be exported as prometheus text (http endpoint or file, see
+# https://prometheus.io/docs/instrumenting/exposition_formats/) and as
+# periodic JSON-lines snapshots. everything is cheap enough to stay on all the time.
+# SamplingProfiler is a small stack sampler for --profile.
+
+logger = logging.getLogger(__name__)
+
+PREFIX = "github_scan"
+
+# upper bounds (seconds) of the histogram buckets, from fast HTTP requests to huge clones
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+
+class Histogram:
+
+    def __init__(self):
+        self.buckets = [0] * len(BUCKETS)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        for index, bound in enumerate(BUCKETS):
+            if value <= bound:
+                self.buckets[index] += 1
+                break
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+
+class Registry:
+    """
+    All metrics of a process. Thread safe.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = Counter()
+        self.stages = {}
+        self.queues = {}
+        self.started = time.time()
+
+    def inc(self, name, value=1):
+        """
+        Adds to a counter (e.g. "repos", "bytes_cloned").
+        """
+        with self.lock:
+            self.counters[name] += value
+
+    def observe(self, stage, seconds):
+        """
+        Records the duration of one run of a stage.
+        """
+        with self.lock:
+            if stage not in self.stages:
+                self.stages[stage] = Histogram()
+            self.stages[stage].observe(seconds)
+
+    @contextmanager
+    def timer(self, stage):
+        """
+        Times the body of the with-statement as one run of `stage`.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - start)
+
+    def queue(self, name, depth):
+        """
+        Registers a queue, `depth()` is called whenever metrics are exported.
+        """
+        with self.lock:
+            self.queues[name] = depth
+
+    def snapshot(self):
+        """
+        Returns:
+            dict: The current values, as written to the JSON-lines file.
+        """
+        with self.lock:
+            counters = dict(self.counters)
+            stages = {stage: {"count": histogram.count, "sum_s": round(histogram.sum, 3),
+                              "mean_s": round(histogram.sum / histogram.count, 4) if histogram.count else 0.0,
+                              "max_s": round(histogram.max, 3)}
+                      for stage, histogram in self.stages.items()}
+            queues = dict(self.queues)
+        return {"time": round(time.time(), 3), "uptime_s": round(time.time() - self.started, 1),
+                "counters": counters, "stages": stages, "queues": queue_depths(queues)}
+
+    def prometheus(self):
+        """
+        Returns:
+            str: The metrics in the prometheus text format.
+        """
+        with self.lock:
+            counters = dict(self.counters)
+            stages = {stage: (list(histogram.buckets), histogram.count, histogram.sum)
+                      for stage, histogram in self.stages.items()}
+            queues = dict(self.queues)
+
+        lines = []
+        for name, value in sorted(counters.items()):
+            lines.append(f"# TYPE {PREFIX}_{name}_total counter")
+            lines.append(f"{PREFIX}_{name}_total {value}")
+
+        if stages:
+            lines.append(f"# TYPE {PREFIX}_stage_seconds histogram")
+        for stage, (buckets, count, total) in sorted(stages.items()):
+            cumulative = 0
+            for bound, bucket in zip(BUCKETS, buckets):
+                cumulative += bucket
+                lines.append(f'{PREFIX}_stage_seconds_bucket{{stage="{stage}",le="{bound}"}} {cumulative}')
+            lines.append(f'{PREFIX}_stage_seconds_bucket{{stage="{stage}",le="+Inf"}} {count}')
+            lines.append(f'{PREFIX}_stage_seconds_sum{{stage="{stage}"}} {total:.6f}')
+            lines.append(f'{PREFIX}_stage_seconds_count{{stage="{stage}"}} {count}')
+
+        depths = queue_depths(queues)
+        if depths:
+            lines.append(f"# TYPE {PREFIX}_queue_depth gauge")
+        for name, depth in sorted(depths.items()):
+            lines.append(f'{PREFIX}_queue_depth{{queue="{name}"}} {depth}')
+        return "\n".join(lines) + "\n"
+
+
+def queue_depths(queues):
+    depths = {}
+    for name, depth in queues.items():
+        try:
+            depths[name] = depth()
+        except Exception:
+            # e.g. a database that was already closed
+            continue
+    return depths
+
+
+# the registry used by the scanner, the collector and the pipeline
+registry = Registry()
+inc = registry.inc
+observe = registry.observe
+timer = registry.timer
+queue = registry.queue
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_response(404)
+            self.end_headers()
+            return
+        data = registry.prometheus().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class Exporter:
+    """
+    Exports the registry while a run is going on: serves /metrics over HTTP,
+    and/or rewrites a prometheus text file and appends a JSON snapshot every
+    `interval` seconds. The files are written a last time by close().
+    """
+
+    def __init__(self, port=None, prometheus_file=None, jsonl_file=None, interval=10.0):
+        """
+        Args:
+            port (int, optional): Serve http://127.0.0.1:<port>/metrics. Defaults to None.
+            prometheus_file (str, optional): Keep the current metrics in this file (prometheus text). Defaults to None.
+            jsonl_file (str, optional): Append a JSON snapshot to this file every interval. Defaults to None.
+            interval (float, optional): Seconds between two file updates. Defaults to 10.0.
+        """
+        self.prometheus_file = prometheus_file
+        self.jsonl_file = jsonl_file
+        self.interval = interval
+        self.stop = threading.Event()
+        self.server = None
+        self.thread = None
+
+        if port is not None:
+            self.server = ThreadingHTTPServer(('127.0.0.1', port), MetricsHandler)
+            self.server.daemon_threads = True
+            threading.Thread(target=self.server.serve_forever, daemon=True).start()
+            logger.info(f"Serving metrics on http://127.0.0.1:{self.server.server_address[1]}/metrics")
+        if prometheus_file or jsonl_file:
+            self.thread = threading.Thread(target=self._run, daemon=True)
+            self.thread.start()
+
+    def _run(self):
+        while not self.stop.wait(self.interval):
+            self.write()
+
+    def write(self):
+        if self.prometheus_file:
+            # replace the file at once, so readers never see half of it
+            temp_path = self.prometheus_file + '.tmp'
+            with open(temp_path, 'w') as file:
+                file.write(registry.prometheus())
+            os.replace(temp_path, self.prometheus_file)
+        if self.jsonl_file:
+            with open(self.jsonl_file, 'a') as file:
+                file.write(json.dumps(registry.snapshot()) + '\n')
+
+    def close(self):
+        self.stop.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.write()
+        if self.server is not None:
+            self.server.shutdown()
+
+
+class SamplingProfiler:
+    """
+    Samples the stacks of all threads at a fixed interval and counts the
+    call paths, so the hottest ones can be listed after a run. Unlike
+    cProfile it does not slow down the code it measures, and it also sees
+    where worker threads are waiting (git, network, sleeps).
+    """
+
+    def __init__(self, interval=0.01):
+        """
+        Args:
+            interval (float, optional): Seconds between two samples. Defaults to 0.01.
+        """
+        self.interval = interval
+        self.paths = Counter()
+        self.functions = Counter()
+        self.samples = 0
+        self.stop = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def _run(self):
+        own = threading.get_ident()
+        while not self.stop.wait(self.interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own:
+                    continue
+                path = []
+                while frame is not None:
+                    code = frame.f_code
+                    path.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                path.reverse()
+                self.paths[tuple(path)] += 1
+                # every function counted once per sample, even if recursive
+                for function in set(path):
+                    self.functions[function] += 1
+                self.samples += 1
+
+    def close(self, file_path, top=25):
+        """
+        Stops sampling and writes the hottest call paths and functions to a file.
+
+        Args:
+            file_path (str): The report file.
+            top (int, optional): The number of entries per list. Defaults to 25.
+        """
+        self.stop.set()
+        self.thread.join()
+        total = max(1, self.samples)
+        with open(file_path, 'w') as file:
+            file.write(f"{self.samples} samples every {self.interval * 1000:.0f} ms (all threads)\n\n")
+            file.write("hottest call paths (innermost last):\n")
+            for path, count in self.paths.most_common(top):
+                file.write(f"{count / total:7.1%}  {' > '.join(path[-8:])}\n")
+            file.write("\nfunctions (share of samples they were on the stack):\n")
+            for function, count in self.functions.most_common(top):
+                file.write(f"{count / total:7.1%}  {function}\n")
+        logger.info(f"Wrote profile ({self.samples} samples) to {file_path}")
+
+
+def add_arguments(parser):
+    """
+    Adds the metrics/profiling options to a command line parser.
+    """
+    parser.add_argument('--metrics_port', type=int, default=None, help='Serve prometheus metrics on this port (optional)')
+    parser.add_argument('--metrics_file', type=str, default=None, help='Keep the current metrics in this file, prometheus text format (optional)')
+    parser.add_argument('--metrics_jsonl', type=str, default=None, help='Append a JSON snapshot of the metrics to this file periodically (optional)')
+    parser.add_argument('--metrics_interval', type=float, default=10.0, help='Seconds between two metrics file updates (optional)')
+    parser.add_argument('--profile', type=str, default=None, help='Sample the stacks of the run and write the hottest call paths to this file (optional)')
+
+
+@contextmanager
+def export_from_args(args):
+    """
+    Exports the metrics (and profiles) while the body of the with-statement
+    runs, as configured by the options of add_arguments().
+    """
+    exporter = Exporter(args.metrics_port, args.metrics_file, args.metrics_jsonl, args.metrics_interval)
+    profiler = SamplingProfiler().start() if args.profile else None
+    try:
+        yield
+    finally:
+        if profiler is not None:
+            profiler.close(args.profile)
+        exporter.close()
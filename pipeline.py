@@ -0,0 +1,365 @@
+import argparse
+import logging
+import sqlite3
+import threading
+import time
+
+import git_runner
+import log_utils
+import metrics
+import repo_collector
+import repo_scanner
+import scan_engine
+import tarball_fetch
+from result_cache import ResultCache
+from rules import load_rules
+from url_index import UrlIndex, open_blacklist
+from workspace import KEEP_MODES, Workspace, WorkspaceFull
+
+logger = logging.getLogger(__name__)
+
+# seconds the threads get to finish after a stop (the collector its page, the workers their
+# repository), before the databases are closed
+STOP_TIMEOUT = 60
+
+
+class Stopped(Exception):
+    """
+    Raised from the collector's page callback to stop collecting between two pages.
+    """
+
+# brief functionality explanation:
+# runs repo_collector and repo_scanner in one process, connected by a
+# durable work queue (SQLite) instead of CSV files:
+# the collector thread puts every page of search results into the queue
+# as soon as it arrives, and scanner workers take repositories out of it.
+# if the scanner falls behind, the collector waits before fetching the next page.
+# both sides can be restarted: queued items stay in the queue, items that
+# were being scanned are put back, and finished keywords are not searched again.
+
+
+class WorkQueue:
+    """
+    Durable FIFO queue of repositories, backed by SQLite.
+
+    Every item is either pending, taken (being scanned) or done. Items that
+    were taken when the process died are put back with recover().
+    """
+
+    def __init__(self, db_path):
+        """
+        Args:
+            db_path (str): The path to the SQLite database file.
+        """
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(db_path, timeout=60, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS items ("
+                        "id INTEGER PRIMARY KEY AUTOINCREMENT, url TEXT UNIQUE, name TEXT, "
+                        "stars INTEGER, size INTEGER, state TEXT NOT NULL DEFAULT 'pending')")
+        self.db.execute("CREATE INDEX IF NOT EXISTS items_state ON items (state, id)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS keywords (term TEXT PRIMARY KEY)")
+        self.db.commit()
+
+    def put_many(self, repositories):
+        """
+        Adds repositories to the end of the queue (URLs already in it are ignored).
+
+        Args:
+            repositories (list): RepoInfo tuples.
+        """
+        with self.lock:
+            self.db.executemany("INSERT OR IGNORE INTO items (url, name, stars, size) VALUES (?, ?, ?, ?)",
+                                [(repo_info.url, repo_info.name, repo_info.stars, repo_info.size)
+                                 for repo_info in repositories])
+            self.db.commit()
+
+    def take(self):
+        """
+        Takes the oldest pending repository out of the queue.
+
+        Returns:
+            tuple: (id, row) with row in the CSV layout the scanner expects, or None if nothing is pending.
+        """
+        with self.lock:
+            item = self.db.execute("SELECT id, name, stars, url, size FROM items "
+                                   "WHERE state = 'pending' ORDER BY id LIMIT 1").fetchone()
+            if item is None:
+                return None
+            self.db.execute("UPDATE items SET state = 'taken' WHERE id = ?", (item[0],))
+            self.db.commit()
+        item_id, name, stars, url, size = item
+        return item_id, [name, str(stars), url, "" if size is None else str(size)]
+
+    def put_back(self, item_id):
+        """
+        Makes a taken repository pending again, e.g. a hit found after max_hits was reached.
+        """
+        with self.lock:
+            self.db.execute("UPDATE items SET state = 'pending' WHERE id = ?", (item_id,))
+            self.db.commit()
+
+    def done(self, item_id):
+        with self.lock:
+            self.db.execute("UPDATE items SET state = 'done' WHERE id = ?", (item_id,))
+            self.db.commit()
+
+    def pending(self):
+        """
+        Returns:
+            int: The number of repositories waiting to be scanned.
+        """
+        with self.lock:
+            return self.db.execute("SELECT COUNT(*) FROM items WHERE state = 'pending'").fetchone()[0]
+
+    def recover(self):
+        """
+        Puts repositories that were being scanned when the process died back into the queue.
+
+        Returns:
+            list: The rows that were put back.
+        """
+        with self.lock:
+            rows = self.db.execute("SELECT name, stars, url, size FROM items WHERE state = 'taken'").fetchall()
+            self.db.execute("UPDATE items SET state = 'pending' WHERE state = 'taken'")
+            self.db.commit()
+        return rows
+
+    def keyword_done(self, term):
+        with self.lock:
+            self.db.execute("INSERT OR IGNORE INTO keywords (term) VALUES (?)", (term,))
+            self.db.commit()
+
+    def finished_keywords(self):
+        with self.lock:
+            return {row[0] for row in self.db.execute("SELECT term FROM keywords")}
+
+
+def produce(queue, tokens, args, collected, scanned, stop):
+    """
+    Collector side: searches all keywords and puts every page into the queue.
+    Blocks while the queue holds `max_pending` repositories (backpressure).
+    """
+    finished = queue.finished_keywords()
+
+    def on_page(repositories):
+        if stop.is_set():
+            # dropped, the page is fetched again on the next start
+            raise Stopped()
+        new = [repo_info for repo_info in repositories
+               if repo_info.url not in scanned and repo_info.url not in collected]
+        # queued (and committed) first: a crash in between queues them again, which the queue ignores,
+        # instead of marking them collected without ever scanning them
+        queue.put_many(new)
+        for repo_info in new:
+            collected.add(repo_info.url)
+        collected.flush()
+        with metrics.timer("backpressure_wait"):
+            while queue.pending() >= args.max_pending and not stop.is_set():
+                time.sleep(1)
+        if stop.is_set():
+            raise Stopped()
+
+    for term in repo_collector.keyword_list:
+        if stop.is_set():
+            break
+        if term in finished:
+            logger.info(f"Skipping term: {term}, finished in an earlier run")
+            continue
+        logger.info(f"currently at: {term}, {queue.pending()} repos waiting to be scanned")
+        try:
+            repo_collector.collect_keyword(tokens, term, args.language, args.min_stars, args.max_stars,
+                                           partition=not args.no_partition, workers=args.slice_workers,
+                                           on_page=on_page)
+        except Stopped:
+            # the keyword is searched again on the next start
+            break
+        queue.keyword_done(term)
+
+
+def join_all(threads, timeout):
+    """
+    Waits until all threads are done, or the timeout is up.
+
+    Returns:
+        list: The threads that are still running.
+    """
+    deadline = time.monotonic() + timeout
+    for thread in threads:
+        thread.join(max(0.0, deadline - time.monotonic()))
+    return [thread for thread in threads if thread.is_alive()]
+
+
+def consume(queue, blacklist, args, producer_done, stop, stats, progress):
+    """
+    Scanner side: takes repositories out of the queue until the collector is
+    done and the queue is empty.
+    """
+    clone_options = {'blob_limit': args.blob_limit, 'sparse_patterns': args.sparse}
+    while not stop.is_set():
+        item = queue.take()
+        if item is None:
+            if producer_done.is_set():
+                return
+            time.sleep(1)
+            continue
+        item_id, row = item
+        try:
+            hit_files = repo_scanner.process_repository(row, blacklist, args.max_size_mb, clone_options)
+        except WorkspaceFull as e:
+            # the item stays taken and is put back on the next start
+            logger.error(str(e))
+            stop.set()
+            return
+        recorded = False
+        if hit_files:
+            with stats["lock"]:
+                if args.max_hits and stats["hits"] >= args.max_hits:
+                    # finished after the limit was already reached, dont keep it (unless an earlier run kept it),
+                    # and release the claim and the item so a later run scans it again
+                    if not repo_scanner.is_cached(hit_files):
+                        repo_scanner.workspace.discard(repo_scanner.workspace.path(row[0], row[2]))
+                    blacklist.discard(row[2])
+                    queue.put_back(item_id)
+                else:
+                    repo_scanner.record_hits(hit_files)
+                    recorded = True
+                    stats["hits"] += 1
+                    logger.log(log_utils.RESULT, f"Hit #{stats['hits']}: {row[0]}",
+                               extra={"repo": row[0], "url": row[2], "files": hit_files,
+                                      "cached": repo_scanner.is_cached(hit_files)})
+                    if args.max_hits and stats["hits"] >= args.max_hits:
+                        logger.log(log_utils.RESULT, f"Reached {args.max_hits} hits, stopping.")
+                        stop.set()
+        if hit_files and not recorded:
+            continue
+        queue.done(item_id)
+        # permanent failures are not part of the throughput
+        permanent = not hit_files and row[2] in repo_scanner.failures
+        progress.update(hits=1 if recorded else 0, failed=1 if permanent else 0)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Github Repository Collector + Scanner Pipeline')
+    parser.add_argument('--token', type=str, nargs='+', default=None, help='GitHub auth token(s)')
+    parser.add_argument('--token_file', type=str, default=None, help='File with one GitHub auth token per line (optional)')
+    parser.add_argument('--min_stars', type=int, default=11, help='Minimum number of stars')
+    parser.add_argument('--max_stars', type=int, default=13, help='Maximum number of stars')
+    parser.add_argument('--language', type=str, default='python', help='Programming language')
+    parser.add_argument('--queue', type=str, default='./pipeline.db', help='Path of the work queue database')
+    parser.add_argument('--max_pending', type=int, default=200, help='Pause collecting while this many repos wait to be scanned')
+    parser.add_argument('--workers', type=int, default=4, help='Number of repositories cloned and scanned in parallel')
+    parser.add_argument('--max_hits', type=int, default=0, help='Stop after this many hits (optional, 0 = no limit)')
+    parser.add_argument('--index', type=str, default='./blacklist.db', help='Path of the URL index / blacklist database')
+    parser.add_argument('--rules', type=str, default=None, help='Rules file (TOML) describing what to look for (optional)')
+    parser.add_argument('--result_cache', type=str, default=None, help='Database of scan results per (url, commit, rules) (optional)')
+    parser.add_argument('--max_size_mb', type=int, default=100, help='Skip repositories bigger than this')
+    parser.add_argument('--fetch', type=str, default='clone', choices=['clone', 'tarball'], help='Clone repositories, or stream their tarball and scan it in memory (optional)')
+    parser.add_argument('--tarball_url', type=str, default=tarball_fetch.TARBALL_URL, help='With --fetch tarball: where tarballs are downloaded from (optional)')
+    parser.add_argument('--blob_limit', type=str, default=None, help='Do not download files bigger than this, e.g. 1m (optional)')
+    parser.add_argument('--sparse', type=str, nargs='+', default=None, help='Only check out files matching these patterns (optional)')
+    parser.add_argument('--workspace', type=str, default='./tmp', help='Directory the repositories are cloned into, e.g. a tmpfs (optional)')
+    parser.add_argument('--disk_budget_mb', type=int, default=None, help='Maximum size of the workspace, clones wait until they fit (optional)')
+    parser.add_argument('--min_free_mb', type=int, default=1024, help='Do not start a clone that would leave less free disk space (optional)')
+    parser.add_argument('--keep_hits', type=str, default='checkout', choices=KEEP_MODES, help='Keep hits as the whole checkout, only the matching files, or a tarball (optional)')
+    parser.add_argument('--hits_dir', type=str, default='./hits', help='Where hits are archived with --keep_hits files/tarball (optional)')
+    parser.add_argument('--no_partition', action='store_true', help='Do not split queries with more than 1000 results (optional)')
+    parser.add_argument('--slice_workers', type=int, default=4, help='Number of slices of one keyword collected at the same time (optional)')
+    parser.add_argument('--cache', type=str, default=None, help='Cache search responses in this database, e.g. ./http_cache.db; off by default (optional)')
+    parser.add_argument('--api_url', type=str, default=repo_collector.API_URL, help='Base URL of the GitHub API (optional)')
+
+    parser.epilog = """
+    This tool runs the collector and the scanner at the same time. Scanning
+    starts as soon as the first page of search results arrives. Progress is
+    kept in the queue database, so the same command continues after a crash.
+    The file based mode (repo_collector.py + repo_scanner.py) still works.
+
+    Example usage:
+    python pipeline.py --token YOUR_GITHUB_TOKEN --workers 4
+    """
+    scan_engine.add_arguments(parser)
+    git_runner.add_arguments(parser)
+    metrics.add_arguments(parser)
+    log_utils.add_arguments(parser)
+    args = parser.parse_args()
+    log_utils.setup_from_args(args)
+
+    repo_collector.configure_session(args.api_url, args.slice_workers, args.cache)
+    tokens = repo_collector.load_tokens(args.token, args.token_file)
+    if not tokens:
+        parser.error("give at least one token with --token or --token_file")
+    if not repo_collector.check_authentication(tokens):
+        logger.error("Exiting.")
+        exit()
+    tokens = repo_collector.TokenPool(tokens, min_interval=1.0)
+
+    repo_scanner.ruleset = load_rules(args.rules)
+    repo_scanner.walk_options = scan_engine.options_from_args(args)
+    workspace = repo_scanner.workspace = Workspace(args.workspace, args.disk_budget_mb, args.min_free_mb,
+                                                   args.keep_hits, args.hits_dir)
+    repo_scanner.clone_limits = git_runner.limits_from_args(args)
+    if args.fetch == 'tarball':
+        repo_scanner.tarballs = tarball_fetch.TarballFetcher(
+            args.tarball_url, pool_size=args.workers, max_seconds=repo_scanner.clone_limits.timeout,
+            timeout=(tarball_fetch.HTTP_TIMEOUT[0], args.low_speed_time or tarball_fetch.HTTP_TIMEOUT[1]))
+    if args.result_cache:
+        repo_scanner.result_cache = ResultCache(args.result_cache)
+    queue = WorkQueue(args.queue)
+    blacklist = open_blacklist(args.index)
+    repo_scanner.failures = git_runner.FailureLog(args.index, args.retry_failed)
+    collected = UrlIndex(args.index, "collected")
+
+    # repos that were being scanned when we stopped: release their claim and workspace
+    recovered = queue.recover()
+    for name, stars, url, size in recovered:
+        blacklist.discard(url)
+        workspace.discard(workspace.path(name, url))
+    if recovered:
+        logger.info(f"Put {len(recovered)} interrupted repositories back into the queue.")
+
+    stop = threading.Event()
+    producer_done = threading.Event()
+    stats = {"hits": 0, "lock": threading.Lock()}
+
+    def run_producer():
+        try:
+            produce(queue, tokens, args, collected, blacklist, stop)
+        finally:
+            producer_done.set()
+
+    metrics.queue("pipeline_pending", queue.pending)
+    threads = [threading.Thread(target=run_producer, daemon=True)]
+    progress = log_utils.Progress("pipeline")
+    threads += [threading.Thread(target=consume, args=(queue, blacklist, args, producer_done, stop, stats, progress),
+                                 daemon=True)
+                for _ in range(max(1, args.workers))]
+    with metrics.export_from_args(args), progress:
+        for thread in threads:
+            thread.start()
+        try:
+            for thread in threads[1:]:
+                while thread.is_alive():
+                    thread.join(1)
+        except KeyboardInterrupt:
+            logger.warning("Stopping, in-flight repositories will be retried on the next start.")
+        # the collector stops before its next page, the workers after their current repository
+        stop.set()
+        running = join_all(threads, STOP_TIMEOUT)
+
+    if running:
+        # they may still write, so nothing is closed; their items stay taken and are put back on the next start
+        logger.warning(f"{len(running)} thread(s) did not stop within {STOP_TIMEOUT}s, "
+                       f"their repositories will be retried on the next start.")
+        blacklist.flush()
+        collected.flush()
+    else:
+        blacklist.close()
+        collected.close()
+        repo_scanner.failures.close()
+        # let the reaper finish deleting
+        workspace.close()
+    logger.log(log_utils.RESULT, f"Done, found {stats['hits']} repositories meeting the conditions.")
+
+
+if __name__ == "__main__":
+    main()
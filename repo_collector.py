@@ -1,11 +1,46 @@
+import asyncio
+import csv
 import requests
+import requests.adapters
+import threading
 import time
-from datetime import datetime
-import pandas as pd
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, timedelta
 import argparse
+import logging
 import os
+import re
 from pathlib import Path
 
+import log_utils
+import metrics
+from checkpoint import CollectorCheckpoint, remove_checkpoint
+from http_cache import CachedSession
+from keyword_scheduler import KeywordScheduler
+from repo_store import RepoInfo, RepoStore
+from url_index import UrlIndex
+from watermarks import FIELDS, Watermarks
+
+logger = logging.getLogger(__name__)
+
+# base URL of the GitHub API, can be pointed at a local fake server (see fake_github_api.py)
+API_URL = "https://api.github.com"
+
+# pooled HTTP session used for all requests, replaced by a CachedSession in main()
+session = requests.Session()
+
+# the search API never returns more than this many results for one query
+RESULT_CAP = 1000
+# no repository was created before github went live
+FIRST_CREATED = date(2008, 1, 1)
+
+# API requests sent per keyword in this run, for the keyword yields
+api_calls = Counter()
+api_calls_lock = threading.Lock()
+# keywords whose results were cut off (result cap, failed request, ...), their watermark must not move
+incomplete = set()
+
 # modify this to change what repos are searched for
 keyword_list = [
     "webui",
@@ -134,186 +169,976 @@ def extract_single_repo_info(repo):
         repo (dict): The repository data.
 
     Returns:
-        tuple: A tuple containing the stars count, URL, and name of the repository.
+        RepoInfo: The stars count, URL, name and size (in KB) of the repository, and the metadata
+            the scanner can filter on (full_name, pushed_at, default_branch, fork, archived, topics), and created_at.
     """
 
     stars = repo["stargazers_count"]
     url = repo["html_url"]
     name = repo["name"]
-    return stars, url, name
+    size = repo.get("size", "")
+    return RepoInfo(stars, url, name, size, repo.get("full_name"), repo.get("pushed_at"),
+                    repo.get("default_branch"), repo.get("fork"), repo.get("archived"),
+                    tuple(repo.get("topics") or ()), repo.get("created_at"))
 
 
-def check_authentication(token):
+def check_authentication(tokens):
     """
-    Checks if the authentication is successful by making a request to the GitHub API.
-    Prints the authentication status and the username if successful.
+    Checks that every token authenticates, by making a request to the GitHub API
+    for each of them (concurrently). Prints the authentication status and the
+    username of every token.
+
+    Args:
+        tokens (iterable): The GitHub auth tokens.
+
+    Returns:
+        bool: True if all tokens are valid.
     """
 
-    user_url = "https://api.github.com/user"
-    headers = {
-        "Authorization": f"token {token}",
-        "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36",
-    }
+    user_url = f"{API_URL}/user"
 
-    response = requests.get(user_url, headers=headers)
+    def check(token):
+        headers = {
+            "Authorization": f"token {token}",
+            "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36",
+        }
+        response = session.get(user_url, headers=headers)
+        if response.status_code == 200:
+            return response.json()['login']
+        logger.error(f"Authentication failed for token {mask(token)}. Status code: {response.status_code}",
+                     extra={"response": response.text})
+        return None
 
-    if response.status_code == 200:
-        user_data = response.json()
-        print(f"Authentication successful. Welcome, {user_data['login']}!")
-        return True
-    else:
-        print(f"Authentication failed. Status code: {response.status_code}")
-        print(response.json())
+    tokens = list(tokens)
+    with ThreadPoolExecutor(max_workers=len(tokens)) as executor:
+        logins = list(executor.map(check, tokens))
+    if None in logins:
         return False
 
+    for token, login in zip(tokens, logins):
+        logger.info(f"Authentication successful for token {mask(token)}. Welcome, {login}!")
+    if len(set(logins)) < len(logins):
+        # the search limit is per account, not per token
+        logger.warning("some tokens belong to the same account and share its rate limit.")
+    return True
+
+
+def mask(token):
+    """
+    Returns:
+        str: The token shortened to its last 4 characters, for printing.
+    """
+    return f"...{token[-4:]}"
+
 
-def handleRateLimit(response, retries, max_retries):
+def load_tokens(tokens=None, token_file=None):
     """
-    Handles rate limit exceeded scenarios.
+    Collects the tokens given on the command line and in a token file.
 
     Args:
-        response (Response): The response object.
-        retries (int): The number of retries made.
-        max_retries (int): The maximum number of retries allowed.
+        tokens (list, optional): Tokens given directly. Defaults to None.
+        token_file (str, optional): File with one token per line, blank lines and lines starting with # are ignored. Defaults to None.
 
     Returns:
-        bool: True if the rate limit was handled successfully, False otherwise.
-    """
-    if 'Retry-After' in response.headers:
-        retry_after_seconds = int(response.headers['Retry-After'])
-        print("Rate limit exceeded. " +
-              f"Waiting for {retry_after_seconds}s.")
-        time.sleep(retry_after_seconds)
-    elif 'X-RateLimit-Reset' in response.headers and 'X-RateLimit-Remaining' in response.headers:
-        reset_timestamp = int(response.headers['X-RateLimit-Reset'])
-        current_timestamp = int(datetime.utcnow().timestamp())
-        wait_time = max(0, reset_timestamp - current_timestamp + 1)  # Adding 1 second to be safe
-        print("Rate limit exceeded." +
-              f" Waiting for {wait_time} seconds.")
-        time.sleep(wait_time)
-    else:
-        if retries < max_retries:
-            wait_time = 60 * (2 ** retries)
-            print(f"Rate limit exceeded. Waiting {wait_time}s before retrying.")
-            return retries + 1
+        list: The tokens, without duplicates, in the given order.
+    """
+    tokens = list(tokens or [])
+    if token_file is not None:
+        with open(token_file, encoding='utf-8') as file:
+            tokens += [line.strip() for line in file if line.strip() and not line.startswith('#')]
+    return list(dict.fromkeys(tokens))
+
+
+def build_query(query, language, min_stars, max_stars, created=None):
+    """
+    Builds the search query string.
+
+    Args:
+        query (str): The keyword.
+        language (str): The programming language to filter the repositories.
+        min_stars (int): The minimum number of stars.
+        max_stars (int): The maximum number of stars.
+        created (tuple, optional): (from, to) dates the repositories were created in. Defaults to None.
+
+    Returns:
+        str: The value of the `q` parameter.
+    """
+    q = f"{query} language:{language} stars:{min_stars}..{max_stars}"
+    if created is not None:
+        q += f" created:{created[0].isoformat()}..{created[1].isoformat()}"
+    return q
+
+
+def split_slice(search_slice):
+    """
+    Splits a search slice with too many results into two halves: first by
+    stars, and once the star range is a single value, by creation date.
+    (creation dates do not change, unlike pushed dates, so the halves stay stable)
+
+    Args:
+        search_slice (tuple): (min_stars, max_stars, created) with created being None or a (from, to) tuple of dates.
+
+    Returns:
+        list: The two halves, or an empty list if the slice can not be split any further.
+    """
+    min_stars, max_stars, created = search_slice
+    if min_stars < max_stars:
+        middle = (min_stars + max_stars) // 2
+        return [(min_stars, middle, created), (middle + 1, max_stars, created)]
+
+    created_from, created_to = created or (FIRST_CREATED, date.today())
+    if created_from >= created_to:
+        return []
+    middle = created_from + (created_to - created_from) / 2
+    return [(min_stars, max_stars, (created_from, middle)),
+            (min_stars, max_stars, (middle + timedelta(days=1), created_to))]
+
+
+def cached_response(url, params):
+    """
+    Returns a cached response that can be used without sending a request.
+
+    Args:
+        url (str): The URL.
+        params (dict): The query parameters.
+
+    Returns:
+        requests.Response: The cached response, or None.
+    """
+    if isinstance(session, CachedSession):
+        return session.fresh(url, params)
+    return None
+
+
+def search_page_steps(tokens, q, page, per_page=50, max_retries=5):
+    """
+    Requests a single page of search results. The request is sent with the
+    token that has the most headroom; a rate limited token is paused and the
+    request is retried right away with the next one. Only if all tokens are
+    used up, it waits for the first one to be reset.
+
+    This is only the logic, without the transport: a generator that yields the
+    (url, params) of every request to send and is sent back (token, response),
+    see run_steps and run_steps_async.
+
+    Args:
+        tokens (TokenPool): The GitHub auth tokens.
+        q (str): The search query string (see build_query).
+        page (int): The page number.
+        per_page (int, optional): The number of results per page. Defaults to 50.
+        max_retries (int, optional): Give up after this many rate limited responses without a reset time. Defaults to 5.
+
+    Returns:
+        dict: The decoded response, or None if the request failed.
+    """
+    base_url = f"{API_URL}/search/repositories"
+    params = {
+        "q": q,
+        "per_page": str(per_page),
+        "page": page,
+    }
+    retries = 0
+
+    while True:
+        response = cached_response(base_url, params)
+        if response is None:
+            token, response = yield base_url, params
+            metrics.inc("http_requests")
+            count_call(q)
+            tokens.update(token, response.headers)
+
+        if response.status_code == 200:
+            metrics.inc("pages")
+            return response.json()
+
+        elif response.status_code in (403, 429):  # rate limit exceeded
+            metrics.inc("rate_limited")
+            if not has_reset_time(response.headers):
+                if retries >= max_retries:
+                    logger.error("rate limit exceeded. Max retries reached, giving up.", extra={"q": q})
+                    return None
+                retries += 1
+            wait_time = tokens.exhausted(token, response.headers, retries)
+            logger.info(f"rate limit exceeded for token {mask(token)}, pausing it for {wait_time:.0f}s.", extra={"q": q})
+
+        # no other response codes are expected (422 is returned for pages past the result cap)
         else:
-            print("Rate limit exceeded. Max retries reached. Exiting.")
-            return -1
+            logger.error(f"search failed with status {response.status_code}", extra={"q": q, "page": page})
+            return None
+
+
+def send_request(tokens, url, params):
+    """
+    Sends a request of the *_steps generators with the token that has the most headroom.
+
+    Returns:
+        tuple: (token, response)
+    """
+    token = tokens.acquire()
+    with metrics.timer("http_request"):
+        response = session.get(url, headers={"Authorization": f"token {token}"}, params=params)
+    return token, response
+
+
+def run_steps(steps, tokens):
+    """
+    Runs one of the *_steps generators, sending its requests one after the other.
+
+    Args:
+        steps (generator): E.g. search_page_steps(...).
+        tokens (TokenPool): The GitHub auth tokens.
+
+    Returns:
+        What the generator returns.
+    """
+    try:
+        request = next(steps)
+        while True:
+            request = steps.send(send_request(tokens, *request))
+    except StopIteration as e:
+        return e.value
+
+
+def fetch_search_page(tokens, q, page, per_page=50, max_retries=5):
+    """
+    Requests a single page of search results, see search_page_steps.
+
+    Returns:
+        dict: The decoded response, or None if the request failed.
+    """
+    return run_steps(search_page_steps(tokens, q, page, per_page, max_retries), tokens)
+
+
+def count_call(q):
+    # the keyword is everything before the qualifiers added by build_query
+    with api_calls_lock:
+        api_calls[q.split(" language:")[0]] += 1
+
+
+def mark_incomplete(q, reason, page):
+    # remembers that not all results of a keyword were collected
+    logger.warning(f"not all results collected: {reason}", extra={"q": q, "page": page})
+    with api_calls_lock:
+        incomplete.add(q.split(" language:")[0])
+
+
+def is_complete(query):
+    """
+    Returns:
+        bool: False if results of a query (keyword) were left out in this run.
+    """
+    with api_calls_lock:
+        return query not in incomplete
+
+
+def has_reset_time(headers):
+    """
+    Returns:
+        bool: True if a rate limited response says when to try again.
+    """
+    return 'Retry-After' in headers or 'X-RateLimit-Reset' in headers
+
+
+def count_steps(tokens, q):
+    """
+    Asks for the total number of results of a query, using a single one-item page.
+
+    Args:
+        tokens (TokenPool): The GitHub auth tokens.
+        q (str): The search query string (see build_query).
+
+    Returns:
+        int: The total count, or None if the request failed.
+    """
+    data = yield from search_page_steps(tokens, q, 1, per_page=1)
+    return None if data is None else data["total_count"]
+
+
+def count_results(tokens, q):
+    """
+    Returns:
+        int: The total count of a query, or None if the request failed (see count_steps).
+    """
+    return run_steps(count_steps(tokens, q), tokens)
+
+
+def probe_keyword(tokens, query, language, min_stars, max_stars):
+    """
+    Fetches the first page of a keyword, for the keyword scheduler. It is the
+    same request as the first page of an unsplit query, so with the HTTP cache
+    it is not sent twice.
+
+    Args:
+        tokens (TokenPool): The GitHub auth tokens.
+        query (str): The keyword.
+        language (str): The programming language to filter the repositories.
+        min_stars (int): The minimum number of stars.
+        max_stars (int): The maximum number of stars.
+
+    Returns:
+        tuple: (total_count, URLs of the first page), total_count is None if the request failed.
+    """
+    data = fetch_search_page(tokens, build_query(query, language, min_stars, max_stars), 1)
+    if data is None:
+        return None, []
+    return data["total_count"], [repo["html_url"] for repo in data["items"]]
+
+
+def partition_query(tokens, query, language, min_stars, max_stars, known_total=None):
+    """
+    Recursively splits a query into slices that each have at most RESULT_CAP
+    results, because the search API never returns more than that per query.
+
+    Args:
+        tokens (TokenPool): The GitHub auth tokens.
+        query (str): The keyword.
+        language (str): The programming language to filter the repositories.
+        min_stars (int): The minimum number of stars.
+        max_stars (int): The maximum number of stars.
+        known_total (int, optional): The total count of the whole query, if it is known already. Defaults to None.
+
+    Returns:
+        list: The (min_stars, max_stars, created) slices to collect.
+    """
+    slices = []
+    todo = [(min_stars, max_stars, None)]
+    while todo:
+        search_slice = todo.pop()
+        if known_total is not None and search_slice == (min_stars, max_stars, None):
+            total = known_total
+        else:
+            total = count_results(tokens, build_query(query, language, *search_slice))
+        halves = halves_to_count(query, search_slice, total)
+        if halves:
+            todo.extend(halves)
+        else:
+            slices.append(search_slice)
+    return slices
+
+
+def halves_to_count(query, search_slice, total):
+    """
+    Decides whether a slice of a query has to be split.
+
+    Args:
+        query (str): The keyword.
+        search_slice (tuple): The (min_stars, max_stars, created) slice.
+        total (int): Its total count, None if it is unknown.
+
+    Returns:
+        list: The halves to count next, empty if the slice is collected as it is.
+    """
+    if total is None or total <= RESULT_CAP:
+        return []
+    halves = split_slice(search_slice)
+    if not halves:
+        logger.warning(f"{query}: {total} results for {search_slice} can not be split further, "
+                       f"only the first {RESULT_CAP} are collected")
+        return []
+    logger.debug(f"{query}: {total} results for {search_slice}, splitting")
+    return halves
+
+
+def search_steps(tokens, query, language="Python", min_stars=10, max_stars=14, created=None, on_page=None,
+                 start_page=1):
+    """
+    Pages through the results of one query. Like search_page_steps, a generator
+    that yields the requests to send (see run_steps and run_steps_async).
+
+    Returns:
+        list: A list of tuples containing the stars count, URL, name and size of the repositories.
+    """
+    repositories = []
+    page = start_page
+    per_page = 50
+    q = build_query(query, language, min_stars, max_stars, created)
+    if (page - 1) * per_page >= RESULT_CAP:
+        return repositories
+
+    page_results = None
+    while True:
+        logger.debug("fetching page", extra={"q": q, "page": page})
+        data = yield from search_page_steps(tokens, q, page, per_page)
+        if data is None:
+            mark_incomplete(q, "request failed", page)
+            break
+        if data.get("incomplete_results"):
+            mark_incomplete(q, "search timed out on github's side", page)
 
+        # update previous result to reflect previous value
+        prev_results = page_results
+        page_results = data["items"]
 
-def search_github_repositories(token,
+        if page_results == prev_results and prev_results != None:
+            # always getting same results...
+            mark_incomplete(q, "stopping due to repeating output", page)
+            break
+
+        # iterate through results and extract info
+        page_repositories = [extract_single_repo_info(res) for res in page_results]
+        repositories.extend(page_repositories)
+        if on_page is not None:
+            on_page(page_repositories)
+
+        if len(page_results) < per_page or page * per_page >= RESULT_CAP:
+            # if page length not maxed out, its likely the last page
+            logger.debug("encountered last page", extra={"q": q, "page": page})
+            if data["total_count"] > page * per_page:
+                mark_incomplete(q, f"{data['total_count']} results, only the first {RESULT_CAP} are returned", page)
+            break
+        else:
+            # otherwise increment page indicator
+            page += 1
+
+    return repositories
+
+
+def search_github_repositories(tokens,
                                query,
                                language="Python",
                                min_stars=10,
-                               max_stars=14):
+                               max_stars=14,
+                               created=None,
+                               on_page=None,
+                               start_page=1):
     """
     Searches for GitHub repositories based on the provided query and filters.
 
     Args:
+        tokens (TokenPool): The GitHub auth tokens.
         query (str): The search query.
         language (str, optional): The programming language to filter the repositories. Defaults to "Python".
         min_stars (int, optional): The minimum number of stars to filter the repositories. Defaults to 10.
         max_stars (int, optional): The maximum number of stars to filter the repositories. Defaults to 14.
+        created (tuple, optional): (from, to) dates the repositories were created in. Defaults to None.
+        on_page (callable, optional): Called with the repositories of every page as soon as it arrives.
+            The next page is only requested once it returns. Defaults to None.
+        start_page (int, optional): The first page to fetch (when resuming). Defaults to 1.
 
     Returns:
-        list: A list of tuples containing the stars count, URL, and name of the repositories.
+        list: A list of tuples containing the stars count, URL, name and size of the repositories.
     """
-    base_url = "https://api.github.com/search/repositories"
-    headers = {
-        "Authorization": f"token {token}"
-    } 
+    return run_steps(search_steps(tokens, query, language, min_stars, max_stars, created, on_page, start_page), tokens)
+
+
+def collect_keyword(tokens, query, language, min_stars, max_stars, partition=True, workers=4, on_page=None,
+                    checkpoint=None, known_total=None):
+    """
+    Collects all repositories of a keyword. Queries with more results than the
+    search API returns are split into slices first, which are then collected
+    in parallel.
+
+    Args:
+        tokens (TokenPool): The GitHub auth tokens.
+        query (str): The keyword.
+        language (str): The programming language to filter the repositories.
+        min_stars (int): The minimum number of stars.
+        max_stars (int): The maximum number of stars.
+        partition (bool, optional): Split queries over the result cap. Defaults to True.
+        workers (int, optional): The number of slices collected at the same time. Defaults to 4.
+        on_page (callable, optional): Passed on to search_github_repositories. Defaults to None.
+        checkpoint (CollectorCheckpoint, optional): Records slices and pages, and skips those of an earlier run. Defaults to None.
+        known_total (int, optional): The total count of the keyword, if it was probed already. Defaults to None.
+
+    Returns:
+        list: A list of tuples containing the stars count, URL, name and size of the repositories.
+    """
+    slices = None if checkpoint is None else checkpoint.slices(query)
+    if slices is None:
+        if partition:
+            slices = partition_query(tokens, query, language, min_stars, max_stars, known_total)
+        else:
+            slices = [(min_stars, max_stars, None)]
+        if checkpoint is not None:
+            checkpoint.set_slices(query, slices)
+    if partition:
+        logger.info(f"{query}: collecting {len(slices)} slice(s)")
+
+    def collect_slice(search_slice):
+        if checkpoint is None:
+            return search_github_repositories(tokens, query, language, *search_slice, on_page=on_page)
+        start_page, done = checkpoint.slice_state(query, search_slice)
+        if done:
+            return []
+        repositories = search_github_repositories(tokens, query, language, *search_slice, start_page=start_page,
+                                                  on_page=checkpoint.page_recorder(query, search_slice, start_page, on_page))
+        checkpoint.slice_done(query, search_slice, complete=is_complete(query))
+        return repositories
+
     repositories = []
-    page = 1
-    per_page = 50
-    retries = 0
-    max_retries = 5  # You can adjust this based on your requirements
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for slice_repositories in executor.map(collect_slice, slices):
+            repositories.extend(slice_repositories)
+    if checkpoint is not None:
+        # including the pages fetched before a restart
+        return checkpoint.collected(query)
+    return repositories
 
-    params = {
-        "q": f"{query} language:{language} stars:{min_stars}..{max_stars}",
-        "per_page": "50",
-        "page": page,
-    }
 
-    page_results = None
-    while True:
-        time.sleep(1)
-        print("----------")
-        print("status:")
-        print("term: ", query)
-        print("page: ", page)
-        print("----------")
-        response = requests.get(base_url, headers=headers, params=params)
+class RateLimiter:
+    """
+    Token bucket of one GitHub token, driven by GitHub's rate limit headers.
 
-        if response.status_code == 200:
-            # update previous result to reflect previous value
-            prev_results = page_results
-            page_results = response.json()["items"]
-
-            if page_results == prev_results and prev_results != None:
-                # always getting same results...
-                # no idea why this happens, but often the result stays the same across pages?
-                print("Stopping due to repeating output..")
-                break
+    `X-RateLimit-Remaining` is the number of requests left and `X-RateLimit-Reset`
+    the time the bucket is refilled. Requests are spread evenly over the rest
+    of the window, so we run at exactly the allowed rate instead of sleeping a
+    fixed time and then running into a 403.
+    Not thread safe on its own, see TokenPool.
+    """
 
-            # iterate through results and extract info
-            for res in page_results:
-                repo_info = extract_single_repo_info(res)
-                # stars, url, name = repo_info
-                repositories.append(repo_info)
+    def __init__(self, min_interval=0.0):
+        """
+        Args:
+            min_interval (float, optional): Never send requests closer together than this. Defaults to 0.0.
+        """
+        self.min_interval = min_interval
+        self.remaining = None
+        self.reset = None
+        self.next_slot = 0.0
+        self.paused_until = 0.0
 
-            if len(page_results) < per_page:
-                # if page length not maxed out, its likely the last page
-                print("Encountered last page.")
-                break
-            else:
-                # otherwise increment page indicator
-                page += 1
-                print("Moving to next page: ", page)
+    def update(self, headers):
+        """
+        Updates the bucket from the rate limit headers of a response.
 
-        elif response.status_code == 403:  # Rate limit exceeded
-            return_value = handleRateLimit(response, retries, max_retries)
-            if return_value == -1:
-                break
-            else:
-                retries = return_value
-        
-        # no other response codes are expected
+        Args:
+            headers (dict): The response headers.
+        """
+        if 'X-RateLimit-Remaining' not in headers or 'X-RateLimit-Reset' not in headers:
+            return
+        remaining = int(headers['X-RateLimit-Remaining'])
+        reset = int(headers['X-RateLimit-Reset'])
+        if self.reset is None or reset > self.reset:
+            # new window
+            self.remaining, self.reset = remaining, reset
+        elif reset == self.reset:
+            # responses of concurrent requests can arrive out of order
+            self.remaining = min(self.remaining, remaining)
+
+    def pause(self, seconds):
+        """
+        Stops all requests for the given time (e.g. after a 403 with Retry-After).
+
+        Args:
+            seconds (float): How long to pause.
+        """
+        self.paused_until = max(self.paused_until, time.time() + seconds)
+
+    def headroom(self, now):
+        """
+        Returns:
+            float: The number of requests left in the current window (infinite if unknown).
+        """
+        if self.remaining is None or now >= self.reset:
+            return float('inf')
+        return self.remaining
+
+    def ready_at(self, now):
+        """
+        Returns:
+            float: The time the next request may be sent.
+        """
+        at = max(now, self.paused_until, self.next_slot)
+        if self.remaining is not None and self.remaining <= 0 and at < self.reset:
+            # +1 second to be safe
+            at = self.reset + 1
+        return at
+
+    def reserve(self, now):
+        """
+        Books the next request.
+
+        Returns:
+            float: The time it may be sent.
+        """
+        at = self.ready_at(now)
+        interval = self.min_interval
+        if self.remaining is not None and at < self.reset:
+            # spread the remaining requests evenly until the reset
+            interval = max(interval, (self.reset - at) / self.remaining)
+            self.remaining -= 1
+        self.next_slot = at + interval
+        return at
+
+
+class TokenPool:
+    """
+    Several GitHub tokens, each with its own RateLimiter.
+
+    Every request goes out with the token that can send soonest, and of those
+    the one with the most requests left. A token that runs into the rate limit
+    is paused and the next one takes over without waiting; only once every
+    token is used up, requests wait for the earliest reset.
+    """
+
+    def __init__(self, tokens, min_interval=0.0):
+        """
+        Args:
+            tokens (iterable): The GitHub auth tokens.
+            min_interval (float, optional): Minimum time between two requests of the same token. Defaults to 0.0.
+        """
+        self.limiters = {token: RateLimiter(min_interval) for token in tokens}
+        if not self.limiters:
+            raise ValueError("no GitHub token given")
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.limiters)
+
+    def __iter__(self):
+        return iter(self.limiters)
+
+    def _reserve(self):
+        with self.lock:
+            now = time.time()
+            token = min(self.limiters, key=lambda t: (self.limiters[t].ready_at(now),
+                                                      -self.limiters[t].headroom(now)))
+            return token, self.limiters[token].reserve(now)
+
+    def acquire(self):
+        """
+        Waits until a token may send the next request.
+
+        Returns:
+            str: The token to use.
+        """
+        token, at = self._reserve()
+        wait_time = max(0.0, at - time.time())
+        metrics.observe("rate_limit_wait", wait_time)
+        time.sleep(wait_time)
+        return token
+
+    async def acquire_async(self):
+        """
+        Async version of acquire().
+
+        Returns:
+            str: The token to use.
+        """
+        token, at = self._reserve()
+        wait_time = max(0.0, at - time.time())
+        metrics.observe("rate_limit_wait", wait_time)
+        await asyncio.sleep(wait_time)
+        return token
+
+    def update(self, token, headers):
+        """
+        Updates the state of a token from the rate limit headers of its response.
+        """
+        with self.lock:
+            self.limiters[token].update(headers)
+
+    def exhausted(self, token, headers, retries):
+        """
+        Pauses a token after a rate limited (403/429) response.
+
+        Args:
+            token (str): The token that was rate limited.
+            headers (dict): The response headers.
+            retries (int): The number of rate limited responses without a reset time so far.
+
+        Returns:
+            float: The number of seconds the token is paused.
+        """
+        if 'Retry-After' in headers:
+            wait_time = int(headers['Retry-After'])
+        elif 'X-RateLimit-Reset' in headers:
+            wait_time = max(0, int(headers['X-RateLimit-Reset']) - time.time() + 1)
         else:
-            print(f"Error: {response.status_code}")
-            break
+            wait_time = 60 * (2 ** max(0, retries - 1))
+        with self.lock:
+            self.limiters[token].update(headers)
+            self.limiters[token].pause(wait_time)
+        return wait_time
 
-    return repositories
+
+async def send_request_async(tokens, url, params):
+    """
+    Async version of send_request, throttled by the per-token rate limiters.
+
+    Returns:
+        tuple: (token, response)
+    """
+    token = await tokens.acquire_async()
+    # requests is blocking, run it in a worker thread (sharing the session's connection pool)
+    with metrics.timer("http_request"):
+        response = await asyncio.to_thread(session.get, url, headers={"Authorization": f"token {token}"}, params=params)
+    return token, response
+
+
+async def run_steps_async(steps, tokens):
+    """
+    Async version of run_steps: the requests of one generator are sent one after
+    the other, but other generators run while it waits.
+    """
+    try:
+        request = next(steps)
+        while True:
+            request = steps.send(await send_request_async(tokens, *request))
+    except StopIteration as e:
+        return e.value
+
+
+async def partition_query_async(tokens, query, language, min_stars, max_stars, known_total=None):
+    """
+    Async version of partition_query, the halves of a slice are counted concurrently.
+
+    Returns:
+        list: The (min_stars, max_stars, created) slices to collect.
+    """
+    async def partition(search_slice):
+        if known_total is not None and search_slice == (min_stars, max_stars, None):
+            total = known_total
+        else:
+            total = await run_steps_async(count_steps(tokens, build_query(query, language, *search_slice)), tokens)
+        halves = halves_to_count(query, search_slice, total)
+        if not halves:
+            return [search_slice]
+        parts = await asyncio.gather(*(partition(half) for half in halves))
+        return [part for slices in parts for part in slices]
+
+    return await partition((min_stars, max_stars, None))
+
+
+async def search_github_repositories_async(tokens,
+                                           query,
+                                           language="Python",
+                                           min_stars=10,
+                                           max_stars=14,
+                                           created=None,
+                                           on_page=None,
+                                           start_page=1):
+    """
+    Async version of search_github_repositories, throttled by the per-token
+    rate limiters instead of fixed sleeps.
+
+    Returns:
+        list: A list of tuples containing the stars count, URL, name and size of the repositories.
+    """
+    return await run_steps_async(search_steps(tokens, query, language, min_stars, max_stars, created, on_page,
+                                              start_page), tokens)
 
 
-def append_to_csv(file_path, data):
+async def collect_async(tokens, terms, concurrency, language, min_stars, max_stars, on_result, partition=True,
+                        checkpoint=None, totals=None):
     """
-    Appends the provided data to a CSV file.
+    Searches several keywords at the same time over the pooled HTTP session.
 
     Args:
-        file_path (str): The path to the CSV file.
-        data (str): The data to append to the CSV file.
+        tokens (TokenPool): The GitHub auth tokens.
+        terms (list): The keywords to search for.
+        concurrency (int): The number of keywords (and slices) searched at the same time.
+        language (str): The programming language to filter the repositories.
+        min_stars (int): The minimum number of stars to filter the repositories.
+        max_stars (int): The maximum number of stars to filter the repositories.
+        on_result (callable): Called with (term, repositories) as soon as a keyword is done.
+        partition (bool, optional): Split queries over the result cap. Defaults to True.
+        checkpoint (CollectorCheckpoint, optional): Records slices and pages, and skips those of an earlier run. Defaults to None.
+        totals (dict, optional): The total count of keywords that were probed already. Defaults to None.
     """
-    with open(file_path, 'a', encoding='utf-8') as csv_file:
-        csv_file.write(data)
+    keyword_semaphore = asyncio.Semaphore(concurrency)
+    slice_semaphore = asyncio.Semaphore(concurrency)
 
+    async def search_slice(term, search_slice):
+        if checkpoint is None:
+            async with slice_semaphore:
+                return await search_github_repositories_async(tokens, term, language, *search_slice)
+        start_page, done = checkpoint.slice_state(term, search_slice)
+        if done:
+            return []
+        async with slice_semaphore:
+            repositories = await search_github_repositories_async(
+                tokens, term, language, *search_slice, start_page=start_page,
+                on_page=checkpoint.page_recorder(term, search_slice, start_page))
+        checkpoint.slice_done(term, search_slice, complete=is_complete(term))
+        return repositories
 
-def remove_duplicates_and_save(file_path):
-    df = pd.read_csv(file_path)
-    rows_before = df.shape[0]  # count rows
-    df_no_duplicates = df.drop_duplicates()
-    rows_after = df_no_duplicates.shape[0]  # count rows
-    df_no_duplicates.to_csv(file_path, index=False) # save back to original path
-    print(f"Duplicate removal changed row count: {rows_before} -> {rows_after}")
+    async def search(term):
+        async with keyword_semaphore:
+            slices = None if checkpoint is None else checkpoint.slices(term)
+            if slices is None:
+                if partition:
+                    slices = await partition_query_async(tokens, term, language, min_stars, max_stars,
+                                                         (totals or {}).get(term))
+                else:
+                    slices = [(min_stars, max_stars, None)]
+                if checkpoint is not None:
+                    checkpoint.set_slices(term, slices)
+            results = await asyncio.gather(*(search_slice(term, s) for s in slices))
+            if checkpoint is not None:
+                on_result(term, checkpoint.collected(term))
+            else:
+                on_result(term, [repo_info for repositories in results for repo_info in repositories])
+
+    await asyncio.gather(*(search(term) for term in terms))
+
+
+class BatchWriter:
+    """
+    Writes one `repositories_{n}.csv` batch file.
+
+    Rows are written through a large buffer into a hidden temp file next to
+    the batch file, which is renamed into place on commit(). The rename is
+    atomic, so the scanner (which polls for the batch file) never sees a
+    half-written file.
+    """
+
+    def __init__(self, file_path, buffer_size=1024 * 1024):
+        """
+        Args:
+            file_path (str): The final path of the batch file.
+            buffer_size (int, optional): The write buffer size in bytes. Defaults to 1 MB.
+        """
+        self.path = Path(file_path)
+        self.tmp_path = self.path.with_name(f".{self.path.name}.tmp")
+        self.file = open(self.tmp_path, 'w', encoding='utf-8', newline='', buffering=buffer_size)
+        self.writer = csv.writer(self.file)
+        self.rows = 0
+        self.lock = threading.Lock()
+
+    def write(self, repo_info):
+        """
+        Adds a repository to the batch.
+
+        Args:
+            repo_info (RepoInfo): As returned by extract_single_repo_info.
+        """
+        with self.lock:
+            self.writer.writerow([repo_info.name, repo_info.stars, repo_info.url, repo_info.size])
+            self.rows += 1
+
+    def commit(self):
+        """
+        Flushes the batch to disk and moves it into place.
+        """
+        with self.lock:
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.file.close()
+            os.replace(self.tmp_path, self.path)
+
+    def abort(self):
+        """
+        Throws the batch away.
+        """
+        with self.lock:
+            self.file.close()
+            os.remove(self.tmp_path)
+
+
+def write_batch(output_path, file_batch_index, repositories, collected, scanned, store=None, keyword=None,
+                rescan_updated=False):
+    """
+    Writes the repositories of one keyword to `repositories_{file_batch_index}.csv`,
+    skipping URLs that were seen before. Duplicates are dropped as the rows
+    arrive, using the in-memory set of the URL index. The URLs are only added
+    to the index once the file is committed, so a batch that is interrupted
+    can be written again.
+
+    Args:
+        output_path (str): The output directory.
+        file_batch_index (int): The number of the CSV file.
+        repositories (iterable): The RepoInfo tuples returned by search_github_repositories.
+        collected (UrlIndex): URLs written by earlier batches/runs.
+        scanned (UrlIndex): URLs the scanner already processed.
+        store (RepoStore, optional): Also keep the metadata of the batch here. Defaults to None.
+        keyword (str, optional): The keyword of the batch, for the store. Defaults to None.
+        rescan_updated (bool, optional): Write repositories that were seen before again if they were pushed
+            to since (by the pushed_at in the store), and take them off the scanner's blacklist. Defaults to False.
+
+    Returns:
+        int: The number of repositories written (the new ones).
+    """
+    output_path_iteration = Path(output_path) / f"repositories_{file_batch_index}.csv"
+    previous = {}
+    if rescan_updated and store is not None:
+        previous = store.pushed_at([repo_info.url for repo_info in repositories])
+
+    # (the file is committed even if empty, the scanner waits for every batch number)
+    writer = BatchWriter(output_path_iteration)
+    skipped = 0
+    written = {}
+    updated = []
+    for repo_info in repositories:
+        url = repo_info.url
+        if url in written:
+            skipped += 1
+            continue
+        if url in scanned or url in collected:
+            pushed_before = previous.get(url.strip())
+            if not (pushed_before and repo_info.pushed_at and repo_info.pushed_at > pushed_before):
+                skipped += 1
+                continue
+            updated.append(url)
+        written[url] = repo_info
+        writer.write(repo_info)
+    if store is not None:
+        # before the CSV file appears, the scanner may look the batch up right away
+        store.add(file_batch_index, list(written.values()), keyword)
+    writer.commit()
+    for url in written:
+        collected.add(url)
+    collected.flush()
+    for url in updated:
+        # scanned with an older commit, the scanner processes it again
+        scanned.discard(url)
+    metrics.inc("repos_collected", writer.rows)
+
+    logger.log(log_utils.RESULT, f"Wrote {writer.rows} repositories to '{output_path_iteration}' ({skipped} duplicates or already seen before)",
+               extra={"batch": file_batch_index, "rows": writer.rows, "skipped": skipped, "updated": len(updated)})
+    return writer.rows
+
+
+def configure_session(api_url, pool_size, cache_path=None, cache_ttl=86400, cache_max_mb=500):
+    """
+    Sets up the API base URL and the pooled HTTP session shared by all requests.
+
+    Args:
+        api_url (str): Base URL of the GitHub API.
+        pool_size (int): The number of connections kept open (parallel searches).
+        cache_path (str, optional): Path of the HTTP response cache, None disables it. Defaults to None.
+        cache_ttl (int, optional): Seconds a cached search page is used before it is revalidated. Defaults to 86400.
+        cache_max_mb (int, optional): Size of the HTTP response cache. Defaults to 500.
+    """
+    global API_URL, session
+
+    API_URL = api_url.rstrip('/')
+    if cache_path is not None:
+        session = CachedSession(cache_path, ttl=cache_ttl, max_bytes=cache_max_mb * 1024 * 1024)
+    else:
+        session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_maxsize=pool_size)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+
+
+def main():
 
-if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Github Repository URL Collector')
     parser.add_argument('--min_stars', type=int, default=11, help='Minimum number of stars')
     parser.add_argument('--max_stars', type=int, default=13, help='Maximum number of stars')
     parser.add_argument('--language', type=str, default='python', help='Programming language')
-    parser.add_argument('--token', type=str, required=True, help='GitHub auth token')
-    parser.add_argument('--file_batch_index', type=int, default=0, help='Index of the latest "repositories_" csv file (optional, only if continue)')
-    parser.add_argument('--starting_point', type=str, default='webui', help='Next term to be queried (optional, only if continue)')
+    parser.add_argument('--token', type=str, nargs='+', default=None, help='GitHub auth token(s), each request uses the one with the most quota left')
+    parser.add_argument('--token_file', type=str, default=None, help='File with one GitHub auth token per line (optional, instead of or in addition to --token)')
+    parser.add_argument('--file_batch_index', type=int, default=None, help='Index of the latest "repositories_" csv file (optional, starts over instead of resuming from the checkpoint)')
+    parser.add_argument('--starting_point', type=str, default=None, help='Next term to be queried (optional, starts over instead of resuming from the checkpoint)')
     parser.add_argument('--out', type=str, required=True, help='Output directory path')
+    parser.add_argument('--checkpoint', type=str, default=None, help='Path of the checkpoint a restarted run resumes from (optional, default: <out>/collector_checkpoint.json)')
+    parser.add_argument('--no_checkpoint', action='store_true', help='Do not write a checkpoint (optional)')
+    parser.add_argument('--store', type=str, default=None, help='Database with the metadata of every batch, for filtering in repo_scanner (optional, default: <out>/repos.db)')
+    parser.add_argument('--index', type=str, default='./blacklist.db', help='Path of the URL index shared with repo_scanner, already seen URLs are not written again')
+    parser.add_argument('--concurrency', type=int, default=1, help='Search this many keywords at the same time, paced by the rate limit headers instead of fixed sleeps (optional)')
+    parser.add_argument('--no_partition', action='store_true', help='Do not split queries with more than 1000 results into star/date slices (optional)')
+    parser.add_argument('--slice_workers', type=int, default=4, help='Number of slices of one keyword collected at the same time (optional)')
+    parser.add_argument('--schedule', type=str, default='yield', choices=('yield', 'list'), help='Search the keywords expected to find the most new repositories per API call first, or in list order (optional)')
+    parser.add_argument('--min_yield', type=float, default=1.0, help='Keywords expected to find fewer new repositories per API call are low-yield (optional)')
+    parser.add_argument('--skip_low_yield', action='store_true', help='Do not search low-yield keywords at all, instead of searching them last (optional)')
+    parser.add_argument('--incremental', action='store_true', help='Only fetch repositories pushed to (or created) since the last run of each query, as new batches (optional)')
+    parser.add_argument('--watermark', type=str, default='pushed', choices=tuple(FIELDS), help='With --incremental: fetch new and updated repositories (pushed), or only new ones (created) (optional)')
+    parser.add_argument('--cache', type=str, default=None, help='Cache search responses in this database, e.g. ./http_cache.db; off by default (optional)')
+    parser.add_argument('--cache_ttl', type=int, default=86400, help='Seconds a cached search page is used before it is revalidated (optional)')
+    parser.add_argument('--cache_max_mb', type=int, default=500, help='Size of the HTTP response cache (optional)')
+    parser.add_argument('--api_url', type=str, default=API_URL, help='Base URL of the GitHub API, e.g. a local fake_github_api.py server (optional)')
 
     example_usage = """
     This tool will search for GitHub repositories based on the provided
@@ -326,65 +1151,226 @@ if __name__ == "__main__":
     """
 
     parser.epilog = example_usage
+    metrics.add_arguments(parser)
+    log_utils.add_arguments(parser)
     args = parser.parse_args()
+    log_utils.setup_from_args(args)
     min_stars = args.min_stars
     max_stars = args.max_stars
     language = args.language
-    token = args.token
-    file_batch_index = args.file_batch_index
-    starting_point = args.starting_point
+    tokens = load_tokens(args.token, args.token_file)
+    if not tokens:
+        parser.error("give at least one token with --token or --token_file")
     output_path = args.out
+    checkpoint_path = args.checkpoint or os.path.join(output_path, "collector_checkpoint.json")
+    if args.file_batch_index is not None or args.starting_point is not None:
+        # explicit positions start over
+        remove_checkpoint(checkpoint_path)
+    file_batch_index = args.file_batch_index
+    if file_batch_index is None:
+        # incremental runs add their batches after the existing ones
+        file_batch_index = last_batch_index(output_path) if args.incremental else 0
+    starting_point = args.starting_point or keyword_list[0]
 
-    # check that output path exists and token is valid
+    # one pooled session for everything, big enough for all parallel searches
+    configure_session(args.api_url, max(args.concurrency, args.slice_workers),
+                      args.cache, args.cache_ttl, args.cache_max_mb)
+
+    # check that output path exists and the tokens are valid
     if not os.path.exists(output_path):
         os.makedirs(output_path)
-    elif os.listdir(output_path):
-        print("Warning: The output directory is not empty. You have 5 seconds to abort.")
+    resuming = not args.no_checkpoint and os.path.exists(checkpoint_path)
+    if not resuming and not args.incremental and os.listdir(output_path):
+        logger.warning("The output directory is not empty. You have 5 seconds to abort.")
         time.sleep(5)
-    if not check_authentication(token):
-        print("Exiting.")
+    if not check_authentication(tokens):
+        logger.error("Exiting.")
         exit()
 
-    # for statistics
-    global_count = 0
+    checkpoint = None if args.no_checkpoint else CollectorCheckpoint(checkpoint_path)
+    store = RepoStore(args.store or os.path.join(output_path, "repos.db"))
 
-    # main loop
-    reached_starting_point = False
-    for term in keyword_list:
+    # in sequential mode every token sends at most one request per second
+    tokens = TokenPool(tokens, min_interval=1.0 if args.concurrency <= 1 else 0.0)
 
-        if term == starting_point:
-            # skip all keywords until starting_point is reached
-            reached_starting_point = True
+    # URLs written by earlier batches/runs, and URLs the scanner already processed
+    collected = UrlIndex(args.index, "collected")
+    scanned = UrlIndex(args.index, "scanned")
 
-        if term != starting_point and not reached_starting_point:
-            # skip all keywords until starting_point is reached
-            print(f"Skipping term: {term} to resume at set starting point ({starting_point})")
-            continue
+    # what is searched for every keyword: with --incremental, only what changed since its watermark
+    watermarks = Watermarks(args.index, args.watermark) if args.incremental else None
+    base_queries = {term: build_query(term, language, min_stars, max_stars) for term in keyword_list}
+    if watermarks is not None:
+        queries = {term: watermarks.qualify(term, base_queries[term]) for term in keyword_list}
+    else:
+        queries = {term: term for term in keyword_list}
+
+    def advance_watermark(term, repositories, complete):
+        # only a keyword whose results were all collected moves on, otherwise the next pass searches the same range again
+        if complete:
+            watermarks.advance(base_queries[term], repositories)
+        else:
+            logger.warning(f"{term}: not all results were collected, its watermark is left where it was")
+
+    # skip all keywords until starting_point is reached
+    if starting_point in keyword_list:
+        terms = keyword_list[keyword_list.index(starting_point):]
+    else:
+        logger.warning(f"Starting point {starting_point} is not a keyword, searching all keywords.")
+        terms = keyword_list
+
+    if resuming:
+        interrupted = checkpoint.interrupted_write()
+        if interrupted is not None and os.path.exists(
+                os.path.join(output_path, f"repositories_{interrupted['file_batch_index']}.csv")):
+            # the batch was committed right before the stop
+            term = interrupted["term"]
+            repositories = checkpoint.collected(queries[term])
+            complete = checkpoint.complete(queries[term])
+            checkpoint.keyword_done(term, interrupted["file_batch_index"], queries[term])
+            if watermarks is not None:
+                advance_watermark(term, repositories, complete)
+        file_batch_index = checkpoint.file_batch_index
+        done = checkpoint.done_keywords()
+        if args.incremental and all(term in done for term in terms):
+            # the previous pass is complete, look for what changed since
+            checkpoint.next_pass()
+            done = set()
+            logger.info(f"Starting a new incremental pass after batch {file_batch_index}")
+        terms = [term for term in terms if term not in done]
+        logger.info(f"Resuming from {checkpoint_path}: {len(done)} keyword(s) done, next batch is {file_batch_index + 1}")
+    elif checkpoint is not None:
+        checkpoint.start(file_batch_index)
+    if not terms:
+        logger.log(log_utils.RESULT, "All keywords are done, pass --starting_point or --file_batch_index to start over.")
+
+    # the yield of every keyword is kept next to the URL index
+    scheduler = KeywordScheduler(args.index, args.min_yield)
+    # what does not count as new: with --incremental, everything found was created or pushed to since the last pass
+    known = () if watermarks is not None else collected
+    totals = {}
+    if args.schedule == "yield" and terms:
+        # one request per keyword, paid back by the keywords that are not worth searching
+        logger.info(f"Probing {len(terms)} keyword(s) to order them by expected yield")
+        with metrics.timer("keyword_probe"), ThreadPoolExecutor(max_workers=args.slice_workers) as executor:
+            probes = executor.map(lambda term: probe_keyword(tokens, queries[term], language, min_stars, max_stars), terms)
+            for term, (total_count, sample) in zip(terms, probes):
+                scheduler.probe(term, total_count, sample)
+                totals[queries[term]] = total_count
+
+    def finish_keyword(term, batch_index, repositories):
+        # writes the batch of a keyword and moves the checkpoint (and its watermark) past it
+        complete = is_complete(queries[term]) and (checkpoint is None or checkpoint.complete(queries[term]))
+        if checkpoint is not None:
+            checkpoint.writing(term, batch_index)
+        new = write_batch(output_path, batch_index, repositories, collected, scanned, store, term,
+                          rescan_updated=args.incremental and args.watermark == "pushed")
+        if checkpoint is not None:
+            checkpoint.keyword_done(term, batch_index, queries[term])
+        if watermarks is not None:
+            advance_watermark(term, repositories, complete)
+        with api_calls_lock:
+            calls = api_calls[queries[term]]
+        scheduler.record(term, calls, len(repositories), new)
+
+    def skip_low_yield(remaining):
+        # logs the keywords that are left out
+        logger.log(log_utils.RESULT, f"Skipping {len(remaining)} low-yield keyword(s): {', '.join(remaining)}",
+                   extra={"min_yield": args.min_yield})
 
-        # process keyword : search for it
-        print(f"currently at: {term}, already collected: {global_count} repos")
-        repositories = search_github_repositories(token, 
-                                                  term,
-                                                  language=language,
-                                                  min_stars=min_stars,
-                                                  max_stars=max_stars)
-        
+    with metrics.export_from_args(args), log_utils.Progress("collect", total=len(terms), unit="keywords") as progress:
         # for statistics
-        global_count += len(repositories)
+        global_count = 0
 
-        # increment output csv number
-        file_batch_index += 1
-        print(f"Increase file_batch_index to {file_batch_index}")
+        if args.concurrency > 1:
+            # async mode: several keywords at once, each written as soon as it is done
+            terms_by_query = {queries[term]: term for term in terms}
 
-        # construct output path
-        output_path_iteration = Path(output_path) / f"repositories_{file_batch_index}.csv"
+            def on_result(query, repositories):
+                nonlocal file_batch_index, global_count
+                term = terms_by_query[query]
+                global_count += len(repositories)
+                file_batch_index += 1
+                logger.info(f"Finished {term} ({len(repositories)} repos), writing batch {file_batch_index}")
+                progress.update(repos=len(repositories))
+                finish_keyword(term, file_batch_index, repositories)
 
-        # actually write to csv at output path
-        for repo_info in repositories:
-            stars, url, name = repo_info
-            append_to_csv(output_path_iteration, f"{name}, {stars}, {url}\n")
+            # the order is fixed up front, keywords finish out of order anyway
+            if args.schedule == "yield":
+                terms = scheduler.order(terms, known)
+            if args.skip_low_yield:
+                low = [term for term in terms if scheduler.is_low_yield(term, known)]
+                if low:
+                    skip_low_yield(low)
+                    terms = [term for term in terms if term not in low]
+            asyncio.run(collect_async(tokens, [queries[term] for term in terms], args.concurrency, language, min_stars, max_stars, on_result,
+                                      partition=not args.no_partition, checkpoint=checkpoint, totals=totals))
+            logger.log(log_utils.RESULT, f"Done, collected {global_count} repos.")
+            scheduler.close()
+            if watermarks is not None:
+                watermarks.close()
+            report_cache()
+            return
 
-        print(f"Repositories appended to '{output_path_iteration}'")
-        remove_duplicates_and_save(output_path_iteration)
-        print("Sleeping for 60s before searching for next keyword...")
-        time.sleep(60)
+        # main loop
+        remaining = list(terms)
+        while remaining:
+            # re-estimated after every keyword, against everything collected so far
+            term = scheduler.next(remaining, known, reorder=args.schedule == "yield",
+                                  skip_low_yield=args.skip_low_yield)
+            if term is None:
+                skip_low_yield(remaining)
+                break
+            remaining.remove(term)
+
+            # process keyword : search for it
+            logger.info(f"currently at: {term}, already collected: {global_count} repos",
+                        extra={"expected_yield": scheduler.estimate(term, known)})
+            repositories = collect_keyword(tokens,
+                                           queries[term],
+                                           language,
+                                           min_stars,
+                                           max_stars,
+                                           partition=not args.no_partition,
+                                           workers=args.slice_workers,
+                                           checkpoint=checkpoint,
+                                           known_total=totals.get(queries[term]))
+
+            # for statistics
+            global_count += len(repositories)
+
+            # increment output csv number
+            file_batch_index += 1
+            logger.debug(f"Increase file_batch_index to {file_batch_index}")
+
+            finish_keyword(term, file_batch_index, repositories)
+            progress.update(repos=len(repositories))
+
+        scheduler.close()
+        if watermarks is not None:
+            watermarks.close()
+        report_cache()
+
+
+def last_batch_index(output_path):
+    """
+    Returns:
+        int: The highest n of the `repositories_{n}.csv` files in a directory, 0 if there are none.
+    """
+    if not os.path.isdir(output_path):
+        return 0
+    indices = [int(match.group(1)) for match in
+               (re.match(r'repositories_(\d+)\.csv$', name) for name in os.listdir(output_path)) if match]
+    return max(indices, default=0)
+
+
+def report_cache():
+    """
+    Prints the cache hit/miss counts, if the cache is used.
+    """
+    if isinstance(session, CachedSession):
+        session.report()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,52 +1,209 @@
 import csv
+import json
+import logging
 import os
+import re
 import shutil
-import subprocess
+import threading
 import time
 import argparse
-import os
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from itertools import islice
+
+import git_runner
+import log_utils
+import metrics
+from checkpoint import ScannerCheckpoint, release_interrupted
+from git_runner import OTHER, TOO_BIG, CloneLimits, FailureLog, GitFailed, retry, run_git, time_left
+from repo_store import ORDER_COLUMNS, RepoStore, csv_row, pushed_cutoff
+from result_cache import ResultCache, local_head, remote_head
+from rules import load_rules
+import scan_engine
+from scan_engine import PatternMatcher, WalkOptions, scan_tree, walk_tree
+from shards import in_shard, parse_shard, shard_path
+from tarball_fetch import HTTP_TIMEOUT, TARBALL_URL, TarballFetcher, TarballTooBig
+from url_index import open_blacklist
+from workspace import KEEP_MODES, MB, Workspace, WorkspaceFull
 
 # brief functionality explanation:
 # go through a .csv file with links to github repositories
 # for each link :
 # clone the repo (first append .git to the link)
-# check if the code uses Flask
-# check if the code contains the function/string "render_template_string"
-# if both is true, print the repository name and the file path
+# check it against the rules (rules.py, by default: the code uses Flask
+# and contains the function/string "render_template_string")
+# if a rule matches, print the repository name and the file paths
 # delete the cloned repository (could also keep if match)
 # continue this until 100 repos that match the condition were found
+# (with --workers N, N repos are cloned and scanned at the same time)
+
+logger = logging.getLogger(__name__)
+
+# seconds each worker waits before cloning, to stay polite towards github
+# (0 for local repositories, see benchmark.py)
+CLONE_DELAY = 3
+
+# hits can be recorded from several threads (see pipeline.py)
+hits_lock = threading.Lock()
+# where hits are recorded (one file per shard, set in main())
+hits_path = "hits.txt"
+# appended to the hit files of results taken from the result cache
+CACHED_MARK = " (cached)"
+
+# (i, N) with --shard i/N: only repositories of this shard are processed (see shards.py)
+shard = None
+
+# metadata of the batches (see repo_store.py), and the conditions repos are selected by,
+# e.g. {"skip_forks": True, "pushed_within_days": 365}; set in main()
+store = None
+filters = {}
+
+# scan results per (url, commit, rules), set in main() if --result_cache is given
+result_cache = None
+# with the result cache, go through blacklisted repos again (unchanged ones are not cloned)
+rescan = False
 
+# where clones go, under a disk budget (set in main())
+workspace = None
 
-def clone_repository(repo_url, destination, blacklist):
+# everything the scanner looks for, all rules are evaluated in a single pass per repo
+# (replaced in main() if a rules file is given)
+ruleset = load_rules()
+
+# which files of a checkout are scanned (see scan_engine.py), set in main()
+walk_options = WalkOptions()
+
+# with --fetch tarball: repositories are streamed and scanned in memory instead of cloned
+# (see tarball_fetch.py), set in main()
+tarballs = None
+
+# timeouts and retries of clones (see git_runner.py), set in main()
+clone_limits = CloneLimits()
+# repositories that failed permanently (not found, auth, too big), never tried again; set in main()
+failures = None
+
+
+def claim_repository(repo_url, blacklist):
+    """
+    Marks a repository as processed, unless it already is on the blacklist.
+
+    Args:
+        repo_url (str): The URL of the repository.
+        blacklist (UrlIndex): The shared index of already processed URLs.
+
+    Returns:
+        bool: True if the repository was not processed before, False otherwise.
+    """
+    if failures is not None and repo_url in failures:
+        logger.debug("failed permanently before, skipping", extra={"url": repo_url})
+        return False
+    if not blacklist.add(repo_url) and not rescan:
+        logger.debug("already processed this one", extra={"url": repo_url})
+        return False
+    return True
+
+
+def record_failure(repo_name, repo_url, failure, blacklist):
+    """
+    Handles a repository that could not be cloned (or downloaded): permanent
+    failures are recorded so it is never tried again, others are taken off
+    the blacklist so a later run tries again.
+
+    Args:
+        repo_name (str): The name of the repository.
+        repo_url (str): The URL of the repository.
+        failure (GitFailed): What went wrong.
+        blacklist (UrlIndex): The shared index of already processed URLs.
+    """
+    metrics.inc(f"failures_{failure.kind}")
+    if failure.permanent:
+        # left out of the throughput (see handle_report)
+        metrics.inc("repos_failed_permanently")
+        if failures is not None:
+            failures.record(repo_url, failure)
+        logger.warning("repository failed permanently, not trying it again",
+                       extra={"repo": repo_name, "kind": failure.kind, "error": failure.message})
+    else:
+        blacklist.discard(repo_url)
+        logger.warning("error cloning repository", extra={"url": repo_url, "kind": failure.kind,
+                                                          "error": failure.message})
+
+
+def clone_repository(repo_url, destination, blob_limit=None, sparse_patterns=None):
     """
     Clones a repository from the given `repo_url` to the specified `destination` directory.
-    (Only if not on blacklist)
+    Only the latest commit of the default branch is fetched.
 
     Args:
-        github_token (str): The GitHub token used for authentication.
         repo_url (str): The URL of the repository to clone.
         destination (str): The directory where the repository will be cloned.
+        blob_limit (str, optional): Skip files bigger than this (git size, e.g. "1m"). Defaults to None.
+        sparse_patterns (list, optional): Only check out files matching these patterns (e.g. "*.py"). Defaults to None.
 
     Returns:
-        bool: True if the repository was cloned successfully, False otherwise.
+        bool: True once the repository is cloned.
+
+    Raises:
+        GitFailed: The clone failed (after retrying network errors) or took longer than clone_limits.timeout.
     """
     repo_url = repo_url.strip()
 
-    if repo_url in blacklist:
-        print("already processed this one.")
-        return False
-    else:
-        blacklist.append(repo_url)
-        with open("blacklist.txt", 'a') as file:
-            file.write(repo_url + '\n')
+    command = ['clone', '--quiet', '--depth', '1', '--single-branch']
+    if blob_limit:
+        command.append(f'--filter=blob:limit={blob_limit}')
+    elif sparse_patterns:
+        command.append('--filter=blob:none')
+    if blob_limit or sparse_patterns:
+        # files are checked out below, once we know which ones we want
+        command.append('--no-checkout')
+    command += [f'{repo_url}.git', destination]
+
+    def attempt(number):
+        if number:
+            # whatever the failed attempt left behind
+            shutil.rmtree(destination, ignore_errors=True)
+            os.makedirs(destination, exist_ok=True)
+        # the timeout is for the whole clone, including the checkout
+        deadline = time.monotonic() + clone_limits.timeout if clone_limits.timeout else None
+        run_git(command, time_left(deadline), clone_limits)
+        if blob_limit or sparse_patterns:
+            checkout_partial(destination, blob_limit, sparse_patterns, deadline)
+
+    retry(attempt, clone_limits, f"cloning {repo_url}")
+    logger.debug("repository cloned", extra={"destination": destination})
+    return True
+
+
+def checkout_partial(repo_path, blob_limit=None, sparse_patterns=None, deadline=None):
+    """
+    Checks out a repository cloned with `--no-checkout`, restricted to the sparse
+    patterns and without the files that were left out by the blob filter
+    (otherwise git would lazily download them during checkout).
 
-    try:
-        subprocess.run(['git', 'clone', f'{repo_url}.git', destination], check=True)
-        print(f"Repository cloned successfully to: {destination}")
-        return True
-    except subprocess.CalledProcessError as e:
-        print(f"Error cloning repository {repo_url}: {e}")
-        return False
+    Args:
+        repo_path (str): The path to the cloned repository.
+        blob_limit (str, optional): The blob size limit used for cloning. Defaults to None.
+        sparse_patterns (list, optional): Only check out files matching these patterns. Defaults to None.
+        deadline (float, optional): time.monotonic() by which it has to be done. Defaults to None.
+    """
+    patterns = list(sparse_patterns or ['/*'])
+
+    if blob_limit:
+        # objects the filter left out, "?<oid>" per line
+        missing = run_git(['-C', repo_path, 'rev-list', '--objects', '--missing=print', 'HEAD'], time_left(deadline))
+        missing = {line[1:] for line in missing.splitlines() if line.startswith('?')}
+        if missing:
+            tree = run_git(['-C', repo_path, 'ls-tree', '-r', '-z', 'HEAD'], time_left(deadline))
+            for entry in tree.split('\0'):
+                if not entry:
+                    continue
+                info, file_path = entry.split('\t', 1)
+                if info.split()[2] in missing:
+                    patterns.append('!/' + re.sub(r'([\\*?\[\]!#])', r'\\\1', file_path))
+
+    run_git(['-C', repo_path, 'sparse-checkout', 'set', '--no-cone', *patterns], time_left(deadline))
+    # fetches the blobs of the files that are checked out
+    run_git(['-C', repo_path, 'checkout'], time_left(deadline), clone_limits)
 
 
 def grep(repo_path, string):
@@ -59,23 +216,12 @@ def grep(repo_path, string):
     Returns:
         list: A list of file paths that contain the provided string.
     """
-    files_that_match = []
-
-    for root, dirs, files in os.walk(repo_path):
-        for file in files:
-            file_path = os.path.join(root, file)
-            with open(file_path, 'r', encoding='utf-8', errors='ignore') as f:
-                content = f.read()
-
-            if string in content:
-                files_that_match.append(file_path)
-
-    return files_that_match
+    return scan_tree(repo_path, PatternMatcher(literals=[string]), walk_options)[string]
 
 
 def get_folder_size(folder_path):
     """
-    Calculate the total size of a folder and its subfolders.
+    Calculate the total size of a folder and its subfolders (ignoring .git).
 
     Args:
         folder_path (str): The path to the folder.
@@ -83,83 +229,359 @@ def get_folder_size(folder_path):
     Returns:
         int: The total size of the folder in bytes.
     """
-    total_size = 0
-    for dirpath, dirnames, filenames in os.walk(folder_path):
-        for filename in filenames:
-            filepath = os.path.join(dirpath, filename)
-            total_size += os.path.getsize(filepath)
-    return total_size
+    return walk_tree(folder_path, walk_options).size
+
+
+def git_size(repo_path):
+    """
+    Returns:
+        int: The size of the .git directory of a clone in bytes (what was downloaded).
+    """
+    return walk_tree(repo_path, walk_options).git_size
+
+
+def remove_checkout(repo_path):
+    """
+    Deletes a clone in the background (timed as the cleanup stage by the workspace's reaper).
+    """
+    workspace.release(repo_path)
 
 
-def handle_report(path, report_number, blacklist):
+def process_repository(row, blacklist, max_size_mb=100, clone_options=None):
+    """
+    Clones a single repository from a CSV row, checks it for the conditions and
+    cleans up afterwards. Safe to run from several worker threads at once.
+
+    Args:
+        row (list): The CSV row (name, stars, url[, size in KB]).
+        blacklist (UrlIndex): The shared index of already processed URLs.
+        max_size_mb (int, optional): Repositories bigger than this are skipped. Defaults to 100.
+        clone_options (dict, optional): Extra keyword arguments for clone_repository. Defaults to None.
+
+    Returns:
+        list: The file paths that meet the conditions (empty if none).
+    """
+    repo_name, repo_url = row[0], row[2]
+    repo_destination = workspace.path(repo_name, repo_url)
+
+    logger.debug("examining repository", extra={"url": repo_url})
+    metrics.inc("repos")
+
+    if not claim_repository(repo_url, blacklist):
+        return []
+
+    # the collector stores the size reported by github (in KB), so oversized
+    # repos can be skipped before anything is downloaded
+    expected_size = max_size_mb * MB
+    if len(row) > 3 and row[3].strip():
+        mbsize = int(row[3]) / 1024
+        if mbsize > max_size_mb:
+            logger.info("repo too big according to github, not cloning", extra={"repo": repo_name, "mb": mbsize})
+            record_failure(repo_name, repo_url, GitFailed(TOO_BIG, f"{mbsize:.0f} MB according to github"), blacklist)
+            return []
+        # github's size is about the packed history, the checkout is about as big again
+        expected_size = int(row[3]) * 1024 * 2
+
+    # unchanged commit and rules: use the result of an earlier scan instead of cloning
+    view = json.dumps({**(clone_options or {}), **walk_options.view()} if tarballs is None
+                      else {**walk_options.view(), "fetch": "tarball"}, sort_keys=True)
+    # (only asked now, repositories github says are too big were rejected above)
+    if result_cache is not None:
+        try:
+            sha = remote_head(repo_url, clone_limits)
+        except GitFailed as e:
+            if e.kind != OTHER:
+                # a clone would fail the same way (deleted, timed out, ...)
+                record_failure(repo_name, repo_url, e, blacklist)
+                return []
+            logger.debug("could not ask for the HEAD commit, cloning", extra={"repo": repo_name, "error": e.message})
+            sha = None
+        cached = result_cache.lookup(repo_url, sha, ruleset, view) if sha else None
+        if cached is not None:
+            logger.info("unchanged since it was scanned, using cached result", extra={"repo": repo_name, "sha": sha[:10]})
+            return cached_hit_files(repo_url, repo_destination, cached)
+
+    # throttle each worker so we stay polite towards github
+    time.sleep(CLONE_DELAY)
+
+    if tarballs is not None:
+        return stream_repository(repo_name, repo_url, repo_destination, blacklist, max_size_mb, view)
+
+    # waits until the clone fits into the disk budget
+    workspace.reserve(repo_destination, expected_size)
+
+    start = time.perf_counter()
+    try:
+        clone_repository(repo_url, repo_destination, **(clone_options or {}))
+    except GitFailed as e:
+        # timed separately, failures would skew the clone times
+        metrics.observe("clone_failed", time.perf_counter() - start)
+        record_failure(repo_name, repo_url, e, blacklist)
+        remove_checkout(repo_destination)
+        return []
+    metrics.observe("clone", time.perf_counter() - start)
+    logger.debug("checking repository", extra={"repo": repo_name, "rules": ruleset.names})
+
+    # check if the repo is "small" enough so the search doesnt crash us
+    # (csv files without the github size column are only checked here)
+    try:
+        # one walk measures the clone and lists the files to scan
+        with metrics.timer("size"):
+            tree = walk_tree(repo_destination, walk_options)
+        cloned_bytes, size = tree.git_size, tree.size
+        metrics.inc("repos_cloned")
+        metrics.inc("bytes_cloned", cloned_bytes)
+        mbsize = (size/1024)/1024
+        workspace.measured(repo_destination, cloned_bytes + size)
+        logger.debug("checked out", extra={"repo": repo_name, "mb": mbsize})
+    except:
+        mbsize = None
+
+    if mbsize is None or mbsize > max_size_mb:
+        logger.info("repo too big (or size not measurable)", extra={"repo": repo_name, "mb": mbsize})
+        if mbsize is not None:
+            record_failure(repo_name, repo_url, GitFailed(TOO_BIG, f"{mbsize:.0f} MB checked out"), blacklist)
+        remove_checkout(repo_destination)
+        return []
+
+    try:
+        # one pass over the repo for all rules
+        with metrics.timer("scan"):
+            result = ruleset.scan_tree(repo_destination, walk_options, tree)
+        if result_cache is not None:
+            sha = local_head(repo_destination)
+            if sha:
+                result_cache.store(repo_url, sha, ruleset, result, view)
+
+        if result.hits:
+            logger.info("repository meets the conditions", extra={"repo": repo_name, "rules": list(result.hits)})
+            metrics.inc("hits")
+            return workspace.keep(repo_destination, result.hit_files(repo_destination))
+        else:
+            logger.debug("repository does not meet the conditions, deleting", extra={"repo": repo_name})
+            remove_checkout(repo_destination)
+
+    except Exception as e:
+        logger.warning("encountered error, skipping", extra={"repo": repo_name, "error": str(e)})
+        remove_checkout(repo_destination)
+
+    return []
+
+
+def stream_repository(repo_name, repo_url, repo_destination, blacklist, max_size_mb, view):
+    """
+    Scans a repository from its tarball, in memory. Only the matching files of
+    a hit are written to disk (to the hits directory).
+
+    Args:
+        repo_name (str): The name of the repository.
+        repo_url (str): The URL of the repository.
+        repo_destination (str): Where a clone would go, names the archive of a hit.
+        blacklist (UrlIndex): The shared index of already processed URLs.
+        max_size_mb (int): The download is aborted once the repository gets bigger than this.
+        view (str): The scan options, for the result cache.
+
+    Returns:
+        list: Where the matching files are kept (empty if none).
+    """
+    start = time.perf_counter()
+    try:
+        scan = retry(lambda number: tarballs.scan(repo_url, ruleset, walk_options, max_size_mb * MB, name=repo_name),
+                     clone_limits, f"downloading {repo_url}")
+    except GitFailed as e:
+        metrics.observe("stream_failed", time.perf_counter() - start)
+        if isinstance(e, TarballTooBig):
+            metrics.inc("downloads_aborted")
+        record_failure(repo_name, repo_url, e, blacklist)
+        return []
+    metrics.observe("stream", time.perf_counter() - start)
+
+    metrics.inc("repos_cloned")
+    metrics.inc("bytes_cloned", scan.downloaded)
+    metrics.inc("files_scanned", scan.files_scanned)
+    metrics.inc("bytes_scanned", scan.bytes_scanned)
+    for reason, count in scan.skipped.items():
+        metrics.inc(f"files_skipped_{reason}", count)
+    if result_cache is not None and scan.sha:
+        result_cache.store(repo_url, scan.sha, ruleset, scan.result, view)
+
+    if not scan.result.hits:
+        logger.debug("repository does not meet the conditions", extra={"repo": repo_name})
+        return []
+    logger.info("repository meets the conditions", extra={"repo": repo_name, "rules": list(scan.result.hits)})
+    metrics.inc("hits")
+    hit_files = {os.path.relpath(file_path, repo_destination) for file_path in scan.result.hit_files(repo_destination)}
+    missing = hit_files - set(scan.contents)
+    if missing:
+        # hits of rules without patterns (e.g. only a glob), their content was not kept
+        logger.warning("some hit files were not kept", extra={"repo": repo_name, "files": sorted(missing)})
+    return workspace.keep_contents(repo_destination, {relative_path: scan.contents[relative_path]
+                                                      for relative_path in hit_files - missing})
+
+
+def cached_hit_files(repo_url, repo_destination, result):
+    """
+    Lists the hit files of a cached result. Nothing was cloned, so a file is
+    given where an earlier run kept it, or as `<url>#<file>` if it is not kept
+    anymore. Every entry ends with CACHED_MARK.
+
+    Args:
+        repo_url (str): The URL of the repository.
+        repo_destination (str): The clone directory of the repository.
+        result (RepoScan): The cached result.
+
+    Returns:
+        list: The hit files (empty if none).
+    """
+    hit_files = []
+    for file_path in result.hit_files(repo_destination):
+        relative_path = os.path.relpath(file_path, repo_destination)
+        location = workspace.kept_location(repo_destination, relative_path) or f"{repo_url.strip()}#{relative_path}"
+        hit_files.append(location + CACHED_MARK)
+    if hit_files:
+        metrics.inc("hits_cached")
+    return hit_files
+
+
+def is_cached(hit_files):
+    """
+    Returns:
+        bool: True if the hit files come from the result cache (see cached_hit_files).
+    """
+    return bool(hit_files) and all(file_path.endswith(CACHED_MARK) for file_path in hit_files)
+
+
+def record_hits(hit_files, hits_file=None):
+    """
+    Appends the files of a repository that met the conditions to the hits file.
+
+    Args:
+        hit_files (list): The file paths that meet the conditions.
+        hits_file (str, optional): The path of the hits file. Defaults to `hits_path`.
+    """
+    with hits_lock:
+        with open(hits_file or hits_path, 'a') as file:
+            # log matching files to hits.txt
+            file.write(''.join(file_path + '\n' for file_path in hit_files))
+
+
+def handle_report(path, report_number, blacklist, workers=1, max_hits=100, max_size_mb=100, clone_options=None,
+                  checkpoint=None):
+    """
+    Processes all repositories of one CSV report, using a bounded pool of workers.
+
+    Results are consumed in CSV order, so hits.txt is written in the same order
+    regardless of the number of workers and runs can be compared.
+    With a checkpoint, a report that was interrupted continues after the last
+    consumed row: finished results are used as they are, and repositories that
+    were still being processed are released and processed again.
+
+    Args:
+        path (str): The directory containing the CSV files.
+        report_number (int): The number of the CSV file to process.
+        blacklist (UrlIndex): The shared index of already processed URLs.
+        workers (int, optional): The number of repositories processed in parallel. Defaults to 1.
+        max_hits (int, optional): Stop after this many repositories met the conditions. Defaults to 100.
+        max_size_mb (int, optional): Repositories bigger than this are skipped. Defaults to 100.
+        clone_options (dict, optional): Extra keyword arguments for clone_repository. Defaults to None.
+        checkpoint (ScannerCheckpoint, optional): Records the progress, and resumes from it. Defaults to None.
+    """
     csv_file_path = os.path.join(path, f'repositories_{report_number}.csv')
 
-    with open(csv_file_path, 'r') as csv_file:
-        csv_reader = csv.reader(csv_file)
-        #next(csv_reader)  # there is no header to skip
-
-        repos_found = 0
-        for row in csv_reader:
-            time.sleep(3)
-            if repos_found >= 100:
-                break  # Stop if 100 repos are found (have to manually check them)
-
-            repo_name, stars, repo_url = row[0], row[1], row[2]
-            repo_destination = './tmp/' + repo_name
-
-            if not os.path.exists(repo_destination):
-                os.makedirs(repo_destination)
-
-
-            print(f"Examining repository: {repo_url}")
-
-            if clone_repository(repo_url, repo_destination, blacklist):
-                print(f"Checking repository {repo_name} for Flask and render_template_string")
-
-                # check if the repo is "small" enough so the search doesnt crash us
-                # this size estimate is not very precise
-                # and it would be better to check before cloning (obv)
-                try:
-                    size = get_folder_size(repo_destination)
-                    mbsize = (size/1024)/1024
-                    print("size (mb):", mbsize)
-                except:
-                    mbsize = 101
-
-                if mbsize > 100:
-                    print("repo too big...(or size not measurable)")
-                    shutil.rmtree(repo_destination)
-                else:
-                    try:
-
-                        render_template_files = grep(repo_destination, "render_template_string")
-                        flask_files = grep(repo_destination, "flask")
-
-                        if len(flask_files) >= 1:
-                            print(f"Flask found in {repo_name}")
-
-                            if render_template_files:
-                                print(f"Repository {repo_name} meets the conditions! Render template found in:")
-                                for file_path in render_template_files:
-                                    print(f"- {file_path}")
-                                    # log files with render usage to hits.txt
-                                    with open("hits.txt", 'a') as file:
-                                        file.write(file_path + '\n')
-                                repos_found += 1
-                            else:
-                                print(f"Repository {repo_name} does not meet the conditions. Deleting...")
-                                shutil.rmtree(repo_destination)
-                        else:
-                            print(f"Flask not found in {repo_name}")
-                            shutil.rmtree(repo_destination)
-
-                    except Exception as e:
-                        print("Encountered error (skipping): ", e)
-                        shutil.rmtree(repo_destination)
-
-                print("\n" + "=" * 40 + "\n")
-    
-    print(f"Found {repos_found} repositories meeting the conditions.")
+    offset, repos_found, failed, finished, interrupted = 0, 0, 0, {}, {}
+    if checkpoint is not None:
+        offset, repos_found, finished, interrupted = checkpoint.resume(report_number)
+
+    if store is not None and store.has_batch(report_number):
+        # filtered and ordered by the store, before anything is cloned
+        select_filters = dict(filters)
+        if "pushed_within_days" in select_filters:
+            # the same cutoff as before a restart, so the same rows are selected
+            pushed_since = pushed_cutoff(select_filters["pushed_within_days"])
+            select_filters["pushed_since"] = pushed_since if checkpoint is None else checkpoint.pushed_since(pushed_since)
+        rows = [csv_row(repo_info) for repo_info in store.select(report_number, max_size_mb=max_size_mb, **select_filters)]
+        logger.info(f"{len(rows)} repositories of repositories_{report_number}.csv match the filters")
+    else:
+        if filters:
+            logger.warning(f"no metadata for repositories_{report_number}.csv in the store, the filters are not applied")
+        with open(csv_file_path, 'r') as csv_file:
+            csv_reader = csv.reader(csv_file)
+            #next(csv_reader)  # there is no header to skip
+            rows = list(csv_reader)
+    if shard is not None:
+        # every shard reads all rows, and keeps its own
+        rows = [row for row in rows if len(row) > 2 and in_shard(row[2], shard)]
+        logger.info(f"{len(rows)} repositories of repositories_{report_number}.csv are in shard {shard[0]}/{shard[1]}")
+
+    if offset or finished or interrupted:
+        release_interrupted(interrupted, blacklist, workspace)
+        logger.info(f"Resuming repositories_{report_number}.csv at row {offset}",
+                    extra={"finished": len(finished), "interrupted": len(interrupted), "hits": repos_found})
+
+    with ThreadPoolExecutor(max_workers=workers) as executor, \
+            log_utils.Progress(f"report {report_number}", total=len(rows) - offset) as progress:
+        # keep at most `workers` repos in flight, in submission order
+        pending = deque()
+        rows_iter = islice(enumerate(rows), offset, None)
+        metrics.queue("scanner_in_flight", lambda: len(pending))
+
+        def submit(index, row):
+            if index in finished:
+                # finished before the restart, but not consumed yet
+                future = Future()
+                future.set_result(finished[index])
+                return future
+            if checkpoint is not None:
+                checkpoint.started(index, row)
+            future = executor.submit(process_repository, row, blacklist, max_size_mb, clone_options)
+            if checkpoint is not None:
+                future.add_done_callback(lambda done: record_finished(index, done))
+            return future
+
+        def record_finished(index, future):
+            # from the worker thread, so the result survives a stop before it is consumed
+            if future.exception() is None:
+                checkpoint.finished(index, future.result())
+
+        def fill():
+            for index, row in rows_iter:
+                pending.append((index, row, submit(index, row)))
+                if len(pending) >= workers:
+                    break
+
+        fill()
+        while pending:
+            index, row, future = pending.popleft()
+            hit_files = future.result()
+            recorded = bool(hit_files) and repos_found < max_hits
+
+            if hit_files and not recorded:
+                # finished after the limit was already reached, dont keep it (unless an earlier run kept it),
+                # and release the claim so a later run scans it again
+                if not is_cached(hit_files):
+                    workspace.discard(workspace.path(row[0], row[2]))
+                blacklist.discard(row[2])
+            elif recorded:
+                logger.log(log_utils.RESULT, f"Hit #{repos_found + 1}: {row[0]}",
+                           extra={"repo": row[0], "url": row[2], "files": hit_files, "cached": is_cached(hit_files)})
+                record_hits(hit_files)
+                repos_found += 1
+            if checkpoint is not None:
+                checkpoint.consumed(index, repos_found)
+            # permanent failures are not part of the throughput
+            permanent = not hit_files and failures is not None and row[2] in failures
+            failed += permanent
+            # hits dropped after max_hits are not counted
+            progress.update(hits=1 if recorded else 0, failed=1 if permanent else 0)
+
+            if repos_found < max_hits:
+                fill()
+            # otherwise stop submitting (have to manually check them), drain in-flight repos
+
+    if checkpoint is not None:
+        checkpoint.report_done(report_number)
+    logger.log(log_utils.RESULT, f"Found {repos_found} repositories meeting the conditions.",
+               extra={"report": report_number, "repos": len(rows), "hits": repos_found, "failed": failed})
 
 
 def wait_until_report(path, report_number):
@@ -173,17 +595,47 @@ def wait_until_report(path, report_number):
     Returns:
         None
     """
+    if not os.path.exists(os.path.join(path, f"repositories_{report_number}.csv")):
+        logger.info(f"File repositories_{report_number}.csv not found. Waiting...")
     while not os.path.exists(os.path.join(path, f"repositories_{report_number}.csv")):
-        print(f"File repositories_{report_number}.csv not found. Waiting...")
         time.sleep(5)
-    print(f"Found repositories_{report_number}.csv. Starting handling...")
+    logger.info(f"Found repositories_{report_number}.csv. Starting handling...")
 
 
 def main():
+    global ruleset, result_cache, rescan, workspace, hits_path, shard, store, filters, walk_options, tarballs, \
+        clone_limits, failures
+
     parser = argparse.ArgumentParser(description='Github Repository Scanner')
-    parser.add_argument('--file_batch_index', type=int, default=1, required=False, help='csv number to start processing at')
+    parser.add_argument('--file_batch_index', type=int, default=None, required=False, help='csv number to start processing at (optional, default: resume from the checkpoint, or 1)')
     # parser.add_argument('--token', type=str, required=True, help='GitHub auth token')
     parser.add_argument('--dir', type=str, required=True, help='Directory path containing the .csv files')
+    parser.add_argument('--index', type=str, default='./blacklist.db', help='Path of the blacklist database (shared with repo_collector)')
+    parser.add_argument('--rules', type=str, default=None, help='Rules file (TOML) describing what to look for, see rules.toml (optional, default: flask + render_template_string)')
+    parser.add_argument('--result_cache', type=str, default=None, help='Database of scan results per (url, commit, rules); unchanged repos are not cloned again (optional)')
+    parser.add_argument('--rescan', action='store_true', help='With --result_cache: process blacklisted repos again, e.g. for new rules (optional)')
+    parser.add_argument('--workers', type=int, default=1, help='Number of repositories cloned and scanned in parallel')
+    parser.add_argument('--max_size_mb', type=int, default=100, help='Skip repositories bigger than this (checked before cloning if the csv has the size column)')
+    parser.add_argument('--fetch', type=str, default='clone', choices=['clone', 'tarball'], help='Clone repositories, or stream their tarball and scan it in memory (optional)')
+    parser.add_argument('--tarball_url', type=str, default=TARBALL_URL, help='With --fetch tarball: where tarballs are downloaded from, {url} is the repository URL and {name} its name (optional)')
+    parser.add_argument('--blob_limit', type=str, default=None, help='Do not download files bigger than this, e.g. 1m (optional)')
+    parser.add_argument('--sparse', type=str, nargs='+', default=None, help='Only check out files matching these patterns, e.g. "*.py" "*.txt" (optional)')
+    parser.add_argument('--store', type=str, default=None, help='Metadata database written by repo_collector (optional, default: <dir>/repos.db if it exists)')
+    parser.add_argument('--skip_forks', action='store_true', help='With the store: do not clone forks (optional)')
+    parser.add_argument('--skip_archived', action='store_true', help='With the store: do not clone archived repositories (optional)')
+    parser.add_argument('--pushed_within_days', type=int, default=None, help='With the store: only repositories pushed to in the last N days (optional)')
+    parser.add_argument('--min_stars', type=int, default=None, help='With the store: only repositories with at least this many stars (optional)')
+    parser.add_argument('--topic', type=str, nargs='+', default=None, help='With the store: only repositories with one of these topics (optional)')
+    parser.add_argument('--order_by', type=str, default='batch', choices=list(ORDER_COLUMNS), help='With the store: order in which the repositories of a batch are processed (optional)')
+    parser.add_argument('--workspace', type=str, default='./tmp', help='Directory the repositories are cloned into, e.g. a tmpfs like /dev/shm/github_scan (optional)')
+    parser.add_argument('--disk_budget_mb', type=int, default=None, help='Maximum size of the workspace, clones wait until they fit (optional)')
+    parser.add_argument('--min_free_mb', type=int, default=1024, help='Do not start a clone that would leave less free disk space (optional)')
+    parser.add_argument('--keep_hits', type=str, default='checkout', choices=KEEP_MODES, help='Keep hits as the whole checkout, only the matching files, or a tarball (optional)')
+    parser.add_argument('--hits_dir', type=str, default='./hits', help='Where hits are archived with --keep_hits files/tarball (optional)')
+    parser.add_argument('--checkpoint', type=str, default='./scanner_checkpoint.json', help='Path of the checkpoint a restarted scanner resumes from (optional)')
+    parser.add_argument('--hits', type=str, default='hits.txt', help='File the matching files are appended to (optional)')
+    parser.add_argument('--shard', type=str, default=None, help='Only process the repositories of shard i out of N, e.g. 1/4; every shard keeps its own blacklist, hits, checkpoint and workspace (optional, see shards.py)')
+    parser.add_argument('--no_checkpoint', action='store_true', help='Do not write a checkpoint (optional)')
 
     example_usage = """
     This tool will clone each of the repositories in the provided CSV file
@@ -196,32 +648,91 @@ def main():
     """
 
     parser.epilog = example_usage
+    scan_engine.add_arguments(parser)
+    git_runner.add_arguments(parser)
+    metrics.add_arguments(parser)
+    log_utils.add_arguments(parser)
     args = parser.parse_args()
-    report_number = args.file_batch_index
+    log_utils.setup_from_args(args)
+    if args.shard is not None:
+        try:
+            shard = parse_shard(args.shard)
+        except ValueError as e:
+            parser.error(str(e))
+        # nodes sharing a filesystem never write to the same files
+        args.index, args.checkpoint, args.hits, args.workspace = (
+            shard_path(args.index, shard), shard_path(args.checkpoint, shard),
+            shard_path(args.hits, shard), shard_path(args.workspace, shard))
+        logger.info(f"Running as shard {shard[0]}/{shard[1]}", extra={"index": args.index, "hits": args.hits})
+    hits_path = args.hits
     path = args.dir
+    workers = max(1, args.workers)
+    clone_options = {'blob_limit': args.blob_limit, 'sparse_patterns': args.sparse}
+    ruleset = load_rules(args.rules)
+    walk_options = scan_engine.options_from_args(args)
+    workspace = Workspace(args.workspace, args.disk_budget_mb, args.min_free_mb, args.keep_hits, args.hits_dir)
+    clone_limits = git_runner.limits_from_args(args)
+    if args.fetch == 'tarball':
+        tarballs = TarballFetcher(args.tarball_url, pool_size=workers, max_seconds=clone_limits.timeout,
+                                  timeout=(HTTP_TIMEOUT[0], args.low_speed_time or HTTP_TIMEOUT[1]))
+        if args.gitignore or args.blob_limit or args.sparse:
+            logger.warning("--gitignore, --blob_limit and --sparse only apply to clones, not to --fetch tarball")
+    if args.result_cache:
+        result_cache = ResultCache(args.result_cache)
+        rescan = args.rescan
+    elif args.rescan:
+        logger.error("--rescan needs --result_cache, otherwise every repository would be cloned again.")
+        quit()
 
     # check if input path exists
     if not os.path.exists(path):
-        print(f"Directory path {path} does not exist.")
+        logger.error(f"Directory path {path} does not exist.")
+        quit()
+
+    # only the conditions that were given
+    filters = {name: value for name, value in [("skip_forks", args.skip_forks), ("skip_archived", args.skip_archived),
+                                               ("pushed_within_days", args.pushed_within_days),
+                                               ("min_stars", args.min_stars), ("topics", args.topic)]
+               if value is not None and value is not False}
+    if args.order_by != 'batch':
+        filters["order_by"] = args.order_by
+    store_path = args.store or os.path.join(path, "repos.db")
+    if os.path.exists(store_path):
+        store = RepoStore(store_path)
+    elif args.store is not None or filters:
+        logger.error(f"Store {store_path} does not exist, filtering needs the metadata written by repo_collector.")
         quit()
 
-    blacklist = []
-    # initialize blacklist from file, in case it exists
-    blacklist_file = './blacklist.txt'
-    if not os.path.exists(blacklist_file):
-        print(f"{blacklist_file} does not exist. Skipping initialization of blacklist from file."
-              " This is regular behaviour on fresh starts.")
+    # processed URLs, shared with other scanner processes using the same index
+    blacklist = open_blacklist(args.index)
+    failures = FailureLog(args.index, args.retry_failed)
+    logger.info(f"Initialized blacklist with {len(blacklist)} URLs.", extra={"failed_permanently": len(failures)})
+
+    checkpoint = None if args.no_checkpoint else ScannerCheckpoint(args.checkpoint)
+    if args.file_batch_index is not None:
+        report_number = args.file_batch_index
+    elif checkpoint is not None and checkpoint.report is not None:
+        report_number = checkpoint.report
+        logger.info(f"Resuming from {args.checkpoint} at repositories_{report_number}.csv")
     else:
-        with open(blacklist_file, 'r', encoding='utf-8', errors='ignore') as file:
-            tmp = list(file.readlines())
-            blacklist = [el.strip() for el in tmp]
-            print(f"Initialized blacklist with {len(blacklist)} URLs.")
+        report_number = 1
 
     # main loop
-    while True:
-        wait_until_report(path, report_number)
-        handle_report(path, report_number, blacklist)
-        report_number += 1
-    
+    with metrics.export_from_args(args):
+        while True:
+            with metrics.timer("wait_for_report"):
+                wait_until_report(path, report_number)
+            # the collector takes repositories with new commits off the blacklist (--incremental)
+            blacklist.reload()
+            try:
+                handle_report(path, report_number, blacklist, workers=workers,
+                              max_size_mb=args.max_size_mb, clone_options=clone_options, checkpoint=checkpoint)
+            except WorkspaceFull as e:
+                # the checkpoint has the repositories in flight, a restart continues with them
+                logger.error(str(e))
+                workspace.close()
+                quit()
+            report_number += 1
+
 if __name__ == "__main__":
     main()
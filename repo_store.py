@@ -0,0 +1,166 @@
+import json
+import sqlite3
+import threading
+import time
+from collections import namedtuple
+from datetime import datetime, timedelta, timezone
+
+# brief functionality explanation:
+# the metadata of collected repositories, kept next to the CSV files in an
+# indexed SQLite database (`<out>/repos.db`). the collector adds every batch
+# it writes; the scanner can then pick the repositories of a batch with a
+# query, e.g. no forks, smaller than 50 MB, pushed in the last year,
+# instead of re-parsing the CSV and cloning everything in it.
+
+# one repository as returned by the search API. the first four fields are
+# the CSV columns; the rest is only kept in the store
+RepoInfo = namedtuple("RepoInfo", ["stars", "url", "name", "size", "full_name", "pushed_at",
+                                   "default_branch", "fork", "archived", "topics", "created_at"],
+                      defaults=(None, None, None, None, None, (), None))
+
+# what the scanner can sort a batch by
+ORDER_COLUMNS = {"batch": "position", "stars": "stars DESC", "size": "size", "pushed": "pushed_at DESC"}
+
+
+def pushed_cutoff(days):
+    """
+    Returns:
+        str: The pushed_at timestamp `days` days ago, in github's format.
+    """
+    return (datetime.now(timezone.utc) - timedelta(days=days)).strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+class RepoStore:
+    """
+    Repositories per CSV batch with their metadata. Thread safe, and several
+    processes (collector, scanners) can use the same file.
+    """
+
+    def __init__(self, db_path):
+        """
+        Args:
+            db_path (str): The path to the SQLite database file.
+        """
+        self.db_path = db_path
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(db_path, timeout=60, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS repos ("
+                        "url TEXT PRIMARY KEY, batch INTEGER NOT NULL, position INTEGER NOT NULL, "
+                        "keyword TEXT, name TEXT, full_name TEXT, stars INTEGER, size INTEGER, "
+                        "pushed_at TEXT, default_branch TEXT, fork INTEGER, archived INTEGER, "
+                        "topics TEXT, collected_at REAL)")
+        # the predicates the scanner filters on, within a batch
+        self.db.execute("CREATE INDEX IF NOT EXISTS repos_batch ON repos (batch, position)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS repos_batch_size ON repos (batch, size)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS repos_batch_pushed ON repos (batch, pushed_at)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS repos_batch_stars ON repos (batch, stars)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS topics ("
+                        "topic TEXT NOT NULL, url TEXT NOT NULL, PRIMARY KEY (topic, url)) WITHOUT ROWID")
+        self.db.commit()
+
+    def add(self, batch, repositories, keyword=None):
+        """
+        Stores the repositories of a batch, in CSV order. Adding a batch again replaces it.
+
+        Args:
+            batch (int): The number of the CSV file.
+            repositories (list): RepoInfo tuples.
+            keyword (str, optional): The keyword they were found with. Defaults to None.
+        """
+        now = time.time()
+        rows = [(repo_info.url.strip(), batch, position, keyword, repo_info.name, repo_info.full_name,
+                 repo_info.stars, repo_info.size if repo_info.size != "" else None, repo_info.pushed_at,
+                 repo_info.default_branch, flag(repo_info.fork), flag(repo_info.archived),
+                 json.dumps(list(repo_info.topics or ())), now)
+                for position, repo_info in enumerate(repositories)]
+        with self.lock:
+            with self.db:
+                self.db.execute("DELETE FROM repos WHERE batch = ?", (batch,))
+                self.db.executemany("INSERT OR REPLACE INTO repos VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+                self.db.executemany("INSERT OR IGNORE INTO topics VALUES (?, ?)",
+                                    [(topic, repo_info.url.strip()) for repo_info in repositories
+                                     for topic in repo_info.topics or ()])
+
+    def pushed_at(self, urls):
+        """
+        Returns:
+            dict: url -> pushed_at of the given URLs that are in the store.
+        """
+        urls = [url.strip() for url in urls]
+        found = {}
+        with self.lock:
+            # in chunks, SQLite limits the number of parameters
+            for start in range(0, len(urls), 500):
+                chunk = urls[start:start + 500]
+                found.update(self.db.execute(f"SELECT url, pushed_at FROM repos WHERE url IN ({', '.join('?' * len(chunk))})",
+                                             chunk).fetchall())
+        return found
+
+    def has_batch(self, batch):
+        with self.lock:
+            return self.db.execute("SELECT 1 FROM repos WHERE batch = ? LIMIT 1", (batch,)).fetchone() is not None
+
+    def select(self, batch, max_size_mb=None, min_stars=None, pushed_within_days=None, skip_forks=False,
+               skip_archived=False, topics=None, order_by="batch", pushed_since=None):
+        """
+        Picks the repositories of a batch that match all given conditions.
+
+        Args:
+            batch (int): The number of the CSV file.
+            max_size_mb (int, optional): Only repositories up to this size (as reported by github). Defaults to None.
+            min_stars (int, optional): Only repositories with at least this many stars. Defaults to None.
+            pushed_within_days (int, optional): Only repositories pushed to in the last this many days. Defaults to None.
+            skip_forks (bool, optional): Leave out forks. Defaults to False.
+            skip_archived (bool, optional): Leave out archived repositories. Defaults to False.
+            topics (list, optional): Only repositories with at least one of these topics. Defaults to None.
+            order_by (str, optional): "batch" (CSV order), "stars", "size" or "pushed". Defaults to "batch".
+            pushed_since (str, optional): The cutoff of pushed_within_days (see pushed_cutoff), instead of
+                counting back from now, e.g. the one recorded by a checkpoint. Defaults to None.
+
+        Returns:
+            list: RepoInfo tuples.
+        """
+        conditions, params = ["batch = ?"], [batch]
+        if max_size_mb is not None:
+            conditions.append("(size IS NULL OR size <= ?)")
+            params.append(max_size_mb * 1024)
+        if min_stars is not None:
+            conditions.append("stars >= ?")
+            params.append(min_stars)
+        if pushed_within_days is not None or pushed_since is not None:
+            conditions.append("pushed_at >= ?")
+            params.append(pushed_since or pushed_cutoff(pushed_within_days))
+        if skip_forks:
+            conditions.append("NOT COALESCE(fork, 0)")
+        if skip_archived:
+            conditions.append("NOT COALESCE(archived, 0)")
+        if topics:
+            conditions.append(f"url IN (SELECT url FROM topics WHERE topic IN ({', '.join('?' * len(topics))}))")
+            params.extend(topics)
+        # the url makes the order stable, so a checkpoint offset stays valid as long as
+        # the conditions are the same (the cutoff of pushed_within_days moves with the clock)
+        query = (f"SELECT stars, url, name, size, full_name, pushed_at, default_branch, fork, archived, topics "
+                 f"FROM repos WHERE {' AND '.join(conditions)} ORDER BY {ORDER_COLUMNS[order_by]}, url")
+        with self.lock:
+            rows = self.db.execute(query, params).fetchall()
+        return [RepoInfo(stars, url, name, size, full_name, pushed_at, default_branch,
+                         None if fork is None else bool(fork), None if archived is None else bool(archived),
+                         tuple(json.loads(topics or "[]")))
+                for stars, url, name, size, full_name, pushed_at, default_branch, fork, archived, topics in rows]
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+
+def flag(value):
+    return None if value is None else int(bool(value))
+
+
+def csv_row(repo_info):
+    """
+    Returns:
+        list: A repository in the CSV layout the scanner works with (name, stars, url, size).
+    """
+    return [repo_info.name, str(repo_info.stars), repo_info.url, "" if repo_info.size is None else str(repo_info.size)]
@@ -0,0 +1,130 @@
+import json
+import sqlite3
+import threading
+
+from git_runner import CloneLimits, GitFailed, retry, run_git
+from rules import RepoScan
+
+
+class ResultCache:
+    """
+    Scan results keyed by (repository URL, HEAD commit SHA, ruleset fingerprint).
+
+    If neither the commit nor the rules changed, the cached result is used and
+    the repository is not cloned again. Besides the results, the patterns found
+    per file are stored per commit, so a new ruleset that only uses literals
+    and regexes that were already looked for is answered without cloning too.
+
+    Scans of partial checkouts (sparse patterns, blob limit) only see some of
+    the files, so every lookup also takes a `view` describing the checkout,
+    and results of different views are never mixed.
+    """
+
+    def __init__(self, db_path):
+        """
+        Args:
+            db_path (str): The path to the SQLite database file.
+        """
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(db_path, timeout=60, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS results ("
+                        "url TEXT, sha TEXT, view TEXT, ruleset TEXT, hits TEXT, PRIMARY KEY (url, sha, view, ruleset))")
+        self.db.execute("CREATE TABLE IF NOT EXISTS patterns ("
+                        "url TEXT, sha TEXT, view TEXT, scanned TEXT, files TEXT, PRIMARY KEY (url, sha, view))")
+        self.db.commit()
+
+    def lookup(self, url, sha, ruleset, view=''):
+        """
+        Finds the result of the rules for a commit, without cloning.
+
+        Args:
+            url (str): The repository URL.
+            sha (str): The HEAD commit SHA.
+            ruleset (RuleSet): The rules.
+            view (str, optional): Describes how the repository is checked out. Defaults to ''.
+
+        Returns:
+            RepoScan: The cached (or derived) result, or None if the repository has to be scanned.
+        """
+        url = url.strip()
+        with self.lock:
+            row = self.db.execute("SELECT hits FROM results WHERE url = ? AND sha = ? AND view = ? AND ruleset = ?",
+                                  (url, sha, view, ruleset.fingerprint)).fetchone()
+            if row is not None:
+                return RepoScan(json.loads(row[0]), {})
+            row = self.db.execute("SELECT scanned, files FROM patterns WHERE url = ? AND sha = ? AND view = ?",
+                                  (url, sha, view)).fetchone()
+        if row is None or not ruleset.answerable_from_patterns(json.loads(row[0])):
+            return None
+
+        result = ruleset.evaluate_patterns(json.loads(row[1]))
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?)",
+                            (url, sha, view, ruleset.fingerprint, json.dumps(result.hits)))
+            self.db.commit()
+        return result
+
+    def store(self, url, sha, ruleset, result, view=''):
+        """
+        Stores the result of a scan.
+
+        Args:
+            url (str): The repository URL.
+            sha (str): The HEAD commit SHA that was scanned.
+            ruleset (RuleSet): The rules.
+            result (RepoScan): The result of ruleset.scan_tree().
+            view (str, optional): Describes how the repository was checked out. Defaults to ''.
+        """
+        url = url.strip()
+        scanned = set(ruleset.matcher.names)
+        files = {relative_path: set(patterns) for relative_path, patterns in result.file_patterns.items()}
+        with self.lock:
+            # same commit, same files: merge with what earlier rulesets found
+            row = self.db.execute("SELECT scanned, files FROM patterns WHERE url = ? AND sha = ? AND view = ?",
+                                  (url, sha, view)).fetchone()
+            if row is not None:
+                scanned |= set(json.loads(row[0]))
+                for relative_path, patterns in json.loads(row[1]).items():
+                    files.setdefault(relative_path, set()).update(patterns)
+            self.db.execute("INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?)",
+                            (url, sha, view, ruleset.fingerprint, json.dumps(result.hits)))
+            self.db.execute("INSERT OR REPLACE INTO patterns VALUES (?, ?, ?, ?, ?)",
+                            (url, sha, view, json.dumps(sorted(scanned)),
+                             json.dumps({relative_path: sorted(patterns) for relative_path, patterns in files.items()})))
+            self.db.commit()
+
+
+def remote_head(repo_url, limits=None):
+    """
+    Asks the remote for its HEAD commit, without cloning anything. It runs
+    under the same limits as a clone: the timeout, the low-speed limit and
+    the retries of network errors.
+
+    Args:
+        repo_url (str): The URL of the repository.
+        limits (CloneLimits, optional): The timeout and retries. Defaults to None (CloneLimits()).
+
+    Returns:
+        str: The commit SHA, or None if the repository has no HEAD.
+
+    Raises:
+        GitFailed: ls-remote failed, e.g. NOT_FOUND for a deleted repository, or TIMEOUT.
+    """
+    limits = limits or CloneLimits()
+    repo_url = repo_url.strip()
+    # never prompts for credentials, deleted and private repositories just fail
+    output = retry(lambda number: run_git(['ls-remote', f'{repo_url}.git', 'HEAD'], limits.timeout, limits),
+                   limits, f"asking {repo_url} for its HEAD")
+    return output.split()[0] if output.strip() else None
+
+
+def local_head(repo_path):
+    """
+    Returns:
+        str: The commit SHA checked out in a local clone, or None.
+    """
+    try:
+        return run_git(['-C', repo_path, 'rev-parse', 'HEAD']).strip()
+    except GitFailed:
+        return None
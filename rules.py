@@ -0,0 +1,399 @@
+import ast
+import fnmatch
+import hashlib
+import json
+import os
+import threading
+import tomllib
+from collections import OrderedDict
+
+import metrics
+from scan_engine import PatternMatcher, read_files, walk_tree
+
+# brief functionality explanation:
+# a rules file describes what the scanner looks for, e.g.
+#
+#   [[rule]]
+#   name = "flask_render_template_string"
+#   # has to hold somewhere in the repository (different files may satisfy different parts)
+#   repo = { literal = "flask" }
+#   # files satisfying this are reported as hits
+#   file = { all = [ { glob = "*.py" }, { call = "render_template_string", non_constant_arg = true } ] }
+#
+# conditions are combined with all / any / not, the leaves are:
+#   literal = "text"          the file contains the text
+#   regex = "pattern"         the file matches the regular expression
+#   glob = "*.py"             the file path (or file name) matches the pattern
+#   call = "name"             python code calls `name(...)` or `x.name(...)`,
+#                             with non_constant_arg = true only if an argument is not a constant
+#   import = "module"         python code imports the module (or a submodule)
+#
+# all rules are evaluated together in one pass over the files of a repository:
+# literals and regexes of all rules are matched by one shared matcher,
+# and python files are only parsed if the name they are checked for occurs in them.
+
+# the behaviour of the scanner before rules existed
+DEFAULT_RULES = {
+    "rule": [{
+        "name": "flask_render_template_string",
+        "repo": {"literal": "flask"},
+        "file": {"literal": "render_template_string"},
+    }]
+}
+
+# facts extracted from parsed python files, keyed by content hash
+AST_CACHE_SIZE = 10000
+
+
+class RuleError(ValueError):
+    """
+    Raised for invalid rules files.
+    """
+
+
+class Condition:
+    """
+    A node of a condition tree, see compile_condition().
+    """
+
+    def __init__(self, kind, value=None, children=(), non_constant_arg=False):
+        self.kind = kind
+        self.value = value
+        self.children = list(children)
+        self.non_constant_arg = non_constant_arg
+
+    def leaves(self):
+        if self.children:
+            for child in self.children:
+                yield from child.leaves()
+        else:
+            yield self
+
+    def evaluate(self, leaf_value):
+        """
+        Evaluates the tree, with `leaf_value(leaf)` deciding the leaves.
+        """
+        if self.kind == 'all':
+            return all(child.evaluate(leaf_value) for child in self.children)
+        if self.kind == 'any':
+            return any(child.evaluate(leaf_value) for child in self.children)
+        if self.kind == 'not':
+            return not self.children[0].evaluate(leaf_value)
+        return leaf_value(self)
+
+    @property
+    def prefilter(self):
+        """
+        The literal that has to occur in a file for this leaf to be true (None if there is none).
+        """
+        if self.kind in ('literal', 'call'):
+            return self.value
+        if self.kind == 'import':
+            return self.value.split('.')[0]
+        return None
+
+
+def compile_condition(definition):
+    """
+    Turns the condition of a rules file into a Condition tree.
+
+    Args:
+        definition (dict): The condition, e.g. {"all": [{"literal": "flask"}, {"glob": "*.py"}]}.
+
+    Returns:
+        Condition: The root of the tree.
+    """
+    if not isinstance(definition, dict):
+        raise RuleError(f"condition must be a table, got {definition!r}")
+    if 'all' in definition or 'any' in definition:
+        kind = 'all' if 'all' in definition else 'any'
+        children = definition[kind]
+        if not isinstance(children, list) or not children:
+            raise RuleError(f"'{kind}' needs a non-empty list of conditions")
+        return Condition(kind, children=[compile_condition(child) for child in children])
+    if 'not' in definition:
+        return Condition('not', children=[compile_condition(definition['not'])])
+    for kind in ('literal', 'regex', 'glob', 'call', 'import'):
+        if kind in definition:
+            return Condition(kind, definition[kind], non_constant_arg=bool(definition.get('non_constant_arg')))
+    raise RuleError(f"unknown condition {definition!r}")
+
+
+class Rule:
+
+    def __init__(self, definition):
+        if 'name' not in definition or 'file' not in definition:
+            raise RuleError(f"every rule needs a 'name' and a 'file' condition: {definition!r}")
+        self.name = definition['name']
+        self.repo = compile_condition(definition['repo']) if 'repo' in definition else None
+        self.file = compile_condition(definition['file'])
+
+
+class RepoScan:
+    """
+    The result of scanning one repository. Files are given relative to the
+    repository root, so results do not depend on where it was checked out.
+
+    Attributes:
+        hits (dict): Maps the names of the rules that matched to their hit files.
+        file_patterns (dict): Maps every file to the literals/regexes found in it (only files with at least one).
+    """
+
+    def __init__(self, hits, file_patterns):
+        self.hits = hits
+        self.file_patterns = file_patterns
+
+    def hit_files(self, root):
+        """
+        All hit files of all rules, in a stable order.
+
+        Args:
+            root (str): The directory the repository is (or was) checked out to.
+
+        Returns:
+            list: The paths of the hit files below root.
+        """
+        return [os.path.join(root, relative_path)
+                for relative_path in sorted({path for files in self.hits.values() for path in files})]
+
+
+class RuleSet:
+    """
+    A set of rules that are evaluated together in a single pass over the files.
+    """
+
+    def __init__(self, definitions):
+        """
+        Args:
+            definitions (dict): The content of a rules file ({"rule": [...]}).
+        """
+        self.definitions = definitions
+        self.rules = [Rule(definition) for definition in definitions.get('rule', [])]
+        if not self.rules:
+            raise RuleError("no rules defined")
+
+        leaves = [leaf for rule in self.rules
+                  for tree in (rule.repo, rule.file) if tree is not None
+                  for leaf in tree.leaves()]
+        literals = {leaf.value for leaf in leaves if leaf.kind == 'literal'}
+        literals |= {leaf.prefilter for leaf in leaves if leaf.kind in ('call', 'import')}
+        regexes = {leaf.value for leaf in leaves if leaf.kind == 'regex'}
+        self.matcher = PatternMatcher(literals=sorted(literals), regexes=sorted(regexes))
+        self.repo_leaves = [leaf for rule in self.rules if rule.repo is not None for leaf in rule.repo.leaves()]
+
+        self._ast_cache = OrderedDict()
+        self._ast_lock = threading.Lock()
+
+    @property
+    def fingerprint(self):
+        """
+        Hash of the rules, changes whenever the rules change.
+        """
+        canonical = json.dumps(self.definitions, sort_keys=True, separators=(',', ':'))
+        return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+    @property
+    def names(self):
+        return [rule.name for rule in self.rules]
+
+    def scan_tree(self, repo_path, options=None, tree=None):
+        """
+        Scans the files of a checked out repository.
+
+        Args:
+            repo_path (str): The path to the repository.
+            options (WalkOptions, optional): Which files to leave out (see scan_engine.py). Defaults to None (WalkOptions()).
+            tree (Tree, optional): The repository walked with these options already. Defaults to None.
+
+        Returns:
+            RepoScan: The result.
+        """
+        if tree is None:
+            tree = walk_tree(repo_path, options)
+        scanned = {"files": 0, "bytes": 0}
+
+        def contents():
+            for file_path, relative_path, data in read_files(tree, options):
+                scanned["files"] += 1
+                scanned["bytes"] += len(data)
+                yield relative_path, data
+
+        result = self.scan_contents(contents())
+        metrics.inc("files_scanned", scanned["files"])
+        metrics.inc("bytes_scanned", scanned["bytes"])
+        for reason, count in tree.skipped.items():
+            metrics.inc(f"files_skipped_{reason}", count)
+        metrics.inc("dirs_pruned", tree.pruned)
+        return result
+
+    def scan_contents(self, files, keep=None):
+        """
+        Scans files that are already in memory (or opened by the caller).
+
+        Args:
+            files (iterable): (path relative to the repository root, content bytes) tuples.
+            keep (dict, optional): Filled with the content of the files that contain at least one
+                pattern, for callers that cannot read them again (see tarball_fetch.py). Defaults to None.
+
+        Returns:
+            RepoScan: The result.
+        """
+        def found_in(files):
+            for relative_path, data in files:
+                found = self.matcher.find(data) if data else set()
+                if found and keep is not None:
+                    keep[relative_path] = bytes(data)
+                yield relative_path, data, found
+
+        return self._evaluate(found_in(files))
+
+    def _evaluate(self, files):
+        # files: (relative path, content, patterns found in the content)
+        hits = {rule.name: [] for rule in self.rules}
+        file_patterns = {}
+        # repo conditions: leaves that were true for at least one file
+        satisfied = set()
+
+        for relative_path, data, found in files:
+            if found:
+                file_patterns[relative_path] = found
+            facts = {}
+
+            def leaf_value(leaf):
+                return self._leaf_value(leaf, relative_path, data, found, facts)
+
+            for leaf in self.repo_leaves:
+                if id(leaf) not in satisfied and leaf_value(leaf):
+                    satisfied.add(id(leaf))
+            for rule in self.rules:
+                if rule.file.evaluate(leaf_value):
+                    hits[rule.name].append(relative_path)
+
+        matched = {}
+        for rule in self.rules:
+            if not hits[rule.name]:
+                continue
+            if rule.repo is None or rule.repo.evaluate(lambda leaf: id(leaf) in satisfied):
+                matched[rule.name] = hits[rule.name]
+        return RepoScan(matched, file_patterns)
+
+    def evaluate_patterns(self, file_patterns):
+        """
+        Evaluates the rules using only the literals/regexes found per file in an
+        earlier scan (see RepoScan.file_patterns), without reading any file.
+
+        Args:
+            file_patterns (dict): Maps files to the patterns found in them.
+
+        Returns:
+            RepoScan: The result.
+        """
+        return self._evaluate((relative_path, None, set(patterns))
+                              for relative_path, patterns in file_patterns.items())
+
+    def answerable_from_patterns(self, scanned_patterns):
+        """
+        Checks if evaluate_patterns() gives the same result as a full scan:
+        only literal/regex leaves that were all part of the earlier scan, and
+        no `not` (files without any pattern are not in the earlier result).
+
+        Args:
+            scanned_patterns (iterable): The patterns the earlier scan looked for.
+
+        Returns:
+            bool: True if the rules can be answered from the earlier scan.
+        """
+        scanned_patterns = set(scanned_patterns)
+        for rule in self.rules:
+            for tree in (rule.repo, rule.file):
+                if tree is None:
+                    continue
+                if has_negation(tree):
+                    return False
+                for leaf in tree.leaves():
+                    if leaf.kind not in ('literal', 'regex') or leaf.value not in scanned_patterns:
+                        return False
+        return True
+
+    def _leaf_value(self, leaf, relative_path, data, found, facts):
+        if leaf.kind in ('literal', 'regex'):
+            return leaf.value in found
+        if leaf.kind == 'glob':
+            if relative_path is None:
+                return False
+            return (fnmatch.fnmatchcase(relative_path, leaf.value)
+                    or fnmatch.fnmatchcase(relative_path.rsplit('/', 1)[-1], leaf.value))
+        # python checks: cheap literal prefilter first, then the (cached) parsed file
+        if leaf.prefilter not in found:
+            return False
+        if 'ast' not in facts:
+            facts['ast'] = self._python_facts(data)
+        calls, imports = facts['ast']
+        if leaf.kind == 'call':
+            if leaf.value not in calls:
+                return False
+            return calls[leaf.value] if leaf.non_constant_arg else True
+        if leaf.kind == 'import':
+            return any(module == leaf.value or module.startswith(leaf.value + '.') for module in imports)
+        return False
+
+    def _python_facts(self, data):
+        """
+        Parses a python file (cached by content hash) and extracts the calls and imports.
+
+        Returns:
+            tuple: ({called name: called with a non-constant argument}, {imported modules})
+        """
+        data = bytes(data)
+        key = hashlib.sha1(data).digest()
+        with self._ast_lock:
+            if key in self._ast_cache:
+                self._ast_cache.move_to_end(key)
+                return self._ast_cache[key]
+
+        calls, imports = {}, set()
+        try:
+            tree = ast.parse(data)
+        except (SyntaxError, ValueError):
+            tree = None
+        if tree is not None:
+            for node in ast.walk(tree):
+                if isinstance(node, ast.Call):
+                    func = node.func
+                    name = func.id if isinstance(func, ast.Name) else func.attr if isinstance(func, ast.Attribute) else None
+                    if name is None:
+                        continue
+                    arguments = list(node.args) + [keyword.value for keyword in node.keywords]
+                    non_constant = any(not isinstance(argument, ast.Constant) for argument in arguments)
+                    calls[name] = calls.get(name, False) or non_constant
+                elif isinstance(node, ast.Import):
+                    imports.update(alias.name for alias in node.names)
+                elif isinstance(node, ast.ImportFrom) and node.module and not node.level:
+                    imports.add(node.module)
+        facts = (calls, imports)
+
+        with self._ast_lock:
+            self._ast_cache[key] = facts
+            if len(self._ast_cache) > AST_CACHE_SIZE:
+                self._ast_cache.popitem(last=False)
+        return facts
+
+
+def has_negation(tree):
+    return tree.kind == 'not' or any(has_negation(child) for child in tree.children)
+
+
+def load_rules(file_path=None):
+    """
+    Loads a rules file (TOML).
+
+    Args:
+        file_path (str, optional): The path to the rules file. Defaults to None (the built-in flask rule).
+
+    Returns:
+        RuleSet: The compiled rules.
+    """
+    if file_path is None:
+        return RuleSet(DEFAULT_RULES)
+    with open(file_path, 'rb') as file:
+        return RuleSet(tomllib.load(file))
@@ -0,0 +1,430 @@
+import mmap
+import os
+import re
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, nullcontext
+
+# files at least this big are memory-mapped instead of read into memory
+MMAP_THRESHOLD = 1024 * 1024
+
+# directories that hold no code of the repository itself: version control,
+# dependencies, virtualenvs, caches and vendored assets
+PRUNE_DIRS = frozenset({'.git', '.hg', '.svn', '.bzr', 'node_modules', 'bower_components', 'jspm_packages',
+                        'vendor', '__pycache__', '.venv', 'venv', 'site-packages', '.tox', '.nox', '.eggs',
+                        '.mypy_cache', '.pytest_cache'})
+# files bigger than this are not scanned (data, generated or minified files)
+MAX_FILE_SIZE = 10 * 1024 * 1024
+# a file with a NUL byte in its first this many bytes is binary
+SNIFF_SIZE = 8192
+# repositories with at least this many files to scan are read by a thread pool
+PARALLEL_MIN_FILES = 256
+READ_THREADS = 4
+
+
+class PatternMatcher:
+    """
+    Matches any number of literal or regex patterns against content that was
+    read once. Literals are searched with bytes.find (a C substring search,
+    much faster than the regex engine), every regex is compiled on its own,
+    so named groups, backreferences and inline flags of one regex cannot
+    affect the others.
+    """
+
+    def __init__(self, literals=(), regexes=()):
+        """
+        Args:
+            literals (iterable): Plain strings to look for (case sensitive).
+            regexes (iterable): Regular expressions to look for.
+        """
+        # (name, encoded literal) and (name, compiled regex)
+        self.literals = [(literal, literal.encode('utf-8')) for literal in literals]
+        self.regexes = [(regex, re.compile(regex.encode('utf-8'))) for regex in regexes]
+        self.names = tuple(dict.fromkeys([name for name, _ in self.literals] + [name for name, _ in self.regexes]))
+
+    def find(self, data):
+        """
+        Finds which of the patterns occur in the given data.
+
+        Args:
+            data (bytes or mmap): The content to search.
+
+        Returns:
+            set: The patterns that occur at least once.
+        """
+        # find() rather than `in`, which only looks for single bytes in an mmap
+        found = {name for name, literal in self.literals if data.find(literal) != -1}
+        found.update(name for name, regex in self.regexes if name not in found and regex.search(data))
+        return found
+
+
+@contextmanager
+def open_content(file_path):
+    """
+    Opens a file for matching: small files are read into memory, large ones
+    are memory-mapped, so each file is read exactly once.
+
+    Args:
+        file_path (str): The path to the file.
+
+    Yields:
+        bytes or mmap: The content of the file.
+    """
+    with open(file_path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if size == 0:
+            yield b''
+        elif size < MMAP_THRESHOLD:
+            yield f.read()
+        else:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                yield data
+
+
+class WalkOptions:
+    """
+    What walk_tree() and read_files() leave out, and how files are read.
+    """
+
+    def __init__(self, prune=True, extensions=None, max_file_size=MAX_FILE_SIZE, skip_binary=True, gitignore=False,
+                 read_threads=READ_THREADS):
+        """
+        Args:
+            prune (bool, optional): Do not descend into PRUNE_DIRS and virtualenvs. Defaults to True.
+            extensions (iterable, optional): Only files with these extensions, e.g. [".py", ".html"]. Defaults to None (all).
+            max_file_size (int, optional): Skip files bigger than this many bytes, None for no limit. Defaults to MAX_FILE_SIZE.
+            skip_binary (bool, optional): Skip files with a NUL byte at the start. Defaults to True.
+            gitignore (bool, optional): Skip what the repository's .gitignore files exclude. Defaults to False.
+            read_threads (int, optional): Threads reading the files of big repositories. Defaults to READ_THREADS.
+        """
+        self.prune = prune
+        self.extensions = None if extensions is None else frozenset(
+            (extension if extension.startswith('.') else '.' + extension).lower() for extension in extensions)
+        self.max_file_size = max_file_size
+        self.skip_binary = skip_binary
+        self.gitignore = gitignore
+        self.read_threads = read_threads
+
+    def view(self):
+        """
+        Returns:
+            dict: The options that change scan results (for the result cache).
+        """
+        return {"prune": self.prune, "extensions": sorted(self.extensions) if self.extensions is not None else None,
+                "max_file_size": self.max_file_size, "skip_binary": self.skip_binary, "gitignore": self.gitignore}
+
+    def skip_reason(self, name, size):
+        """
+        Returns:
+            str: Why a file is not scanned ("extension", "size"), or None.
+        """
+        if self.extensions is not None and os.path.splitext(name)[1].lower() not in self.extensions:
+            return "extension"
+        if self.max_file_size is not None and size > self.max_file_size:
+            return "size"
+        return None
+
+
+class GitIgnore:
+    """
+    The .gitignore rules that apply in one directory, including those of its parents.
+    Covers the usual syntax (negation, anchoring, directory-only patterns, **).
+    """
+
+    def __init__(self, rules=()):
+        # (directory the rule is relative to, compiled pattern, negated, only matches directories)
+        self.rules = tuple(rules)
+
+    def child(self, directory, relative_dir, names):
+        """
+        Returns:
+            GitIgnore: The rules for a subdirectory, with its own .gitignore added.
+        """
+        if '.gitignore' not in names:
+            return self
+        try:
+            with open(os.path.join(directory, '.gitignore'), encoding='utf-8', errors='replace') as file:
+                lines = file.read().splitlines()
+        except OSError:
+            return self
+        rules = []
+        for line in lines:
+            line = line.rstrip()
+            if not line or line.startswith('#'):
+                continue
+            negated = line.startswith('!')
+            if negated:
+                line = line[1:]
+            if line.startswith('\\'):
+                line = line[1:]
+            dir_only = line.endswith('/')
+            line = line.rstrip('/')
+            if not line:
+                continue
+            # a slash anywhere but at the end anchors the pattern to this directory
+            anchored = '/' in line
+            body = gitignore_regex(line.lstrip('/'))
+            rules.append((relative_dir, re.compile(body if anchored else '(?:.*/)?' + body), negated, dir_only))
+        return GitIgnore(self.rules + tuple(rules))
+
+    def ignored(self, relative_path, is_dir):
+        """
+        Returns:
+            bool: True if the path (relative to the repository root) is ignored. The last matching rule wins.
+        """
+        ignored = False
+        for base, pattern, negated, dir_only in self.rules:
+            if dir_only and not is_dir:
+                continue
+            if relative_path.startswith(base) and pattern.fullmatch(relative_path[len(base):]):
+                ignored = not negated
+        return ignored
+
+
+def gitignore_regex(pattern):
+    """
+    Translates a .gitignore glob into a regular expression (`*` stays within a directory, `**` does not).
+    """
+    parts = []
+    index = 0
+    while index < len(pattern):
+        if pattern.startswith('**/', index):
+            parts.append('(?:.*/)?')
+            index += 3
+        elif pattern.startswith('**', index):
+            parts.append('.*')
+            index += 2
+        elif pattern[index] == '*':
+            parts.append('[^/]*')
+            index += 1
+        elif pattern[index] == '?':
+            parts.append('[^/]')
+            index += 1
+        elif pattern[index] == '[' and ']' in pattern[index + 2:]:
+            end = pattern.index(']', index + 2)
+            characters = pattern[index + 1:end]
+            if characters.startswith('!'):
+                characters = '^' + characters[1:]
+            parts.append('[' + characters.replace('\\', '\\\\') + ']')
+            index = end + 1
+        else:
+            parts.append(re.escape(pattern[index]))
+            index += 1
+    return ''.join(parts)
+
+
+class Tree:
+    """
+    The result of walk_tree().
+
+    Attributes:
+        files (list): (file path, path relative to the repository root with forward slashes, size) of the files to scan.
+        size (int): Bytes of all checked out files, including skipped ones (not .git).
+        git_size (int): Bytes in the .git directory (what was downloaded).
+        skipped (Counter): Files left out, by reason ("extension", "size", "ignored", and "binary" once read).
+        pruned (int): Directories that were not descended into for scanning.
+    """
+
+    def __init__(self):
+        self.files = []
+        self.size = 0
+        self.git_size = 0
+        self.skipped = Counter()
+        self.pruned = 0
+
+
+def walk_tree(repo_path, options=None):
+    """
+    Walks a repository once with os.scandir: lists the files worth scanning and
+    measures the checkout and the .git directory on the way. Pruned directories
+    are only measured. Symlinks are neither followed nor scanned.
+
+    Args:
+        repo_path (str): The path to the repository.
+        options (WalkOptions, optional): What to leave out. Defaults to None (WalkOptions()).
+
+    Returns:
+        Tree: The files and sizes.
+    """
+    options = options or WalkOptions()
+    tree = Tree()
+    # (directory, its path relative to the root, scanned or only measured, inside .git, gitignore rules)
+    stack = [(repo_path, '', True, False, GitIgnore())]
+    while stack:
+        directory, relative_dir, scanned, in_git, ignore = stack.pop()
+        try:
+            with os.scandir(directory) as iterator:
+                entries = list(iterator)
+        except OSError:
+            continue
+        names = {entry.name for entry in entries}
+        if scanned and options.prune and 'pyvenv.cfg' in names:
+            # a virtualenv, whatever it is called
+            scanned = False
+            tree.pruned += 1
+        if scanned and options.gitignore:
+            ignore = ignore.child(directory, relative_dir, names)
+
+        for entry in entries:
+            relative_path = relative_dir + entry.name
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    git = in_git or (not relative_dir and entry.name == '.git')
+                    descend = (scanned and not git and not (options.prune and entry.name in PRUNE_DIRS)
+                               and not (options.gitignore and ignore.ignored(relative_path, True)))
+                    if scanned and not descend and not git:
+                        tree.pruned += 1
+                    stack.append((entry.path, relative_path + '/', descend, git, ignore))
+                elif entry.is_file(follow_symlinks=False):
+                    size = entry.stat(follow_symlinks=False).st_size
+                    if in_git:
+                        tree.git_size += size
+                        continue
+                    tree.size += size
+                    if not scanned:
+                        continue
+                    reason = options.skip_reason(entry.name, size)
+                    if reason is None and options.gitignore and ignore.ignored(relative_path, False):
+                        reason = "ignored"
+                    if reason is not None:
+                        tree.skipped[reason] += 1
+                    else:
+                        tree.files.append((entry.path, relative_path, size))
+            except OSError:
+                # vanished or unreadable
+                continue
+
+    tree.files.sort(key=lambda file: file[1])
+    return tree
+
+
+def walk_files(repo_path, options=None):
+    """
+    Lists the files of a repository that are worth scanning.
+
+    Args:
+        repo_path (str): The path to the repository.
+        options (WalkOptions, optional): What to leave out. Defaults to None (WalkOptions()).
+
+    Yields:
+        tuple: (file path, path relative to the repository root with forward slashes)
+    """
+    for file_path, relative_path, size in walk_tree(repo_path, options).files:
+        yield file_path, relative_path
+
+
+def is_binary(data):
+    """
+    Returns:
+        bool: True if the content looks binary (a NUL byte in the first SNIFF_SIZE bytes).
+    """
+    return b'\0' in data[:SNIFF_SIZE]
+
+
+def read_whole(file_path):
+    with open(file_path, 'rb') as file:
+        return file.read()
+
+
+def read_files(tree, options=None):
+    """
+    Reads the files of a walked tree, in order, leaving out binaries. In big
+    trees the small files are read ahead by a thread pool (a bounded number at
+    a time, so memory stays bounded); large files are memory-mapped when they
+    are reached.
+
+    Args:
+        tree (Tree): The result of walk_tree(). Skipped binaries are counted in it.
+        options (WalkOptions, optional): Defaults to None (WalkOptions()).
+
+    Yields:
+        tuple: (file path, relative path, content bytes or mmap). The content is only valid until the next item.
+    """
+    options = options or WalkOptions()
+    parallel = options.read_threads > 1 and len(tree.files) >= PARALLEL_MIN_FILES
+    executor = ThreadPoolExecutor(max_workers=options.read_threads) if parallel else None
+    files = iter(tree.files)
+    window = deque()
+
+    def submit():
+        for file_path, relative_path, size in files:
+            future = executor.submit(read_whole, file_path) if executor and size < MMAP_THRESHOLD else None
+            window.append((file_path, relative_path, future))
+            return
+
+    try:
+        for _ in range(options.read_threads * 4 if parallel else 1):
+            submit()
+        while window:
+            file_path, relative_path, future = window.popleft()
+            submit()
+            try:
+                with nullcontext(future.result()) if future is not None else open_content(file_path) as data:
+                    if options.skip_binary and is_binary(data):
+                        tree.skipped["binary"] += 1
+                        continue
+                    yield file_path, relative_path, data
+            except (OSError, ValueError):
+                # broken symlinks, special files etc.
+                continue
+    finally:
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+
+def scan_file(file_path, matcher):
+    """
+    Reads a single file once (as bytes, memory-mapped if large) and matches it.
+
+    Args:
+        file_path (str): The path to the file.
+        matcher (PatternMatcher): The compiled patterns.
+
+    Returns:
+        set: The patterns that occur in the file.
+    """
+    with open_content(file_path) as data:
+        return matcher.find(data) if data else set()
+
+
+def scan_tree(repo_path, matcher, options=None):
+    """
+    Walks the repository once and reports, per pattern, the files it occurs in.
+
+    Args:
+        repo_path (str): The path to the repository to scan.
+        matcher (PatternMatcher): The compiled patterns.
+        options (WalkOptions, optional): What to leave out. Defaults to None (WalkOptions()).
+
+    Returns:
+        dict: Maps every pattern to a list of file paths that contain it.
+    """
+    hits = {name: [] for name in matcher.names}
+
+    for file_path, relative_path, data in read_files(walk_tree(repo_path, options), options):
+        for name in matcher.find(data) if data else ():
+            hits[name].append(file_path)
+
+    return hits
+
+
+def add_arguments(parser):
+    """
+    Adds the options of the file walker to a command line parser.
+    """
+    parser.add_argument('--max_file_mb', type=float, default=MAX_FILE_SIZE / 1024 / 1024, help='Do not scan files bigger than this (optional, 0 = no limit)')
+    parser.add_argument('--extensions', type=str, nargs='+', default=None, help='Only scan files with these extensions, e.g. .py .html (optional)')
+    parser.add_argument('--no_prune', action='store_true', help='Also scan node_modules, vendor, virtualenvs and caches; the checkout\'s .git is never scanned (optional)')
+    parser.add_argument('--gitignore', action='store_true', help="Do not scan what the repository's .gitignore files exclude (optional)")
+    parser.add_argument('--scan_binaries', action='store_true', help='Also scan files that look binary (optional)')
+    parser.add_argument('--read_threads', type=int, default=READ_THREADS, help='Threads reading the files of big repositories (optional)')
+
+
+def options_from_args(args):
+    """
+    Returns:
+        WalkOptions: The options given on the command line (see add_arguments).
+    """
+    return WalkOptions(prune=not args.no_prune, extensions=args.extensions,
+                       max_file_size=int(args.max_file_mb * 1024 * 1024) if args.max_file_mb else None,
+                       skip_binary=not args.scan_binaries, gitignore=args.gitignore, read_threads=args.read_threads)
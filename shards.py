@@ -0,0 +1,175 @@
+import argparse
+import glob
+import hashlib
+import logging
+import os
+import re
+
+import log_utils
+from url_index import UrlIndex
+
+# brief functionality explanation:
+# splits the work of repo_scanner over several processes or machines that
+# share a filesystem, without a coordinator: with --shard i/N, every node
+# reads all CSV files but only processes the repositories whose URL hashes
+# to its shard. each shard has its own blacklist, hits file, checkpoint and
+# workspace, so nodes never write to the same file.
+# run this file to merge the hits of all shards into one report (and
+# optionally their blacklists into the shared index):
+#
+#   python shards.py --out hits.txt --index ./blacklist.db
+
+logger = logging.getLogger(__name__)
+
+SHARD_PATTERN = re.compile(r'^(\d+)/(\d+)$')
+
+
+def parse_shard(text):
+    """
+    Parses a shard given as "i/N", e.g. "2/4" is the second of four shards.
+
+    Args:
+        text (str): The shard.
+
+    Returns:
+        tuple: (i, N)
+
+    Raises:
+        ValueError: If it is not of the form i/N with 1 <= i <= N.
+    """
+    match = SHARD_PATTERN.match(text.strip())
+    if match is None:
+        raise ValueError(f"shard must look like i/N (e.g. 1/4), got {text!r}")
+    index, count = int(match.group(1)), int(match.group(2))
+    if not 1 <= index <= count:
+        raise ValueError(f"shard {index}/{count} does not exist, i must be between 1 and {count}")
+    return index, count
+
+
+def shard_of(url, count):
+    """
+    Returns:
+        int: The shard (1..count) a repository URL belongs to. The same on every machine and every run.
+    """
+    digest = hashlib.sha1(url.strip().rstrip('/').lower().encode('utf-8')).digest()
+    return int.from_bytes(digest[:8], 'big') % count + 1
+
+
+def in_shard(url, shard):
+    """
+    Returns:
+        bool: True if the URL belongs to the shard, or if there is no shard (None).
+    """
+    return shard is None or shard_of(url, shard[1]) == shard[0]
+
+
+def shard_path(path, shard):
+    """
+    Adds the shard to a file name, e.g. ("hits.txt", (2, 4)) -> "hits-shard2of4.txt".
+
+    Args:
+        path (str): The file (or directory) path used without sharding.
+        shard (tuple): (i, N), or None.
+
+    Returns:
+        str: The path of the shard's own file.
+    """
+    if shard is None:
+        return path
+    base, extension = os.path.splitext(path.rstrip('/'))
+    return f"{base}-shard{shard[0]}of{shard[1]}{extension}"
+
+
+def shard_files(path):
+    """
+    Returns:
+        list: The shard files of a path (see shard_path), ordered by shard.
+    """
+    base, extension = os.path.splitext(path)
+    pattern = re.compile(re.escape(base) + r'-shard(\d+)of(\d+)' + re.escape(extension) + '$')
+    found = []
+    for file_path in glob.glob(f"{glob.escape(base)}-shard*of*{glob.escape(extension)}"):
+        match = pattern.match(file_path)
+        if match:
+            found.append((int(match.group(2)), int(match.group(1)), file_path))
+    return [file_path for _, _, file_path in sorted(found)]
+
+
+def merge_hits(hits_path='hits.txt', out_path=None):
+    """
+    Combines the hits files of all shards (and the unsharded one, if any) into
+    one report without duplicate lines, in shard order.
+
+    Args:
+        hits_path (str, optional): The hits file name used by repo_scanner. Defaults to 'hits.txt'.
+        out_path (str, optional): The merged report. Defaults to `hits_path`.
+
+    Returns:
+        int: The number of lines in the merged report.
+    """
+    out_path = out_path or hits_path
+    sources = [hits_path] if os.path.exists(hits_path) else []
+    sources += shard_files(hits_path)
+
+    lines = {}
+    for file_path in sources:
+        with open(file_path, encoding='utf-8') as file:
+            for line in file:
+                line = line.rstrip('\n')
+                if line:
+                    lines.setdefault(line, None)
+        logger.info(f"Read {file_path}", extra={"lines": len(lines)})
+
+    # replace the report at once, it may be one of the sources
+    temp_path = out_path + '.tmp'
+    with open(temp_path, 'w', encoding='utf-8') as file:
+        file.write(''.join(line + '\n' for line in lines))
+    os.replace(temp_path, out_path)
+    return len(lines)
+
+
+def merge_blacklists(index_path, db_path='./blacklist.db'):
+    """
+    Adds the scanned URLs of all shard blacklists to one index, e.g. the one
+    repo_collector uses to skip repositories that were already scanned.
+
+    Args:
+        index_path (str): The index to merge into.
+        db_path (str, optional): The blacklist name used by repo_scanner. Defaults to './blacklist.db'.
+
+    Returns:
+        int: The number of URLs that were new in the index.
+    """
+    index = UrlIndex(index_path, "scanned")
+    added = 0
+    for file_path in shard_files(db_path):
+        shard = UrlIndex(file_path, "scanned")
+        new = sum(index.add(url) for url in shard)
+        shard.close()
+        added += new
+        logger.info(f"Merged {file_path}", extra={"new": new})
+    index.close()
+    return added
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Merge the outputs of sharded repo_scanner runs')
+    parser.add_argument('--hits', type=str, default='hits.txt', help='Hits file name the scanners were run with (their shard files are merged)')
+    parser.add_argument('--out', type=str, default=None, help='Merged hits report (optional, default: the --hits file)')
+    parser.add_argument('--blacklist', type=str, default='./blacklist.db', help='Blacklist name the scanners were run with (--index)')
+    parser.add_argument('--index', type=str, default=None, help='Also add the scanned URLs of all shards to this index, e.g. the one repo_collector uses (optional)')
+
+    parser.epilog = """
+    Example usage:
+    python repo_scanner.py --dir ./urlstash --shard 1/2   # on the first machine
+    python repo_scanner.py --dir ./urlstash --shard 2/2   # on the second machine
+    python shards.py --out hits.txt --index ./blacklist.db
+    """
+    log_utils.add_arguments(parser)
+    args = parser.parse_args()
+    log_utils.setup_from_args(args)
+    count = merge_hits(args.hits, args.out)
+    logger.log(log_utils.RESULT, f"Wrote {count} hits to {args.out or args.hits}")
+    if args.index is not None:
+        added = merge_blacklists(args.index, args.blacklist)
+        logger.log(log_utils.RESULT, f"Added {added} scanned URLs to {args.index}")
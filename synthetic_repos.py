@@ -0,0 +1,314 @@
+import argparse
+import hashlib
+import json
+import os
+import random
+import shutil
+import socket
+import subprocess
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# brief functionality explanation:
+# builds a corpus of made up git repositories for benchmarks, so the scanner
+# can be measured without cloning anything from github.
+# every repository gets a mix of python, text and binary files of a configurable
+# size; a share of them contains a flask app calling render_template_string,
+# so the default rules produce hits.
+# the corpus is deterministic (same seed, same repositories, same commits) and
+# stored as bare repositories, which are cloned over file:// or a local git daemon,
+# or downloaded as tarballs from a local HTTP server (like github's /archive/HEAD.tar.gz).
+
+# the same commit metadata everywhere, so commit ids do not change between runs
+GIT_ENV = {
+    "GIT_AUTHOR_NAME": "bench", "GIT_AUTHOR_EMAIL": "bench@example.com",
+    "GIT_AUTHOR_DATE": "2020-01-01T00:00:00+0000",
+    "GIT_COMMITTER_NAME": "bench", "GIT_COMMITTER_EMAIL": "bench@example.com",
+    "GIT_COMMITTER_DATE": "2020-01-01T00:00:00+0000",
+}
+
+WORDS = ["user", "item", "order", "cart", "token", "session", "view", "model", "query", "cache",
+         "page", "route", "form", "field", "value", "result", "config", "handler", "record", "index"]
+
+HIT_FILE = '''from flask import Flask, request, render_template_string
+
+app = Flask(__name__)
+
+
+@app.route("/hello")
+def hello():
+    name = request.args.get("name", "")
+    return render_template_string("<p>Hello " + name + "</p>")
+'''
+
+
+def python_file(rng, size):
+    """
+    Generates python code of about `size` bytes.
+    """
+    parts = []
+    length = 0
+    while length < size:
+        name = f"{rng.choice(WORDS)}_{rng.choice(WORDS)}_{rng.randrange(10000)}"
+        body = (f"def {name}({rng.choice(WORDS)}, {rng.choice(WORDS)}=None):\n"
+                f"    result = []\n"
+                f"    for {rng.choice(WORDS)} in range({rng.randrange(100)}):\n"
+                f"        result.append({rng.choice(WORDS)!r})\n"
+                f"    return result\n\n\n")
+        parts.append(body)
+        length += len(body)
+    return "".join(parts)
+
+
+def text_file(rng, size):
+    """
+    Generates prose-like text of about `size` bytes.
+    """
+    words = []
+    length = 0
+    while length < size:
+        word = rng.choice(WORDS)
+        words.append(word)
+        length += len(word) + 1
+    return " ".join(words) + "\n"
+
+
+def make_repo(destination, rng, files=50, file_size=4096, python_ratio=0.6, binary_ratio=0.1,
+              large_files=0, large_file_size=2 * 1024 * 1024, hit=False):
+    """
+    Creates one bare repository with a single commit.
+
+    Args:
+        destination (str): The path of the bare repository (ending in .git).
+        rng (random.Random): The random generator (decides the content).
+        files (int, optional): The number of files. Defaults to 50.
+        file_size (int, optional): The average size of a file in bytes. Defaults to 4096.
+        python_ratio (float, optional): Share of python files. Defaults to 0.6.
+        binary_ratio (float, optional): Share of binary files, the rest is text. Defaults to 0.1.
+        large_files (int, optional): Extra binary files of `large_file_size` (to exercise --blob_limit). Defaults to 0.
+        large_file_size (int, optional): The size of the large files in bytes. Defaults to 2 MB.
+        hit (bool, optional): Add a flask app calling render_template_string. Defaults to False.
+
+    Returns:
+        int: The size of the checked out files in bytes.
+    """
+    work = tempfile.mkdtemp(prefix='synthetic-')
+    total = 0
+    try:
+        for number in range(files):
+            # sizes vary between half and one and a half times the average
+            size = int(file_size * (0.5 + rng.random()))
+            kind = rng.random()
+            directory = os.path.join(work, rng.choice(["", "src", "app", "docs", "static"]))
+            os.makedirs(directory, exist_ok=True)
+            if kind < python_ratio:
+                file_path, data = os.path.join(directory, f"module_{number}.py"), python_file(rng, size).encode()
+            elif kind < python_ratio + binary_ratio:
+                file_path, data = os.path.join(directory, f"asset_{number}.bin"), rng.randbytes(size)
+            else:
+                file_path, data = os.path.join(directory, f"notes_{number}.md"), text_file(rng, size).encode()
+            with open(file_path, 'wb') as file:
+                file.write(data)
+            total += len(data)
+        for number in range(large_files):
+            with open(os.path.join(work, f"large_{number}.bin"), 'wb') as file:
+                file.write(rng.randbytes(large_file_size))
+            total += large_file_size
+        if hit:
+            with open(os.path.join(work, "app.py"), 'w') as file:
+                file.write(HIT_FILE)
+            total += len(HIT_FILE)
+
+        env = dict(os.environ, **GIT_ENV)
+        subprocess.run(['git', 'init', '-q', '-b', 'main', work], check=True, env=env)
+        subprocess.run(['git', '-C', work, 'add', '-A'], check=True, env=env)
+        subprocess.run(['git', '-C', work, 'commit', '-q', '-m', 'synthetic'], check=True, env=env)
+        subprocess.run(['git', 'clone', '-q', '--bare', work, destination], check=True, env=env)
+        # allow --filter when cloning (blob_limit / sparse)
+        subprocess.run(['git', '-C', destination, 'config', 'uploadpack.allowFilter', 'true'], check=True)
+    finally:
+        shutil.rmtree(work, ignore_errors=True)
+    return total
+
+
+def make_corpus(root, repos=20, hit_ratio=0.2, seed=0, **repo_options):
+    """
+    Creates a corpus of bare repositories, or reuses it if it was created with
+    the same settings before.
+
+    Args:
+        root (str): The directory for the corpus.
+        repos (int, optional): The number of repositories. Defaults to 20.
+        hit_ratio (float, optional): Share of repositories the default rules match. Defaults to 0.2.
+        seed (int, optional): The random seed. Defaults to 0.
+        **repo_options: Passed on to make_repo (files, file_size, ...).
+
+    Returns:
+        list: One dict per repository with its name, path, size and whether it is a hit.
+    """
+    settings = dict(repos=repos, hit_ratio=hit_ratio, seed=seed, **repo_options)
+    key = hashlib.sha1(json.dumps(settings, sort_keys=True).encode('utf-8')).hexdigest()[:12]
+    root = os.path.abspath(os.path.join(root, f"corpus-{key}"))
+    manifest_path = os.path.join(root, "manifest.json")
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as file:
+            return json.load(file)["repos"]
+
+    shutil.rmtree(root, ignore_errors=True)
+    os.makedirs(root)
+    rng = random.Random(seed)
+    # hits are spread evenly over the corpus
+    hits = {int(number / hit_ratio) for number in range(int(repos * hit_ratio))} if hit_ratio else set()
+    corpus = []
+    for number in range(repos):
+        name = f"repo{number}"
+        path = os.path.join(root, f"{name}.git")
+        size = make_repo(path, rng, hit=number in hits, **repo_options)
+        corpus.append({"name": name, "path": path, "size": size, "hit": number in hits})
+
+    # written last, an interrupted run is started over
+    with open(manifest_path, 'w') as file:
+        json.dump({"settings": settings, "repos": corpus}, file, indent=2)
+    return corpus
+
+
+def corpus_root(corpus):
+    """
+    Returns:
+        str: The directory the repositories of a corpus are in.
+    """
+    return os.path.dirname(corpus[0]["path"])
+
+
+def file_urls(corpus):
+    """
+    Returns:
+        list: The URL of every repository for cloning over file://, without the .git suffix (like html_url).
+    """
+    return [f"file://{repo['path'][:-len('.git')]}" for repo in corpus]
+
+
+class GitDaemon:
+    """
+    A local `git daemon` serving a corpus over git://, closer to cloning over the network than file://.
+    """
+
+    def __init__(self, root, host='127.0.0.1', port=0):
+        """
+        Args:
+            root (str): The directory of the bare repositories.
+            host (str, optional): The interface to listen on. Defaults to '127.0.0.1'.
+            port (int, optional): The port to listen on, 0 picks a free one. Defaults to 0.
+        """
+        if not port:
+            with socket.socket() as probe:
+                probe.bind((host, 0))
+                port = probe.getsockname()[1]
+        self.host, self.port = host, port
+        self.process = subprocess.Popen(['git', 'daemon', '--reuseaddr', '--export-all', f'--base-path={root}',
+                                         f'--listen={host}', f'--port={port}', root],
+                                        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        # wait until it accepts connections
+        for _ in range(100):
+            try:
+                socket.create_connection((host, port), timeout=0.1).close()
+                return
+            except OSError:
+                time.sleep(0.05)
+        self.close()
+        raise RuntimeError("git daemon did not start")
+
+    def urls(self, corpus):
+        """
+        Returns:
+            list: The git:// URL of every repository, without the .git suffix.
+        """
+        return [f"git://{self.host}:{self.port}/{repo['name']}" for repo in corpus]
+
+    def close(self):
+        self.process.terminate()
+        self.process.wait()
+
+
+
+class TarballServer:
+    """
+    A local HTTP server answering <name>/archive/HEAD.tar.gz with a tarball of the
+    repository made by `git archive`, like github does (see tarball_fetch.py).
+    """
+
+    def __init__(self, root, host='127.0.0.1', port=0):
+        """
+        Args:
+            root (str): The directory of the bare repositories.
+            host (str, optional): The interface to listen on. Defaults to '127.0.0.1'.
+            port (int, optional): The port to listen on, 0 picks a free one. Defaults to 0.
+        """
+        class Handler(BaseHTTPRequestHandler):
+            # keep-alive, so pooled connections are reused
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                parts = self.path.strip('/').split('/')
+                path = os.path.join(root, f"{parts[0]}.git")
+                if len(parts) != 3 or parts[1] != "archive" or not parts[2].endswith(".tar.gz") \
+                        or not os.path.isdir(path):
+                    self.send_error(404)
+                    return
+                ref = parts[2][:-len(".tar.gz")]
+                archive = subprocess.run(['git', '-C', path, 'archive', '--format=tar.gz',
+                                          f'--prefix={parts[0]}-{ref}/', ref], capture_output=True)
+                if archive.returncode:
+                    self.send_error(404)
+                    return
+                self.send_response(200)
+                self.send_header("Content-Type", "application/x-gzip")
+                self.send_header("Content-Length", str(len(archive.stdout)))
+                self.end_headers()
+                self.wfile.write(archive.stdout)
+
+            def handle(self):
+                try:
+                    super().handle()
+                except ConnectionError:
+                    # the client aborted a download (too big)
+                    pass
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.host, self.port = self.server.server_address[:2]
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def urls(self, corpus):
+        """
+        Returns:
+            list: The http:// URL of every repository (its tarball is at <url>/archive/HEAD.tar.gz).
+        """
+        return [f"http://{self.host}:{self.port}/{repo['name']}" for repo in corpus]
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Synthetic git repositories for benchmarks')
+    parser.add_argument('--root', type=str, default='./bench', help='Directory for the corpus')
+    parser.add_argument('--repos', type=int, default=20, help='Number of repositories')
+    parser.add_argument('--files', type=int, default=50, help='Files per repository')
+    parser.add_argument('--file_size', type=int, default=4096, help='Average file size in bytes')
+    parser.add_argument('--hit_ratio', type=float, default=0.2, help='Share of repositories the default rules match')
+    parser.add_argument('--large_files', type=int, default=0, help='Extra large binary files per repository')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed')
+
+    parser.epilog = """
+    Example usage:
+    python synthetic_repos.py --repos 50 --files 200
+    """
+    args = parser.parse_args()
+    corpus = make_corpus(args.root, repos=args.repos, hit_ratio=args.hit_ratio, seed=args.seed,
+                         files=args.files, file_size=args.file_size, large_files=args.large_files)
+    print(f"{len(corpus)} repositories in {corpus_root(corpus)}")
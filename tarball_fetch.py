@@ -0,0 +1,206 @@
+import logging
+import posixpath
+import tarfile
+import time
+import zlib
+from collections import Counter
+
+import requests
+import requests.adapters
+
+from git_runner import AUTH, NETWORK, NOT_FOUND, TIMEOUT, TOO_BIG, GitFailed
+from scan_engine import PRUNE_DIRS, WalkOptions, is_binary
+
+# brief functionality explanation:
+# stream-and-scan: instead of cloning a repository, its default branch is
+# downloaded as a tarball (github redirects <url>/archive/HEAD.tar.gz to
+# codeload) over a pooled HTTP connection and read as a stream. every member
+# is matched in memory as it arrives, nothing is written to disk.
+# the download is aborted as soon as the repository turns out to be bigger
+# than the cap, and only files containing a pattern are kept in memory, so
+# the matching files of a hit can be written out afterwards.
+# failures are reported like those of git clones (see git_runner.py).
+# the same filters as for checkouts apply (scan_engine.WalkOptions), except
+# .gitignore files and virtualenvs without a well-known name, which would need
+# the whole listing before the first file is scanned.
+
+logger = logging.getLogger(__name__)
+
+# where the tarball of a repository is downloaded from: {url} is the repository URL
+# (html_url), {name} its name. HEAD is the default branch, whatever it is called
+TARBALL_URL = "{url}/archive/HEAD.tar.gz"
+# (connect, read) timeouts in seconds
+HTTP_TIMEOUT = (10, 60)
+
+
+class TarballTooBig(GitFailed):
+    """
+    The repository is bigger than the cap, the download was aborted.
+    """
+
+    def __init__(self, message):
+        super().__init__(TOO_BIG, message)
+
+
+def http_failure(status):
+    """
+    Returns:
+        str: The kind of failure (see git_runner.py) an HTTP error status stands for.
+    """
+    if status in (404, 410, 451):
+        return NOT_FOUND
+    if status in (401, 403):
+        return AUTH
+    if status == 413:
+        return TOO_BIG
+    return NETWORK
+
+
+class TarballScan:
+    """
+    The result of TarballFetcher.scan().
+
+    Attributes:
+        result (RepoScan): The scan result, with paths relative to the repository root.
+        contents (dict): Maps the files that contain at least one pattern to their content.
+        sha (str): The commit of the tarball (from its pax header, written by git archive), or None.
+        downloaded (int): Compressed bytes downloaded.
+        size (int): Bytes of all files in the tarball, including skipped ones.
+        files_scanned (int): Files that were matched.
+        bytes_scanned (int): Bytes that were matched.
+        skipped (Counter): Files left out, by reason ("pruned", "extension", "size", "binary").
+    """
+
+    def __init__(self, result, contents, sha, downloaded, stats):
+        self.result = result
+        self.contents = contents
+        self.sha = sha
+        self.downloaded = downloaded
+        self.size = stats["size"]
+        self.files_scanned = stats["files"]
+        self.bytes_scanned = stats["bytes"]
+        self.skipped = stats["skipped"]
+
+
+class CappedReader:
+    """
+    A file-like view of a streamed response that aborts once more than `max_bytes`
+    were read, or once the time.monotonic() `deadline` has passed.
+    """
+
+    def __init__(self, raw, max_bytes, deadline=None):
+        self.raw = raw
+        self.max_bytes = max_bytes
+        self.deadline = deadline
+        self.count = 0
+
+    def read(self, size=-1):
+        data = self.raw.read(size)
+        self.count += len(data)
+        if self.max_bytes is not None and self.count > self.max_bytes:
+            raise TarballTooBig(f"more than {self.max_bytes} bytes downloaded")
+        if self.deadline is not None and time.monotonic() > self.deadline:
+            raise GitFailed(TIMEOUT, "download took too long")
+        return data
+
+
+class TarballFetcher:
+    """
+    Downloads repository tarballs over a pool of kept-alive connections and scans them in memory. Thread safe.
+    """
+
+    def __init__(self, url_template=TARBALL_URL, pool_size=10, timeout=HTTP_TIMEOUT, max_seconds=None):
+        """
+        Args:
+            url_template (str, optional): Where tarballs are downloaded from, see TARBALL_URL. Defaults to TARBALL_URL.
+            pool_size (int, optional): The number of connections kept open (parallel downloads). Defaults to 10.
+            timeout (tuple, optional): (connect, read) timeouts in seconds. Defaults to HTTP_TIMEOUT.
+            max_seconds (float, optional): Abort a download that takes longer than this. Defaults to None (no limit).
+        """
+        self.url_template = url_template
+        self.timeout = timeout
+        self.max_seconds = max_seconds
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def url(self, repo_url, name=None):
+        """
+        Returns:
+            str: The tarball URL of a repository.
+        """
+        repo_url = repo_url.strip().rstrip('/')
+        return self.url_template.format(url=repo_url, name=name or repo_url.rsplit('/', 1)[-1])
+
+    def scan(self, repo_url, ruleset, options=None, max_bytes=None, name=None):
+        """
+        Streams the tarball of a repository and scans it without writing anything to disk.
+
+        Args:
+            repo_url (str): The URL of the repository.
+            ruleset (RuleSet): What to look for.
+            options (WalkOptions, optional): Which files to leave out. Defaults to None (WalkOptions()).
+            max_bytes (int, optional): Abort if the download or the unpacked files get bigger than this. Defaults to None.
+            name (str, optional): The repository name for the URL template. Defaults to the last part of the URL.
+
+        Returns:
+            TarballScan: The result.
+
+        Raises:
+            TarballTooBig: The repository is bigger than max_bytes.
+            GitFailed: The download failed (e.g. NOT_FOUND for a deleted repository) or took too long.
+        """
+        try:
+            return self._scan(repo_url, ruleset, options, max_bytes, name)
+        except requests.HTTPError as e:
+            raise GitFailed(http_failure(e.response.status_code), str(e))
+        except requests.Timeout as e:
+            raise GitFailed(TIMEOUT, str(e))
+        except (requests.RequestException, tarfile.TarError, EOFError, zlib.error, OSError) as e:
+            # connection errors and downloads that broke off
+            raise GitFailed(NETWORK, str(e) or type(e).__name__)
+
+    def _scan(self, repo_url, ruleset, options, max_bytes, name):
+        options = options or WalkOptions()
+        deadline = time.monotonic() + self.max_seconds if self.max_seconds else None
+        with self.session.get(self.url(repo_url, name), stream=True, timeout=self.timeout) as response:
+            response.raise_for_status()
+            length = response.headers.get("Content-Length")
+            if max_bytes is not None and length and int(length) > max_bytes:
+                raise TarballTooBig(f"{length} bytes to download")
+            # decompressed by tarfile, not by urllib3
+            reader = CappedReader(response.raw, max_bytes, deadline)
+            with tarfile.open(fileobj=reader, mode='r|gz') as tar:
+                stats = {"size": 0, "files": 0, "bytes": 0, "skipped": Counter()}
+                contents = {}
+                result = ruleset.scan_contents(self._members(tar, options, max_bytes, stats), keep=contents)
+                sha = tar.pax_headers.get("comment")
+            return TarballScan(result, contents, sha, reader.count, stats)
+
+    def _members(self, tar, options, max_bytes, stats):
+        # (relative path, content) of the files worth scanning, in tarball order
+        for member in tar:
+            if not member.isfile():
+                continue
+            stats["size"] += member.size
+            if max_bytes is not None and stats["size"] > max_bytes:
+                raise TarballTooBig(f"more than {max_bytes} bytes unpacked")
+            # github and git archive put everything below "<repo>-<ref>/"
+            parts = member.name.split('/')[1:]
+            if not parts:
+                continue
+            if options.prune and any(part in PRUNE_DIRS for part in parts[:-1]):
+                stats["skipped"]["pruned"] += 1
+                continue
+            reason = options.skip_reason(parts[-1], member.size)
+            if reason is not None:
+                stats["skipped"][reason] += 1
+                continue
+            data = tar.extractfile(member).read()
+            if options.skip_binary and is_binary(data):
+                stats["skipped"]["binary"] += 1
+                continue
+            stats["files"] += 1
+            stats["bytes"] += len(data)
+            yield posixpath.join(*parts), data
@@ -0,0 +1,190 @@
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class UrlIndex:
+    """
+    Persistent set of repository URLs, backed by SQLite.
+
+    Lookups are answered from an in-memory set (falling back to the database,
+    so URLs added by other processes are seen as well). Writes are grouped
+    into transactions that are committed every `batch_size` URLs or every
+    `flush_interval` seconds, whichever comes first. A crash therefore loses
+    at most the last uncommitted batch, which only means those repositories
+    are processed again.
+
+    Several namespaces can live in the same database file, e.g. "scanned"
+    for the scanner's blacklist and "collected" for the collector.
+    Instances are safe to share between threads, and several processes can
+    use the same database file at once.
+    """
+
+    def __init__(self, db_path, namespace, batch_size=100, flush_interval=1.0):
+        """
+        Args:
+            db_path (str): The path to the SQLite database file.
+            namespace (str): The name of the set inside the database.
+            batch_size (int, optional): Commit after this many new URLs. Defaults to 100.
+            flush_interval (float, optional): Commit at least every this many seconds. Defaults to 1.0.
+        """
+        self.db_path = db_path
+        self.namespace = namespace
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._closed = False
+        # autocommit mode, transactions are handled by hand below
+        self._db = sqlite3.connect(db_path, timeout=60, isolation_level=None, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS seen ("
+                         "namespace TEXT NOT NULL, url TEXT NOT NULL, "
+                         "PRIMARY KEY (namespace, url)) WITHOUT ROWID")
+
+        self._seen = {row[0] for row in
+                      self._db.execute("SELECT url FROM seen WHERE namespace = ?", (namespace,))}
+
+        # commits batches that did not fill up, so other processes are not kept waiting
+        self._flusher = threading.Thread(target=self._flush_periodically, daemon=True)
+        self._flusher.start()
+
+    def __len__(self):
+        return len(self._seen)
+
+    def __iter__(self):
+        # a copy, other threads may add URLs meanwhile
+        return iter(list(self._seen))
+
+    def __contains__(self, url):
+        url = url.strip()
+        if url in self._seen:
+            return True
+        with self._lock:
+            row = self._db.execute("SELECT 1 FROM seen WHERE namespace = ? AND url = ?",
+                                   (self.namespace, url)).fetchone()
+            if row is not None:
+                self._seen.add(url)
+                return True
+        return False
+
+    def add(self, url):
+        """
+        Adds a URL to the index, unless it is already in it.
+
+        Args:
+            url (str): The URL to add.
+
+        Returns:
+            bool: True if the URL was new, False if it was already in the index.
+        """
+        url = url.strip()
+        with self._lock:
+            if url in self._seen:
+                return False
+            if self._pending == 0:
+                # take the write lock now, so the check below sees the latest state
+                self._db.execute("BEGIN IMMEDIATE")
+            cursor = self._db.execute("INSERT OR IGNORE INTO seen (namespace, url) VALUES (?, ?)",
+                                      (self.namespace, url))
+            self._seen.add(url)
+            self._pending += 1
+            if self._pending >= self.batch_size:
+                self._commit()
+            # nothing inserted means another process added it first
+            return cursor.rowcount == 1
+
+    def discard(self, url):
+        """
+        Removes a URL from the index again (e.g. if processing it was aborted).
+
+        Args:
+            url (str): The URL to remove.
+        """
+        url = url.strip()
+        with self._lock:
+            if self._pending == 0:
+                self._db.execute("BEGIN IMMEDIATE")
+            self._db.execute("DELETE FROM seen WHERE namespace = ? AND url = ?", (self.namespace, url))
+            self._seen.discard(url)
+            self._pending += 1
+            self._commit()
+
+    def reload(self):
+        """
+        Re-reads the set from the database, e.g. to see URLs other processes discarded.
+        """
+        with self._lock:
+            self._commit()
+            self._seen = {row[0] for row in
+                          self._db.execute("SELECT url FROM seen WHERE namespace = ?", (self.namespace,))}
+
+    def import_file(self, file_path):
+        """
+        Adds all URLs of a text file (one per line), e.g. a legacy blacklist.txt.
+
+        Args:
+            file_path (str): The path to the text file.
+
+        Returns:
+            int: The number of URLs that were new.
+        """
+        with open(file_path, 'r', encoding='utf-8', errors='ignore') as file:
+            urls = [line.strip() for line in file if line.strip()]
+        return sum(self.add(url) for url in urls)
+
+    def flush(self):
+        """
+        Commits all pending URLs to disk.
+        """
+        with self._lock:
+            self._commit()
+
+    def close(self):
+        """
+        Commits all pending URLs and closes the database.
+        """
+        with self._lock:
+            self._commit()
+            self._closed = True
+            self._db.close()
+
+    def _commit(self):
+        # caller holds self._lock
+        if self._pending:
+            self._db.execute("COMMIT")
+            self._pending = 0
+
+    def _flush_periodically(self):
+        while True:
+            time.sleep(self.flush_interval)
+            with self._lock:
+                if self._closed:
+                    return
+                self._commit()
+
+
+def open_blacklist(db_path, legacy_file='./blacklist.txt'):
+    """
+    Opens the scanner's blacklist, migrating an old blacklist.txt on first use.
+
+    Args:
+        db_path (str): The path to the SQLite database file.
+        legacy_file (str, optional): The old plain text blacklist. Defaults to './blacklist.txt'.
+
+    Returns:
+        UrlIndex: The URLs that were already scanned.
+    """
+    fresh = not os.path.exists(db_path)
+    blacklist = UrlIndex(db_path, "scanned")
+    if fresh and os.path.exists(legacy_file):
+        imported = blacklist.import_file(legacy_file)
+        blacklist.flush()
+        logger.info(f"Imported {imported} URLs from {legacy_file} into {db_path}.")
+    return blacklist
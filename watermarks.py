@@ -0,0 +1,97 @@
+import logging
+import sqlite3
+import threading
+import time
+
+# brief functionality explanation:
+# incremental collection. for every search query (keyword, language and star
+# range) the latest pushed_at (or created_at) of its results is kept in the
+# index database. the next pass adds a `pushed:>=<watermark>` qualifier to
+# the query, so only repositories that are new or got new commits since then
+# are fetched, and written as new (delta) batches for the scanner.
+
+logger = logging.getLogger(__name__)
+
+# the qualifier and the RepoInfo field it compares with
+FIELDS = {"pushed": "pushed_at", "created": "created_at"}
+
+
+class Watermarks:
+    """
+    The latest pushed_at/created_at seen per search query. Thread safe.
+    """
+
+    def __init__(self, db_path, field="pushed"):
+        """
+        Args:
+            db_path (str): The database the watermarks are kept in (the collector's URL index).
+            field (str, optional): "pushed" fetches new and updated repositories, "created" only new ones. Defaults to "pushed".
+        """
+        if field not in FIELDS:
+            raise ValueError(f"field must be one of {', '.join(FIELDS)}")
+        self.field = field
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(db_path, timeout=60, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS watermarks ("
+                        "query TEXT NOT NULL, field TEXT NOT NULL, value TEXT NOT NULL, updated REAL, "
+                        "PRIMARY KEY (query, field))")
+        self.db.commit()
+
+    def get(self, query):
+        """
+        Args:
+            query (str): The search query without the watermark (see repo_collector.build_query).
+
+        Returns:
+            str: The watermark (an ISO 8601 timestamp), or None if the query was never collected.
+        """
+        with self.lock:
+            row = self.db.execute("SELECT value FROM watermarks WHERE query = ? AND field = ?",
+                                  (query, self.field)).fetchone()
+        return None if row is None else row[0]
+
+    def qualify(self, term, query):
+        """
+        Adds the watermark of a query to its keyword.
+
+        Args:
+            term (str): The keyword.
+            query (str): The search query of the keyword without the watermark.
+
+        Returns:
+            str: e.g. "web pushed:>=2024-05-01T12:00:00Z", or just the keyword if there is no watermark yet.
+        """
+        value = self.get(query)
+        # >= rather than >, repositories seen twice are dropped as duplicates
+        return term if value is None else f"{term} {self.field}:>={value}"
+
+    def advance(self, query, repositories):
+        """
+        Moves the watermark of a query to the latest repository collected with it.
+        Call it only once the repositories are written.
+
+        Args:
+            query (str): The search query without the watermark.
+            repositories (list): The RepoInfo tuples it returned.
+
+        Returns:
+            str: The new watermark, or None if there is none.
+        """
+        attribute = FIELDS[self.field]
+        values = [getattr(repo_info, attribute) for repo_info in repositories]
+        latest = max((value for value in values if value), default=None)
+        with self.lock:
+            row = self.db.execute("SELECT value FROM watermarks WHERE query = ? AND field = ?",
+                                  (query, self.field)).fetchone()
+            if latest is None or (row is not None and row[0] >= latest):
+                return None if row is None else row[0]
+            with self.db:
+                self.db.execute("INSERT OR REPLACE INTO watermarks VALUES (?, ?, ?, ?)",
+                                (query, self.field, latest, time.time()))
+        logger.debug("watermark advanced", extra={"query": query, self.field: latest})
+        return latest
+
+    def close(self):
+        with self.lock:
+            self.db.close()
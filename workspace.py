@@ -0,0 +1,329 @@
+import hashlib
+import io
+import logging
+import os
+import queue
+import shutil
+import tarfile
+import threading
+import time
+import uuid
+
+import metrics
+
+# brief functionality explanation:
+# the directories the scanner clones into.
+# every clone gets its own directory (<name>-<hash of the url>, so repos with
+# the same name from different owners do not collide). before a clone starts,
+# its expected size is reserved against a disk budget and against the free
+# space of the disk; if it does not fit, the clone waits until deletions free
+# enough space.
+# deleting is done by a background thread: a directory is renamed out of the
+# way (instant) and removed later, so workers never wait for rmtree.
+# hits can be kept as full checkouts, as just the matching files, or as a tarball.
+
+logger = logging.getLogger(__name__)
+
+MB = 1024 * 1024
+
+# how hit repositories are kept
+KEEP_MODES = ("checkout", "files", "tarball")
+
+
+class WorkspaceFull(RuntimeError):
+    """
+    The disk budget or the free disk space is used up by kept hits (or by
+    other files), so no clone can ever fit.
+    """
+
+
+def directory_size(path):
+    """
+    Returns:
+        int: The size of all files below `path` in bytes (0 if it does not exist).
+    """
+    total_size = 0
+    for dirpath, dirnames, filenames in os.walk(path):
+        for filename in filenames:
+            try:
+                total_size += os.lstat(os.path.join(dirpath, filename)).st_size
+            except OSError:
+                continue
+    return total_size
+
+
+class Workspace:
+    """
+    Clone directories under a disk budget, cleaned up by a background thread. Thread safe.
+    """
+
+    def __init__(self, root='./tmp', budget_mb=None, min_free_mb=1024, keep_hits="checkout", archive_dir='./hits'):
+        """
+        Args:
+            root (str, optional): Where the clones go, e.g. a tmpfs like /dev/shm/github_scan. Defaults to './tmp'.
+            budget_mb (int, optional): Maximum size of the workspace (clones in progress, kept hits and
+                directories waiting to be deleted). Defaults to None (no limit).
+            min_free_mb (int, optional): Never start a clone that would leave less free space on the disk. Defaults to 1024.
+            keep_hits (str, optional): "checkout" keeps the whole clone of a hit, "files" copies the matching
+                files to `archive_dir`, "tarball" packs the checkout (without .git) into `archive_dir`. Defaults to "checkout".
+            archive_dir (str, optional): Where hits are archived (not counted against the budget). Defaults to './hits'.
+        """
+        if keep_hits not in KEEP_MODES:
+            raise ValueError(f"keep_hits must be one of {', '.join(KEEP_MODES)}")
+        self.root = root
+        self.budget = None if budget_mb is None else budget_mb * MB
+        self.min_free = min_free_mb * MB
+        self.keep_hits = keep_hits
+        self.archive_dir = archive_dir
+
+        self.condition = threading.Condition()
+        # bytes per directory: reserved for clones in progress, measured once they are done
+        self.sizes = {}
+        # directories that were measured (the rest may still grow)
+        self.measured_paths = set()
+        # hits that stay in the workspace
+        self.kept = set()
+        # bytes of directories the reaper has not deleted yet
+        self.deleting = 0
+        # what was in the workspace before this run (kept hits of earlier runs)
+        self.existing = 0
+        self.warned = False
+
+        self.trash = queue.Queue()
+        self.reaper = None
+
+        if os.path.isdir(root):
+            for entry in os.listdir(root):
+                if entry.startswith('.trash-'):
+                    # left over by a run that stopped before its reaper was done
+                    self._delete_later(os.path.join(root, entry), None)
+            if self.budget is not None:
+                self.existing = directory_size(root)
+
+    def path(self, name, url):
+        """
+        Returns:
+            str: The clone directory of a repository.
+        """
+        digest = hashlib.sha1(url.strip().encode('utf-8')).hexdigest()[:8]
+        return os.path.join(self.root, f"{name}-{digest}")
+
+    def used(self):
+        # caller holds the condition
+        return self.existing + sum(self.sizes.values()) + self.deleting
+
+    def _blocked_by(self, nbytes):
+        # caller holds the condition. returns why a clone of nbytes does not fit, or None if it does
+        used = self.used()
+        if self.budget is not None and used + nbytes > self.budget:
+            kept = sum(self.sizes.get(path, 0) for path in self.kept)
+            return (f"the disk budget of {self.budget / MB:.0f} MB is used up ({used / MB:.0f} MB used, "
+                    f"{(kept + self.existing) / MB:.0f} MB of it kept hits and earlier runs, "
+                    f"{nbytes / MB:.0f} MB needed), archive or move kept hits, or raise the disk budget")
+        free = shutil.disk_usage(self.root).free
+        # clones in progress have not written all of their reservation yet
+        unwritten = sum(size for path, size in self.sizes.items() if path not in self.measured_paths)
+        if free - unwritten - nbytes < self.min_free:
+            return (f"the disk of {self.root} has {(free - unwritten) / MB:.0f} MB free, "
+                    f"{nbytes / MB:.0f} MB needed and at least {self.min_free / MB:.0f} MB must stay free, "
+                    f"free up disk space or lower the minimum free space")
+        return None
+
+    def reserve(self, path, nbytes):
+        """
+        Waits until a clone of `nbytes` fits, and books the space for it.
+
+        Args:
+            path (str): The clone directory (see path()).
+            nbytes (int): The expected size of the clone.
+
+        Raises:
+            WorkspaceFull: If the budget or the free disk space is used up, and no clone in progress can free it.
+        """
+        if self.budget is not None:
+            # a clone bigger than the whole budget runs on its own
+            nbytes = min(nbytes, self.budget)
+        os.makedirs(self.root, exist_ok=True)
+        with self.condition:
+            start = time.perf_counter()
+            while True:
+                blocked = self._blocked_by(nbytes)
+                if blocked is None:
+                    break
+                in_progress = len(self.sizes) - len(self.kept)
+                if not in_progress and not self.deleting:
+                    # nothing that could free space is left
+                    raise WorkspaceFull(f"no clone fits into the workspace {self.root}: {blocked}")
+                if not self.warned:
+                    logger.info("waiting for disk space before cloning", extra={"used_mb": round(self.used() / MB),
+                                                                               "needed_mb": round(nbytes / MB),
+                                                                               "reason": blocked})
+                    self.warned = True
+                self.condition.wait(1.0)
+            self.sizes[path] = nbytes
+        metrics.observe("disk_budget_wait", time.perf_counter() - start)
+        os.makedirs(path, exist_ok=True)
+
+    def measured(self, path, nbytes):
+        """
+        Replaces the reservation of a clone with its real size.
+        """
+        with self.condition:
+            self.sizes[path] = nbytes
+            self.measured_paths.add(path)
+            self.condition.notify_all()
+
+    def release(self, path):
+        """
+        Deletes a clone in the background. The directory is moved out of the
+        way right away, so it can be cloned into again.
+        """
+        with self.condition:
+            nbytes = self.sizes.pop(path, None)
+            self.measured_paths.discard(path)
+            self.kept.discard(path)
+            self.condition.notify_all()
+        if os.path.exists(path):
+            trash_path = os.path.join(self.root, f".trash-{uuid.uuid4().hex}")
+            os.rename(path, trash_path)
+            self._delete_later(trash_path, nbytes)
+
+    def discard(self, path):
+        """
+        Deletes a clone and the archive of its hits (e.g. a repository that is processed again).
+        """
+        self.release(path)
+        archive_path = self.archive_path(path)
+        if os.path.isdir(archive_path):
+            shutil.rmtree(archive_path, ignore_errors=True)
+        if os.path.exists(archive_path + '.tar.gz'):
+            os.remove(archive_path + '.tar.gz')
+
+    def _delete_later(self, trash_path, nbytes):
+        with self.condition:
+            if nbytes is not None:
+                self.deleting += nbytes
+            if self.reaper is None:
+                self.reaper = threading.Thread(target=self._reap, daemon=True)
+                self.reaper.start()
+        self.trash.put((trash_path, nbytes))
+
+    def _reap(self):
+        while True:
+            trash_path, nbytes = self.trash.get()
+            if trash_path is None:
+                return
+            if nbytes is None:
+                # not reserved in this run, it was counted in `existing`
+                nbytes = directory_size(trash_path)
+                unreserved = True
+            else:
+                unreserved = False
+            with metrics.timer("cleanup"):
+                shutil.rmtree(trash_path, ignore_errors=True)
+            with self.condition:
+                if unreserved:
+                    self.existing = max(0, self.existing - nbytes)
+                else:
+                    self.deleting -= nbytes
+                self.condition.notify_all()
+
+    def archive_path(self, path):
+        return os.path.join(self.archive_dir, os.path.basename(path))
+
+    def keep(self, path, hit_files):
+        """
+        Keeps a hit, as configured by keep_hits.
+
+        Args:
+            path (str): The clone directory.
+            hit_files (list): The matching files (below `path`).
+
+        Returns:
+            list: Where the matching files are kept: in the clone, in the archive directory,
+                or as `<tarball>#<file>` for tarballs.
+        """
+        if self.keep_hits == "checkout":
+            with self.condition:
+                self.kept.add(path)
+            return hit_files
+
+        os.makedirs(self.archive_dir, exist_ok=True)
+        archive_path = self.archive_path(path)
+        if self.keep_hits == "files":
+            kept_files = []
+            for file_path in hit_files:
+                relative_path = os.path.relpath(file_path, path)
+                destination = os.path.join(archive_path, relative_path)
+                os.makedirs(os.path.dirname(destination), exist_ok=True)
+                shutil.copy2(file_path, destination)
+                kept_files.append(destination)
+        else:
+            tarball_path = archive_path + '.tar.gz'
+            with tarfile.open(tarball_path, 'w:gz') as tarball:
+                tarball.add(path, arcname=os.path.basename(path),
+                            filter=lambda info: None if '/.git/' in f'/{info.name}/' else info)
+            kept_files = [f"{tarball_path}#{os.path.relpath(file_path, path)}" for file_path in hit_files]
+        self.release(path)
+        return kept_files
+
+    def kept_location(self, path, relative_path):
+        """
+        Finds a file of a hit that was kept by an earlier run, in any of the keep_hits modes.
+
+        Args:
+            path (str): The clone directory of the repository.
+            relative_path (str): The file, relative to the repository root.
+
+        Returns:
+            str: Where the file is kept, as returned by keep(), or None if it is not kept (anymore).
+        """
+        archive_path = self.archive_path(path)
+        for candidate in (os.path.join(path, relative_path), os.path.join(archive_path, relative_path)):
+            if os.path.isfile(candidate):
+                return candidate
+        if os.path.isfile(archive_path + '.tar.gz'):
+            return f"{archive_path}.tar.gz#{relative_path}"
+        return None
+
+    def keep_contents(self, path, contents):
+        """
+        Keeps the matching files of a hit that was scanned in memory (see tarball_fetch.py).
+        There is no checkout, so "checkout" keeps the files like "files" does.
+
+        Args:
+            path (str): The clone directory the repository would have had (for the archive name).
+            contents (dict): Maps the matching files (relative to the repository root) to their content.
+
+        Returns:
+            list: Where the matching files are kept, as for keep().
+        """
+        os.makedirs(self.archive_dir, exist_ok=True)
+        archive_path = self.archive_path(path)
+        if self.keep_hits == "tarball":
+            tarball_path = archive_path + '.tar.gz'
+            with tarfile.open(tarball_path, 'w:gz') as tarball:
+                for relative_path, data in sorted(contents.items()):
+                    info = tarfile.TarInfo(f"{os.path.basename(path)}/{relative_path}")
+                    info.size = len(data)
+                    info.mtime = time.time()
+                    tarball.addfile(info, io.BytesIO(data))
+            return [f"{tarball_path}#{relative_path}" for relative_path in sorted(contents)]
+
+        kept_files = []
+        for relative_path, data in sorted(contents.items()):
+            destination = os.path.join(archive_path, relative_path)
+            os.makedirs(os.path.dirname(destination), exist_ok=True)
+            with open(destination, 'wb') as file:
+                file.write(data)
+            kept_files.append(destination)
+        return kept_files
+
+    def close(self):
+        """
+        Waits until all deletions are done.
+        """
+        if self.reaper is not None:
+            self.trash.put((None, None))
+            self.reaper.join()
+            self.reaper = None